@@ -19,6 +19,8 @@ from os import listdir
 from os.path import isfile, isdir, join
 import math
 import ipaddress
+import io
+import numpy as np
 
 imrs_headers = [ "network", "queries", \
     "h00", "h01", "h02", "h03", "h04", "h05", "h06", "h07", "h08", "h09", \
@@ -120,11 +122,14 @@ class imrs_hyperloglog:
             if V > 0:
                 self.E = 16 * math.log(16.0 / V)
 
-    def add(self, other):
+    # With assess=False, the estimate is not updated: when merging many
+    # records, call assess() once before using E.
+    def add(self, other, assess=True):
         for i in range(0, len(self.hllv)):
             if self.hllv[i] < other.hllv[i]:
                 self.hllv[i] = other.hllv[i]
-        self.assess()
+        if assess:
+            self.assess()
 
     def to_string(self):
         s = str(int(self.E))+","
@@ -132,6 +137,70 @@ class imrs_hyperloglog:
             s += str(self.hllv[i])+","
         return s
 
+# Batch of HyperLogLog sketches, with one row of 16 registers per sketch.
+# The merges are element-wise maximums of the register matrices, and the
+# estimates are computed for all rows at once by assess(), with the same
+# formula and the same linear counting correction as imrs_hyperloglog.
+# The estimates are only computed when needed, after the merges.
+class imrs_hll_batch:
+    def __init__(self, registers=None, nb_rows=0):
+        if registers is None:
+            registers = np.zeros((nb_rows, 16), dtype=np.int64)
+        self.registers = registers
+        self.E = None
+
+    def __len__(self):
+        return self.registers.shape[0]
+
+    def from_hyperloglogs(hll_list):
+        registers = np.zeros((len(hll_list), 16), dtype=np.int64)
+        for i in range(0, len(hll_list)):
+            registers[i] = hll_list[i].hllv
+        return imrs_hll_batch(registers)
+
+    # merge the rows of other into the rows of this batch. If targets is
+    # None, the two batches have the same number of rows, and row i is
+    # merged in row i. Otherwise, row i of other is merged in the row
+    # targets[i], and several rows can be merged in the same target.
+    def merge(self, other, targets=None):
+        if targets is None:
+            np.maximum(self.registers, other.registers, out=self.registers)
+        else:
+            np.maximum.at(self.registers, targets, other.registers)
+        self.E = None
+
+    # reduce returns a batch of nb_groups rows, in which row g is the merge
+    # of the rows i for which groups[i] == g.
+    def reduce(self, groups, nb_groups):
+        reduced = imrs_hll_batch(nb_rows=nb_groups)
+        if len(groups) > 0:
+            order = np.argsort(groups, kind="stable")
+            sorted_groups = groups[order]
+            starts = np.flatnonzero(np.concatenate(([True], sorted_groups[1:] != sorted_groups[:-1])))
+            reduced.registers[sorted_groups[starts]] = np.maximum.reduceat(self.registers[order], starts, axis=0)
+        return reduced
+
+    def assess(self):
+        divider = np.ldexp(1.0, -self.registers).sum(axis=1)
+        E = 172.288 / divider
+        V = np.count_nonzero(self.registers == 0, axis=1)
+        linear = (E < 40.0) & (V > 0)
+        E[linear] = 16 * np.log(16.0 / V[linear])
+        self.E = E
+        return E
+
+    def estimates(self):
+        if self.E is None:
+            self.assess()
+        return self.E
+
+    # get returns row i as an imrs_hyperloglog
+    def get(self, i):
+        hll = imrs_hyperloglog()
+        hll.hllv = self.registers[i].tolist()
+        hll.E = float(self.estimates()[i])
+        return hll
+
 class imrs_record:
     def __init__(self):
         self.ip = ""
@@ -186,6 +255,30 @@ class imrs_record:
             print("Cannot parse IMRS Record after " + str(parsed) + " parts:\n" + line.strip()  + "\nException: " + str(e))
         return ok
 
+    # set_row sets the record from a row of an imrs_matrix: the network,
+    # the list of values and the list of the two HLL estimates.
+    def set_row(self, ip, values, estimates):
+        self.ip = ip
+        self.query_volume = values[0]
+        self.hourly_volume = values[imrs_column_slice("h00", "h23")]
+        self.daily_volume = values[imrs_column_slice("d00", "d30")]
+        self.arpa_count = values[imrs_column_index["arpa0"]]
+        self.no_such_domain_queries = values[imrs_column_index["no_such"]]
+        self.no_such_domain_reserved = values[imrs_column_index["ns_res"]]
+        self.no_such_domain_frequent = values[imrs_column_index["ns_frq"]]
+        self.no_such_domain_chromioids = values[imrs_column_index["ns_chr"]]
+        self.tld_counts = values[imrs_column_slice("COM", "US")]
+        self.tld_hyperlog.E = estimates[0]
+        self.tld_hyperlog.hllv = values[imrs_column_slice("tldh0", "tldhf")]
+        self.sld_counts = values[imrs_column_slice("RESOLVER", "PROD")]
+        self.sld_hyperlog.E = estimates[1]
+        self.sld_hyperlog.hllv = values[imrs_column_slice("sldh0", "sldhf")]
+        self.name_parts = values[imrs_column_slice("np0", "np7_more")]
+        self.rr_types = values[imrs_column_slice("NS", "SOA")]
+        self.locales = values[imrs_column_slice("loc0", "loc7")]
+        self.apnic_count = values[imrs_column_index["APNIC"]]
+        self.server_count = values[imrs_column_index["servers"]]
+
     def parse_volume_only(self, line):
         ok = False
         try:
@@ -199,7 +292,8 @@ class imrs_record:
             print("Cannot parse IMRS Record after " + str(parsed) + " parts:\n" + line.strip()  + "\nException: " + str(e))
         return ok
 
-    def add(self, other, is_new_ip=False):
+    # With assess=False, the HLL estimates are only updated by assess().
+    def add(self, other, is_new_ip=False, assess=True):
         self.query_volume += other.query_volume
         imrs_add_one_vector(self.hourly_volume, other.hourly_volume)
         imrs_add_one_vector(self.daily_volume, other.daily_volume)
@@ -209,15 +303,19 @@ class imrs_record:
         self.no_such_domain_frequent += other.no_such_domain_frequent
         self.no_such_domain_chromioids += other.no_such_domain_chromioids
         imrs_add_one_vector(self.tld_counts, other.tld_counts)
-        self.tld_hyperlog.add(other.tld_hyperlog)
+        self.tld_hyperlog.add(other.tld_hyperlog, assess=assess)
         imrs_add_one_vector(self.sld_counts, other.sld_counts)
-        self.sld_hyperlog.add(other.sld_hyperlog)
+        self.sld_hyperlog.add(other.sld_hyperlog, assess=assess)
         imrs_add_one_vector(self.name_parts, other.name_parts)
         imrs_add_one_vector(self.rr_types, other.rr_types)
         imrs_add_one_vector(self.locales, other.locales)
         if is_new_ip:
             self.server_count += other.server_count
 
+    def assess(self):
+        self.tld_hyperlog.assess()
+        self.sld_hyperlog.assess()
+
     def to_string(self):
         s =""
         s += self.ip + ","
@@ -262,8 +360,8 @@ class imrs_record:
         for sld_count in self.sld_counts:
             ratio.append(query_ratio*sld_count)
         ratio.append(query_ratio*self.sld_hyperlog.E)
-        for np in self.name_parts:
-            ratio.append(query_ratio*np)
+        for np_count in self.name_parts:
+            ratio.append(query_ratio*np_count)
         for rr in self.rr_types:
             ratio.append(query_ratio*rr)
         try:
@@ -298,6 +396,163 @@ class imrs_record:
         s += "APNIC,"
         return s
 
+# Bulk loading of ipstats files.
+#
+# parse_imrs converts each field of each line with strip() and int(). The
+# bulk loader reads the file by chunks of lines, and converts each chunk
+# with numpy.loadtxt, in a matrix with one column per header after the
+# network. The matrix is in float64 when parsed, because the "TLDs" and
+# "SLDs" columns hold the HyperLogLog estimates, and because some files
+# have "0.0" instead of "0" in the registers. It is then split into an
+# int64 matrix, the values, and a float64 matrix of the two estimates. The
+# estimates are also in the values, truncated as in to_string.
+#
+# Lines without the APNIC and servers columns get the same defaults as in
+# imrs_record, 0 and 1. A chunk that loadtxt cannot convert is parsed again
+# line by line, and the lines that cannot be converted are skipped.
+imrs_columns = imrs_headers[1:]
+imrs_column_index = dict()
+for i in range(0, len(imrs_columns)):
+    imrs_column_index[imrs_columns[i]] = i
+imrs_estimate_columns = [ imrs_column_index["TLDs"], imrs_column_index["SLDs"] ]
+imrs_min_columns = imrs_column_index["APNIC"]
+imrs_tail_defaults = [ ",0,1", ",1", "" ]
+
+def imrs_column_slice(first, last):
+    return slice(imrs_column_index[first], imrs_column_index[last] + 1)
+
+class imrs_matrix:
+    def __init__(self, ips=None, values=None, estimates=None):
+        if ips is None:
+            ips = []
+        if values is None:
+            values = np.zeros((0, len(imrs_columns)), dtype=np.int64)
+        if estimates is None:
+            estimates = np.zeros((0, 2), dtype=np.float64)
+        self.ips = ips
+        self.values = values
+        self.estimates = estimates
+
+    def __len__(self):
+        return len(self.ips)
+
+    def column(self, name):
+        return self.values[:, imrs_column_index[name]]
+
+    def hll_registers(self, prefix):
+        return self.values[:, imrs_column_slice(prefix + "h0", prefix + "hf")]
+
+    # hll_batch returns the "tld" or "sld" sketches of the rows
+    def hll_batch(self, prefix):
+        return imrs_hll_batch(self.hll_registers(prefix).copy())
+
+    # record returns an imrs_record with the values of row i, the same as
+    # parse_imrs would return for the line of that row.
+    def record(self, i):
+        rec = imrs_record()
+        rec.set_row(self.ips[i], self.values[i].tolist(), self.estimates[i].tolist())
+        return rec
+
+    def records(self):
+        for i in range(0, len(self.ips)):
+            yield self.record(i)
+
+    def concatenate(matrices):
+        if len(matrices) == 0:
+            return imrs_matrix()
+        if len(matrices) == 1:
+            return matrices[0]
+        ips = []
+        for m in matrices:
+            ips += m.ips
+        return imrs_matrix(ips, np.concatenate([ m.values for m in matrices ]), \
+            np.concatenate([ m.estimates for m in matrices ]))
+
+    # parse the text of a chunk, in which the network column was removed,
+    # and the tail columns added.
+    def from_text(ips, text, nb_lines):
+        if nb_lines == 0:
+            return imrs_matrix()
+        parsed = np.loadtxt(io.StringIO(text), delimiter=",", dtype=np.float64, ndmin=2)
+        if parsed.shape != (nb_lines, len(imrs_columns)):
+            raise ValueError("Unexpected shape " + str(parsed.shape))
+        estimates = parsed[:, imrs_estimate_columns].copy()
+        return imrs_matrix(ips, parsed.astype(np.int64), estimates)
+
+    # Parse the lines one by one, after loadtxt failed for the chunk, and
+    # skip the lines that cannot be parsed.
+    def from_lines(lines):
+        ips = []
+        rows = []
+        for line in lines:
+            line_ips = []
+            line_rows = []
+            try:
+                if not imrs_prepare_line(line, line_ips, line_rows):
+                    raise ValueError("Unexpected number of columns")
+                imrs_matrix.from_text(line_ips, line_rows[0], 1)
+                ips += line_ips
+                rows += line_rows
+            except Exception as e:
+                if len(line.strip()) > 0:
+                    print("Cannot parse IMRS Record:\n" + line.strip()  + "\nException: " + str(e))
+        return imrs_matrix.from_text(ips, "\n".join(rows), len(rows))
+
+def imrs_prepare_line(line, ips, rows):
+    line = line.rstrip("\r\n, ")
+    if len(line) == 0:
+        return False
+    comma = line.find(",")
+    if comma < 0:
+        return False
+    ip = line[:comma].strip()
+    if len(ip) == 0:
+        ip = "0.0.0.0"
+    nb_columns = line.count(",")
+    if nb_columns < imrs_min_columns or nb_columns > len(imrs_columns):
+        return False
+    ips.append(ip)
+    rows.append(line[comma+1:] + imrs_tail_defaults[nb_columns - imrs_min_columns])
+    return True
+
+def imrs_load_chunk(lines):
+    ips = []
+    rows = []
+    is_valid = True
+    for line in lines:
+        if not imrs_prepare_line(line, ips, rows):
+            if len(line.strip()) > 0:
+                is_valid = False
+    if is_valid:
+        try:
+            return imrs_matrix.from_text(ips, "\n".join(rows), len(rows))
+        except Exception as e:
+            print("Cannot load IMRS chunk, parsing line by line.\nException: " + str(e))
+    return imrs_matrix.from_lines(lines)
+
+# imrs_matrix_chunks reads the file and yields one imrs_matrix per chunk
+# of chunk_size lines, so that large files can be processed without
+# holding all the lines in memory. A header line starting with "network"
+# is skipped.
+def imrs_matrix_chunks(imrs_file, chunk_size=1000000):
+    lines = []
+    is_first = True
+    with open(imrs_file, "r") as F:
+        for line in F:
+            if is_first:
+                is_first = False
+                if line.startswith(imrs_headers[0] + ","):
+                    continue
+            lines.append(line)
+            if len(lines) >= chunk_size:
+                yield imrs_load_chunk(lines)
+                lines = []
+    if len(lines) > 0:
+        yield imrs_load_chunk(lines)
+
+def imrs_load_matrix(imrs_file, chunk_size=1000000):
+    return imrs_matrix.concatenate(list(imrs_matrix_chunks(imrs_file, chunk_size=chunk_size)))
+
 class apnic_record:
     def __init__(self):
         self.ip = ""
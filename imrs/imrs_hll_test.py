@@ -0,0 +1,79 @@
+# IMRS HyperLogLog batch test.
+# verify that imrs_hll_batch gives the same registers and the same
+# estimates as imrs_hyperloglog, for single sketches, for row by row
+# merges, and for merges of groups of rows.
+
+import random
+import numpy as np
+import imrs
+
+def random_hll(rng):
+    hll = imrs.imrs_hyperloglog()
+    # mostly small values, with many empty registers, so that both the
+    # linear counting and the harmonic mean formulas are tested.
+    nb_filled = rng.randrange(0, 17)
+    for i in range(0, nb_filled):
+        hll.hllv[rng.randrange(0, 16)] = rng.randrange(1, 24)
+    hll.assess()
+    return hll
+
+def same_hll(name, hll, batch_hll):
+    if hll.hllv != batch_hll.hllv or abs(hll.E - batch_hll.E) > 1e-9*max(1.0, hll.E) or \
+        hll.to_string() != batch_hll.to_string():
+        print(name + ": " + hll.to_string() + " != " + batch_hll.to_string())
+        return False
+    return True
+
+def assess_test(hll_list):
+    passing = True
+    batch = imrs.imrs_hll_batch.from_hyperloglogs(hll_list)
+    for i in range(0, len(hll_list)):
+        passing &= same_hll("assess[" + str(i) + "]", hll_list[i], batch.get(i))
+    return passing
+
+def merge_test(hll_list, other_list):
+    passing = True
+    batch = imrs.imrs_hll_batch.from_hyperloglogs(hll_list)
+    batch.merge(imrs.imrs_hll_batch.from_hyperloglogs(other_list))
+    for i in range(0, len(hll_list)):
+        hll = imrs.imrs_hyperloglog()
+        hll.hllv = list(hll_list[i].hllv)
+        hll.add(other_list[i])
+        passing &= same_hll("merge[" + str(i) + "]", hll, batch.get(i))
+    return passing
+
+def reduce_test(hll_list, rng):
+    passing = True
+    nb_groups = 50
+    groups = np.array([ rng.randrange(0, nb_groups) for i in range(0, len(hll_list)) ])
+    batch = imrs.imrs_hll_batch.from_hyperloglogs(hll_list)
+    reduced = batch.reduce(groups, nb_groups)
+    merged = imrs.imrs_hll_batch(nb_rows=nb_groups)
+    merged.merge(batch, targets=groups)
+    expected = []
+    for g in range(0, nb_groups):
+        expected.append(imrs.imrs_hyperloglog())
+    for i in range(0, len(hll_list)):
+        expected[groups[i]].add(hll_list[i], assess=False)
+    for g in range(0, nb_groups):
+        expected[g].assess()
+        passing &= same_hll("reduce[" + str(g) + "]", expected[g], reduced.get(g))
+        passing &= same_hll("merge_at[" + str(g) + "]", expected[g], merged.get(g))
+    return passing
+
+if __name__ == "__main__":
+    rng = random.Random(1234)
+    hll_list = []
+    other_list = []
+    for i in range(0, 1000):
+        hll_list.append(random_hll(rng))
+        other_list.append(random_hll(rng))
+    passing = assess_test(hll_list)
+    passing &= merge_test(hll_list, other_list)
+    passing &= reduce_test(hll_list, rng)
+    if not passing:
+        print("Fail.")
+        exit(-1)
+    else:
+        print("Success.")
+        exit(0)
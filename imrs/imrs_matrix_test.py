@@ -0,0 +1,73 @@
+# IMRS matrix test.
+# verify that the bulk loader of ipstats files gives the same records as
+# parse_imrs, for lines with or without the APNIC and servers columns,
+# with "0.0" HLL registers, and when some lines cannot be parsed.
+#
+# Usage: python imrs_matrix_test.py [<ipstats_file>]
+
+import sys
+import os
+import tempfile
+import imrs
+
+def test_lines():
+    line = "10.0.0.1,12"
+    for i in range(0, 24):
+        line += "," + str(i%3)
+    for i in range(0, 31):
+        line += "," + str(i%2)
+    line += ",1,2,3,4,5"
+    line += ",1,2,3,4,5,6,7,8,3.5"
+    for i in range(0, 16):
+        line += "," + str(i%4)
+    line += ",8,7,6,5,4,3,2,1,2.25"
+    for i in range(0, 16):
+        line += ",0.0"
+    line += ",1,1,1,1,1,1,1,5,2,2,2,2,2,2,0,0,3,3,3,3,0,0,0,0"
+    lines = [ line + "\n", \
+        line.replace("10.0.0.1", "10.0.0.2") + ",17\n", \
+        line.replace("10.0.0.1", "10.0.0.3") + ",17,4,\n", \
+        line.replace("10.0.0.1,12", ",3") + "\n" ]
+    return lines
+
+def compare(m, lines):
+    passing = True
+    if len(m) != len(lines):
+        print("Loaded " + str(len(m)) + " records instead of " + str(len(lines)))
+        return False
+    for i in range(0, len(lines)):
+        rec = imrs.imrs_record()
+        rec.parse_imrs(lines[i].rstrip(", \n") + "\n")
+        m_rec = m.record(i)
+        if rec.to_string() != m_rec.to_string() or rec.tld_hyperlog.E != m_rec.tld_hyperlog.E or \
+            rec.sld_hyperlog.E != m_rec.sld_hyperlog.E:
+            print("Record " + str(i) + " differs:\n" + rec.to_string() + "\n" + m_rec.to_string())
+            passing = False
+    return passing
+
+if __name__ == "__main__":
+    passing = True
+    lines = test_lines()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        test_file = os.path.join(temp_dir, "ipstats.csv")
+        with open(test_file, "w") as F:
+            F.write(",".join(imrs.imrs_headers) + "\n")
+            for line in lines[:2]:
+                F.write(line)
+            F.write("not,an,ipstats,line\n")
+            for line in lines[2:]:
+                F.write(line)
+        m = imrs.imrs_load_matrix(test_file, chunk_size=3)
+        passing &= compare(m, lines)
+        if list(m.column("APNIC")) != [ 0, 17, 17, 0 ] or list(m.column("servers")) != [ 1, 1, 4, 1 ]:
+            print("Unexpected tail columns: " + str(m.column("APNIC")) + ", " + str(m.column("servers")))
+            passing = False
+    if len(sys.argv) > 1:
+        file_lines = open(sys.argv[1], "r").readlines()
+        passing &= compare(imrs.imrs_load_matrix(sys.argv[1], chunk_size=1000), file_lines)
+    if not passing:
+        print("Fail.")
+        exit(-1)
+    else:
+        print("Success.")
+        exit(0)
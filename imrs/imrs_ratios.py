@@ -31,9 +31,8 @@ output_file = sys.argv[2]
 
 with open(output_file,"w") as F:
     F.write("network,queries," + imrs.imrs_record.ratio_headers() + "\n")
-    for line in open(stats_file,"r"):
-        rec = imrs.imrs_record()
-        if rec.parse_imrs(line):
+    for m in imrs.imrs_matrix_chunks(stats_file):
+        for rec in m.records():
             ratios = rec.ratios()
             F.write(rec.ip + "," + str(rec.query_volume) + ",")
             for ratio in ratios:
@@ -51,7 +51,7 @@ class server_process:
                 self.group_is_parsed = True
             parsed = imrs.imrs_record()
             parsed.parse_imrs(line)
-            self.group_record.add(parsed, is_new_ip=True)
+            self.group_record.add(parsed, is_new_ip=True, assess=False)
         self.this_group += 1
         self.this_queries += queries
 
@@ -79,6 +79,7 @@ class server_process:
                 self.nb_apnic_found += 1
                 apnic_count = apnic_nets[self.previous_network]
             if self.need_output:
+                self.group_record.assess()
                 self.group_record.apnic_count = apnic_count
                 F.write(self.group_record.to_string() + "\n")
             if self.this_queries > 10000 or apnic_count > 1000:
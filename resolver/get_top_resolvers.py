@@ -41,24 +41,31 @@ import time
 import pandas as pd
 import bz2
 import top_as
+import rdap_names
+import uid_hll
 
+# The count is the number of distinct UIDs when loading logs, or the sum
+# of the counts when loading saved files. The UIDs are kept in an exact
+# set by default, or counted with a HyperLogLog sketch if approximate is
+# True (see uid_hll.py for the error bounds).
 class resolver_cc_as:
-    def __init__(self, query_AS, query_cc, AS_name="", has_name=False):
+    def __init__(self, query_AS, query_cc, AS_name="", has_name=False, approximate=False):
         self.query_AS = query_AS
         self.query_cc = query_cc
         self.AS_name = AS_name
         self.has_name = has_name
-        self.uid_set = set()
+        self.uid_set = uid_hll.new_uid_set(approximate)
         self.count = 0
 
     def add_uid(self, uid):
-        if not uid in self.uid_set:
-            self.uid_set.add(uid)
-            self.count += 1
+        self.uid_set.add(uid)
 
     def add_count(self, count):
         self.count += count
 
+    def get_count(self):
+        return self.count + self.uid_set.count()
+
     
     def headers():
         return [ 
@@ -69,7 +76,7 @@ class resolver_cc_as:
            ]
     
     def cc_as_row(self, resolver_AS, as_names):
-        return [ resolver_AS, self.query_cc, self.query_AS, self.count ]
+        return [ resolver_AS, self.query_cc, self.query_AS, self.get_count() ]
 
     
     def top_headers():
@@ -85,20 +92,21 @@ class resolver_cc_as:
     def top_cc_as_row(self, resolver_AS, as_names, AS_name="", has_name=False):
         if self.AS_name == "":
             self.AS_name = as_names.name(self.query_AS)
-        return [ resolver_AS, self.query_cc, self.query_AS, self.count, self.AS_name, self.has_name ]
+        return [ resolver_AS, self.query_cc, self.query_AS, self.get_count(), self.AS_name, self.has_name ]
 
 
 class resolver:
-    def __init__(self, resolver_AS):
+    def __init__(self, resolver_AS, approximate=False):
         self.resolver_AS = resolver_AS
         self.r_cc_AS = dict()
         self.total = 0
         self.tops = []
+        self.approximate = approximate
 
     def add_uid(self, query_AS, query_cc, uid, AS_name="", has_name=False):
         key = query_cc + query_AS
         if not key in self.r_cc_AS:
-            self.r_cc_AS[key] = resolver_cc_as(query_AS, query_cc, AS_name=AS_name, has_name=has_name)
+            self.r_cc_AS[key] = resolver_cc_as(query_AS, query_cc, AS_name=AS_name, has_name=has_name, approximate=self.approximate)
         self.r_cc_AS[key].add_uid(uid)
 
     def as_rows(self, as_names, AS_name="", has_name=False):
@@ -120,8 +128,9 @@ class resolver:
         self.tops = []
         for key in self.r_cc_AS:
             rca = self.r_cc_AS[key]
-            self.total += rca.count
-            self.tops.append([key, rca.count])
+            count = rca.get_count()
+            self.total += count
+            self.tops.append([key, count])
         self.tops.sort(key=lambda x: x[1], reverse=True)
 
     def export_top(self, as_names, threshold=100):
@@ -135,9 +144,18 @@ class resolver:
             t.append(self.r_cc_AS[x[0]].top_cc_as_row(self.resolver_AS, as_names))
         return t
 
+# non_empty_strings returns the mask of the values of a column that are
+# non empty strings, which is the test of resolver.load_row.
+def non_empty_strings(column):
+    try:
+        return (column.str.len() > 0).fillna(False).astype(bool)
+    except AttributeError:
+        return pd.Series(False, index=column.index)
+
 class resolver_list:
-    def __init__(self):
+    def __init__(self, approximate=False):
         self.resolvers = dict()
+        self.approximate = approximate
         self.top_list = []
         self.sum_total = 0
         self.groups = dict()
@@ -152,6 +170,7 @@ class resolver_list:
             F = bz2.open(file_name, "rt")
         else:
             F = open(file_name, "r")
+        rsv_cache = rsv_log_parse.resolver_cache()
         for line in F:
             parsed = True
             try:
@@ -164,10 +183,10 @@ class resolver_list:
                 parsed = False
             if parsed:
                 if (not filtering) or x.filter(rr_types=rr_types, experiment=experiment):
-                    x.set_resolver_AS(ip2a4, ip2a6, as_names)
+                    x.set_resolver_AS(ip2a4, ip2a6, as_names, rsv_cache=rsv_cache)
                     if x.resolver_AS != 'AS0' and (x.resolver_tag == 'Same_CC' or x.resolver_tag == 'Others'):
                         if not x.resolver_AS in self.resolvers:
-                            self.resolvers[x.resolver_AS] = resolver(x.resolver_AS)
+                            self.resolvers[x.resolver_AS] = resolver(x.resolver_AS, approximate=self.approximate)
                         self.resolvers[x.resolver_AS].add_uid(x.query_AS, x.query_cc, x.query_user_id)
                     nb_events += 1
                     if (nb_events%lth) == 0:
@@ -195,9 +214,28 @@ class resolver_list:
         self.resolvers[resolver_AS].load_row(x['query_cc'], x['query_AS'], x['count'])
         self.sum_total += x['count']
 
+    # load_file has the same result as calling process_row for each row,
+    # but sums the counts per resolver and CC+AS with a groupby. As in
+    # process_row, a resolver is created for every row, even if its CC or
+    # AS is not valid, and the CC+AS appear in the order of their first row.
     def load_file(self, saved_file):
         df = pd.read_csv(saved_file)
-        df.apply(lambda x: self.process_row(x), axis=1)
+        for resolver_AS in pd.unique(df['resolver_AS']).tolist():
+            if not resolver_AS in self.resolvers:
+                self.resolvers[resolver_AS] = resolver(resolver_AS)
+        valid = non_empty_strings(df['query_cc']) & non_empty_strings(df['query_AS'])
+        vdf = df[valid]
+        vdf = vdf.assign(key=vdf['query_cc'] + vdf['query_AS'])
+        sums = vdf.groupby(['resolver_AS', 'key'], sort=False, dropna=False).agg( \
+            query_cc=('query_cc', 'first'), query_AS=('query_AS', 'first'), count=('count', 'sum'))
+        for index, query_cc, query_AS, count in zip(sums.index.tolist(), sums['query_cc'].tolist(), \
+            sums['query_AS'].tolist(), sums['count'].tolist()):
+            resolver_AS, key = index
+            r_cc_AS = self.resolvers[resolver_AS].r_cc_AS
+            if not key in r_cc_AS:
+                r_cc_AS[key] = resolver_cc_as(query_AS, query_cc)
+            r_cc_AS[key].add_count(count)
+        self.sum_total += sum(df['count'].tolist())
 
     def export_top(self, top_file, as_names, threshold=100):
         self.top_list = []
@@ -310,6 +348,17 @@ class top_resolver:
         cc_as.count = count
         self.top_list.append(cc_as)
 
+    # missing_names returns the list of [ asn, cc, as_name ] for which
+    # get_names will need a name.
+    def missing_names(self):
+        missing = []
+        if not self.has_name:
+            missing.append([ self.resolver_AS, self.resolver_cc, self.AS_name ])
+        for cc_as in self.top_list:
+            if not cc_as.has_name:
+                missing.append([ cc_as.query_AS, cc_as.query_cc, cc_as.AS_name ])
+        return missing
+
     def get_names(self, know_names):
         all_found = True
         if not self.has_name:
@@ -490,12 +539,33 @@ class top_resolvers_list:
             else:
                 self.top_list[resolver_AS].add_query_as(x['query_AS'], x['query_cc'], x['count'], x['AS_name'], x['has_name'])
 
+    # load_file has the same result as calling process_row for each row, but
+    # reads the columns as lists instead of building a Series per row.
     def load_file(self, saved_file):
         df = pd.read_csv(saved_file)
-        df.apply(lambda x: self.process_row(x), axis=1)
+        is_total = (df['query_AS'] == 'total').fillna(False).astype(bool).tolist()
+        for resolver_AS, query_cc, query_AS, count, AS_name, has_name, total in zip( \
+            df['resolver_AS'].tolist(), df['query_cc'].tolist(), df['query_AS'].tolist(), \
+            df['count'].tolist(), df['AS_name'].tolist(), df['has_name'].tolist(), is_total):
+            if total:
+                if not resolver_AS in self.top_list:
+                    self.top_list[resolver_AS] = top_resolver(resolver_AS, query_cc, count, AS_name, has_name)
+                else:
+                    print("Duplicate resolver: " + resolver_AS)
+                    exit(-1)
+            elif not resolver_AS in self.top_list:
+                print("Missing resolver total: " + resolver_AS)
+                exit(-1)
+            else:
+                self.top_list[resolver_AS].add_query_as(query_AS, query_cc, count, AS_name, has_name)
 
     def get_names(self, know_names):
         all_found = True
+        if know_names.fetcher is not None:
+            missing = []
+            for resolver_AS in self.top_list:
+                missing += self.top_list[resolver_AS].missing_names()
+            know_names.prefetch(missing)
         for resolver_AS in self.top_list:
             all_found &= self.top_list[resolver_AS].get_names(know_names)
 
@@ -577,24 +647,33 @@ class top_resolvers_list:
 # Main program
 if __name__ == "__main__":
     time_start = time.time()
+    # with --approximate, the UIDs are counted with HyperLogLog sketches
+    approximate = "--approximate" in sys.argv
+    if approximate:
+        sys.argv.remove("--approximate")
+    # with --rdap-cache <file>, the AS names are kept in a cache file,
+    # and the missing ones fetched concurrently.
+    rdap_cache_file = ""
+    if "--rdap-cache" in sys.argv:
+        i = sys.argv.index("--rdap-cache")
+        if i + 1 >= len(sys.argv):
+            print("Missing file name after --rdap-cache")
+            exit(-1)
+        rdap_cache_file = sys.argv[i+1]
+        sys.argv = sys.argv[:i] + sys.argv[i+2:]
     source_path = Path(__file__).resolve()
     resolver_dir = source_path.parent
     auto_source_dir = resolver_dir.parent
     print("Auto source path is: " + str(auto_source_dir) + " (source: " + str(source_path) + ")")
     source_dir = os.path.join(auto_source_dir, "data") 
-    ip2a4_file = os.path.join(source_dir, "ip2as.csv") 
-    ip2a6_file = os.path.join(source_dir, "ip2asv6.csv")
     as_names_file = os.path.join(source_dir, "as_names.csv") 
     if sys.argv[1] != '+' and sys.argv[1] != '!' and sys.argv[1] != '=' and sys.argv[1] != '?':
-        ip2a4 = ip2as.ip2as_table()
-        ip2a4.load(ip2a4_file)
-        ip2a6 = ip2as.ip2as_table()
-        ip2a6.load(ip2a6_file)
+        ip2a4, ip2a6, as_names = ip2as.load_tables(source_dir)
     else:
         ip2a4 = None
         ip2a6 = None
-    as_names = ip2as.asname()
-    as_names.load(as_names_file)
+        as_names = ip2as.asname()
+        as_names.load(as_names_file)
     time_loaded = time.time()
     print("Tables loaded at " + str(time_loaded - time_start) + " seconds.")
     if sys.argv[1] == '+':
@@ -629,10 +708,20 @@ if __name__ == "__main__":
                 print('\nCode generated an exception: %s' % (exc))
                 print("Cannot get names from top AS list: " + sys.argv[3])
                 exit(-1)
+        rdap_cache = None
+        if len(rdap_cache_file) > 0:
+            rdap_cache = rdap_names.rdap_cache(rdap_cache_file)
+            rdap_cache.warm_defaults()
+            rdap_fetcher = rdap_names.rdap_fetcher(rdap_cache)
+            rdap_fetcher.load_bgp_names(as_names_file)
+            know_names.set_fetcher(rdap_fetcher)
         top_list = top_resolvers_list()
         top_list.load_file(sys.argv[2])
         top_list.get_names(know_names)
         top_list.export_top(sys.argv[2])
+        if rdap_cache is not None:
+            rdap_cache.save()
+            print(rdap_cache.stats())
         print("Updated top file at " + str(time.time() - time_start) + " seconds.")
         exit(0)
     if sys.argv[1] == '?':
@@ -649,7 +738,7 @@ if __name__ == "__main__":
     as_names.load(as_names_file)
     print("AS names loaded at " + str(time.time() - time_start) + " seconds.")
 
-    r_list =  resolver_list()
+    r_list =  resolver_list(approximate=approximate)
     nb_events = r_list.load(sys.argv[1], ip2a4, ip2a6, as_names,
         experiment=['0du'], rr_types = [ 'A', 'AAAA', 'HTTPS' ], time_start = time_start)
     print("Loaded " + str(nb_events) + " events for " + str(len(r_list.resolvers)) + " resolvers at " + str(time.time() - time_start) + " seconds.")
@@ -17,10 +17,26 @@
 # implement a simple binary search algorithm, finding the highest index in
 # the table such that beginning <= search address. We then return the
 # associated AS number if the address is in range, or 0 if it is not.
+#
+# Keeping one Python object per line costs a lot of memory and makes the
+# search slow, so the table is stored as sorted numpy arrays: the IPv4
+# ranges as uint32 values, the IPv6 ranges as 16 bytes big endian keys
+# (numpy "S16"), which sort in the same order as the 128 bit addresses.
+# The binary search is then a single "searchsorted" call, which can also
+# be applied to a whole list of addresses at once with get_asn_many().
+#
+# Parsing the csv files takes a long time, so the tables can also be
+# compiled in a binary "snapshot" file, see compile_snapshot() and
+# load_tables() at the end of this file.
 
 import sys
 import traceback
 import ipaddress
+import socket
+import os
+import mmap
+import struct
+import numpy as np
 
 class ip2as_line:
     def __init__(self):
@@ -42,12 +58,42 @@ class ip2as_line:
             ret = False
         return(ret)
 
+# Convert an IP address string to the key used in the tables: an int for
+# IPv4 addresses, the 16 bytes of the address for IPv6. inet_pton is much
+# faster than ipaddress, but does not accept some valid forms, such as
+# addresses with a scope id, so we fall back to ipaddress in that case.
+# Returns (0, None) if the string is not a valid address.
+def ip_key(s):
+    try:
+        if ":" in s:
+            return 6, socket.inet_pton(socket.AF_INET6, s)
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, s), "big")
+    except (OSError, TypeError):
+        pass
+    try:
+        addr = ipaddress.ip_address(s)
+        if addr.version == 6:
+            return 6, addr.packed
+        return 4, int(addr)
+    except ValueError:
+        return 0, None
+
 class ip2as_table:
     def __init__(self):
-        self.table = []
+        self.v4_first = np.zeros(0, dtype=np.uint32)
+        self.v4_last = np.zeros(0, dtype=np.uint32)
+        self.v4_as = np.zeros(0, dtype=np.uint32)
+        self.v6_first = np.zeros(0, dtype="S16")
+        self.v6_last = np.zeros(0, dtype="S16")
+        self.v6_as = np.zeros(0, dtype=np.uint32)
+
+    def __len__(self):
+        return len(self.v4_as) + len(self.v6_as)
 
     def load(self,file_name):
         ret = True
+        v4 = [[], [], []]
+        v6 = [[], [], []]
         try:
             first = True
             for line in open(file_name, "rt"):
@@ -57,40 +103,84 @@ class ip2as_table:
                     continue
                 il = ip2as_line()
                 if il.load(l):
-                    self.table.append(il)
+                    if il.ip_first.version == 6:
+                        v = v6
+                        v[0].append(il.ip_first.packed)
+                        v[1].append(il.ip_last.packed)
+                    else:
+                        v = v4
+                        v[0].append(int(il.ip_first))
+                        v[1].append(int(il.ip_last))
+                    v[2].append(il.as_number)
         except Exception as e:
             traceback.print_exc()
             print("When loading <" + file_name + ">: " + str(e))
             ret = False
-        print("Loaded " + str(len(self.table)) + " address ranges from " + file_name)
+        self.set_ranges(v4, v6)
+        print("Loaded " + str(len(self)) + " address ranges from " + file_name)
         return ret
-    
+
+    # Append the ranges to the current arrays, and sort the arrays by
+    # start address. The input is a list of three lists per IP version:
+    # first addresses, last addresses and AS numbers.
+    def set_ranges(self, v4, v6):
+        first = np.concatenate([self.v4_first, np.array(v4[0], dtype=np.uint32)])
+        last = np.concatenate([self.v4_last, np.array(v4[1], dtype=np.uint32)])
+        asn = np.concatenate([self.v4_as, np.array(v4[2], dtype=np.uint32)])
+        order = np.argsort(first, kind="stable")
+        self.v4_first = first[order]
+        self.v4_last = last[order]
+        self.v4_as = asn[order]
+        first = np.concatenate([self.v6_first, np.array(v6[0], dtype="S16")])
+        last = np.concatenate([self.v6_last, np.array(v6[1], dtype="S16")])
+        asn = np.concatenate([self.v6_as, np.array(v6[2], dtype=np.uint32)])
+        order = np.argsort(first, kind="stable")
+        self.v6_first = first[order]
+        self.v6_last = last[order]
+        self.v6_as = asn[order]
+
+    # Find the highest index such that first <= key, then check that the
+    # key is within the range. Works for a single key or an array of keys.
+    def search(first, last, asn, keys):
+        i = np.searchsorted(first, keys, side="right") - 1
+        i_ok = np.maximum(i, 0)
+        return np.where((i >= 0) & (keys <= last[i_ok]), asn[i_ok], 0)
+
     def get_asn(self, s):
         asn = 0
-        i_med = 0
-        i_first = 0
-        i_last = len(self.table) - 1
-        if i_last > 0:
-            try:
-                addr = ipaddress.ip_address(s)
-                if addr >= self.table[i_first].ip_first:
-                    if addr >= self.table[i_last].ip_first:
-                        i_first = i_last
-                    else:
-                        while i_first + 1 < i_last:
-                            i_med = int((i_first + i_last)/2)
-                            if addr >= self.table[i_med].ip_first:
-                                i_first = i_med
-                            else:
-                                i_last = i_med
-                    if addr <= self.table[i_first].ip_last:
-                        asn = self.table[i_first].as_number
-            except Exception as e:
-                traceback.print_exc()
-                print("When evaluation <" + s + "> [" + str(i_first) + ","  + str(i_med) + "," + str(i_last) + "]: " + str(e))
-                pass
+        version, key = ip_key(s)
+        if version == 4 and len(self.v4_as) > 0:
+            asn = int(ip2as_table.search(self.v4_first, self.v4_last, self.v4_as, key))
+        elif version == 6 and len(self.v6_as) > 0:
+            asn = int(ip2as_table.search(self.v6_first, self.v6_last, self.v6_as, np.array(key, dtype="S16")))
         return asn
 
+    # Resolve a whole list of address strings in one pass. Returns a numpy
+    # array of AS numbers, with the value 0 for addresses that are not in
+    # any range or cannot be parsed, as get_asn() does.
+    def get_asn_many(self, ip_list):
+        n = len(ip_list)
+        asns = np.zeros(n, dtype=np.int64)
+        i4 = []
+        k4 = []
+        i6 = []
+        k6 = []
+        for i in range(0, n):
+            version, key = ip_key(ip_list[i])
+            if version == 4:
+                i4.append(i)
+                k4.append(key)
+            elif version == 6:
+                i6.append(i)
+                k6.append(key)
+        if len(i4) > 0 and len(self.v4_as) > 0:
+            keys = np.array(k4, dtype=np.uint32)
+            asns[i4] = ip2as_table.search(self.v4_first, self.v4_last, self.v4_as, keys)
+        if len(i6) > 0 and len(self.v6_as) > 0:
+            keys = np.array(k6, dtype="S16")
+            asns[i6] = ip2as_table.search(self.v6_first, self.v6_last, self.v6_as, keys)
+        return asns
+
 class asname:
     def __init__(self):
         self.table = dict()
@@ -128,4 +218,208 @@ class asname:
         if asn in self.table:
             n = self.table[asn]
             c = n[-2:]
-        return c
\ No newline at end of file
+        return c
+
+# The snapshot contains the IPv4 and IPv6 ranges and the AS names. It
+# starts with a fixed header:
+#    magic: 8 bytes, "ITHIASNB"
+#    version: 32 bits, snapshot_version
+#    reserved: 32 bits
+#    nb_v4, nb_v6, nb_names, pool_size: four 64 bits counts
+# followed by the arrays, each padded to a multiple of 8 bytes:
+#    v4_first, v4_last, v4_as: nb_v4 32 bits values each
+#    v6_first, v6_last: nb_v6 16 bytes addresses each
+#    v6_as: nb_v6 32 bits values
+#    name_as, name_offset, name_length: nb_names 32 bits values each,
+#       sorted by AS number
+#    pool: pool_size bytes, the UTF-8 names, each distinct name once.
+# All integers are little endian. The loader maps the file in memory, so
+# loading is almost instant and the pages are shared between processes.
+
+snapshot_magic = b"ITHIASNB"
+snapshot_version = 1
+snapshot_header = struct.Struct("<8sIIQQQQ")
+snapshot_default_name = "ip2as_tables.bin"
+
+def snapshot_arrays(nb_v4, nb_v6, nb_names, pool_size):
+    return [
+        ("v4_first", "<u4", nb_v4),
+        ("v4_last", "<u4", nb_v4),
+        ("v4_as", "<u4", nb_v4),
+        ("v6_first", "S16", nb_v6),
+        ("v6_last", "S16", nb_v6),
+        ("v6_as", "<u4", nb_v6),
+        ("name_as", "<u4", nb_names),
+        ("name_offset", "<u4", nb_names),
+        ("name_length", "<u4", nb_names),
+        ("pool", "u1", pool_size) ]
+
+def snapshot_padding(length):
+    return (8 - (length % 8)) % 8
+
+# AS name table backed by the snapshot string pool. It behaves like the
+# dict in asname.table for the operations used by asname: "as_id in table"
+# and "table[as_id]", with keys of the form "AS<number>".
+class as_name_pool:
+    def __init__(self, name_as, name_offset, name_length, pool):
+        self.name_as = name_as
+        self.name_offset = name_offset
+        self.name_length = name_length
+        self.pool = pool
+        self.cache = dict()
+
+    def __len__(self):
+        return len(self.name_as)
+
+    def find(self, as_id):
+        if as_id in self.cache:
+            return self.cache[as_id]
+        n = None
+        if isinstance(as_id, str) and as_id.startswith("AS") and as_id[2:].isdigit():
+            asn = int(as_id[2:])
+            i = int(np.searchsorted(self.name_as, asn))
+            if i < len(self.name_as) and self.name_as[i] == asn:
+                offset = int(self.name_offset[i])
+                n = bytes(self.pool[offset:offset + int(self.name_length[i])]).decode("utf-8")
+        self.cache[as_id] = n
+        return n
+
+    def __contains__(self, as_id):
+        return self.find(as_id) is not None
+
+    def __getitem__(self, as_id):
+        n = self.find(as_id)
+        if n is None:
+            raise KeyError(as_id)
+        return n
+
+def compile_snapshot(snapshot_file, ip2a4, ip2a6, as_names):
+    as_list = []
+    for as_id in as_names.table:
+        as_list.append([int(as_id[2:]), as_names.table[as_id]])
+    as_list.sort(key=lambda x: x[0])
+    pool = bytearray()
+    interned = dict()
+    name_as = np.zeros(len(as_list), dtype="<u4")
+    name_offset = np.zeros(len(as_list), dtype="<u4")
+    name_length = np.zeros(len(as_list), dtype="<u4")
+    for i in range(0, len(as_list)):
+        b = as_list[i][1].encode("utf-8")
+        if not b in interned:
+            interned[b] = len(pool)
+            pool += b
+        name_as[i] = as_list[i][0]
+        name_offset[i] = interned[b]
+        name_length[i] = len(b)
+    arrays = {
+        "v4_first": ip2a4.v4_first, "v4_last": ip2a4.v4_last, "v4_as": ip2a4.v4_as,
+        "v6_first": ip2a6.v6_first, "v6_last": ip2a6.v6_last, "v6_as": ip2a6.v6_as,
+        "name_as": name_as, "name_offset": name_offset, "name_length": name_length,
+        "pool": np.frombuffer(bytes(pool), dtype="u1") }
+    # write to a temporary file and rename, so that concurrent processes
+    # never see a partial snapshot.
+    temp_file = snapshot_file + "." + str(os.getpid()) + ".tmp"
+    with open(temp_file, "wb") as F:
+        F.write(snapshot_header.pack(snapshot_magic, snapshot_version, 0, \
+            len(ip2a4.v4_as), len(ip2a6.v6_as), len(as_list), len(pool)))
+        for name, dtype, count in snapshot_arrays(len(ip2a4.v4_as), len(ip2a6.v6_as), len(as_list), len(pool)):
+            b = np.ascontiguousarray(arrays[name], dtype=dtype).tobytes()
+            F.write(b)
+            F.write(bytes(snapshot_padding(len(b))))
+    os.replace(temp_file, snapshot_file)
+    print("Saved " + str(len(ip2a4.v4_as)) + " IPv4 ranges, " + str(len(ip2a6.v6_as)) + " IPv6 ranges and " + \
+        str(len(as_list)) + " AS names to " + snapshot_file)
+
+# load_snapshot returns the IPv4 table, the IPv6 table and the AS names,
+# or None if the file is missing, not a snapshot or has another version.
+def load_snapshot(snapshot_file):
+    try:
+        with open(snapshot_file, "rb") as F:
+            mm = mmap.mmap(F.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(mm) < snapshot_header.size:
+        return None
+    magic, version, reserved, nb_v4, nb_v6, nb_names, pool_size = snapshot_header.unpack_from(mm, 0)
+    if magic != snapshot_magic or version != snapshot_version:
+        print("Ignoring " + snapshot_file + ", not a version " + str(snapshot_version) + " snapshot.")
+        return None
+    arrays = dict()
+    offset = snapshot_header.size
+    for name, dtype, count in snapshot_arrays(nb_v4, nb_v6, nb_names, pool_size):
+        length = count*np.dtype(dtype).itemsize
+        if offset + length > len(mm):
+            print("Ignoring " + snapshot_file + ", file is truncated.")
+            return None
+        arrays[name] = np.frombuffer(mm, dtype=dtype, count=count, offset=offset)
+        offset += length + snapshot_padding(length)
+    ip2a4 = ip2as_table()
+    ip2a4.v4_first = arrays["v4_first"]
+    ip2a4.v4_last = arrays["v4_last"]
+    ip2a4.v4_as = arrays["v4_as"]
+    ip2a6 = ip2as_table()
+    ip2a6.v6_first = arrays["v6_first"]
+    ip2a6.v6_last = arrays["v6_last"]
+    ip2a6.v6_as = arrays["v6_as"]
+    as_names = asname()
+    as_names.table = as_name_pool(arrays["name_as"], arrays["name_offset"], arrays["name_length"], arrays["pool"])
+    return ip2a4, ip2a6, as_names
+
+# default_source_dir returns the "data" directory of the source tree, in
+# which the scripts look for the csv files and the snapshot.
+def default_source_dir():
+    resolver_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(os.path.dirname(resolver_dir), "data")
+
+# load_tables returns the IPv4 table, the IPv6 table and the AS names for
+# the csv files in source_dir. The snapshot is used if it is more recent
+# than all the csv files, otherwise it is rebuilt from the csv files.
+def load_tables(source_dir, snapshot_name=snapshot_default_name):
+    ip2a4_file = os.path.join(source_dir, "ip2as.csv")
+    ip2a6_file = os.path.join(source_dir, "ip2asv6.csv")
+    as_names_file = os.path.join(source_dir, "as_names.csv")
+    snapshot_file = os.path.join(source_dir, snapshot_name)
+    is_fresh = os.path.isfile(snapshot_file)
+    if is_fresh:
+        snapshot_time = os.path.getmtime(snapshot_file)
+        for csv_file in [ ip2a4_file, ip2a6_file, as_names_file ]:
+            if os.path.isfile(csv_file) and os.path.getmtime(csv_file) > snapshot_time:
+                is_fresh = False
+                break
+    if is_fresh:
+        tables = load_snapshot(snapshot_file)
+        if tables is not None:
+            print("Loaded tables from " + snapshot_file)
+            return tables
+    ip2a4 = ip2as_table()
+    is_loaded = ip2a4.load(ip2a4_file)
+    ip2a6 = ip2as_table()
+    is_loaded &= ip2a6.load(ip2a6_file)
+    as_names = asname()
+    as_names.load(as_names_file)
+    if is_loaded:
+        try:
+            compile_snapshot(snapshot_file, ip2a4, ip2a6, as_names)
+        except Exception as e:
+            traceback.print_exc()
+            print("Cannot save snapshot <" + snapshot_file + ">: " + str(e))
+    return ip2a4, ip2a6, as_names
+
+# Compile the snapshot for the csv files in the specified directory:
+#
+# Usage: python ip2as.py <data_directory>
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python ip2as.py <data_directory>")
+        exit(-1)
+    source_dir = sys.argv[1]
+    ip2a4 = ip2as_table()
+    is_loaded = ip2a4.load(os.path.join(source_dir, "ip2as.csv"))
+    ip2a6 = ip2as_table()
+    is_loaded &= ip2a6.load(os.path.join(source_dir, "ip2asv6.csv"))
+    as_names = asname()
+    as_names.load(os.path.join(source_dir, "as_names.csv"))
+    if not is_loaded:
+        exit(-1)
+    compile_snapshot(os.path.join(source_dir, snapshot_default_name), ip2a4, ip2a6, as_names)
+    exit(0)
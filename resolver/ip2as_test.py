@@ -0,0 +1,127 @@
+# IP to AS test.
+# verify that the scalar and batch lookups return the expected AS numbers,
+# and that the tables loaded from a snapshot give the same results.
+
+import os
+import tempfile
+import ip2as
+
+ip2as_test_ranges = [
+    "ip_first, ip_last, as_number,",
+    "1.0.0.0, 1.0.0.255, 13335,",
+    "1.0.4.0, 1.0.7.255, 38803,",
+    "8.8.8.0, 8.8.8.255, 15169,",
+    "184.178.229.0, 184.178.229.255, 22773,",
+    "255.255.255.0, 255.255.255.255, 65535,",
+    "2001:470::, 2001:470:ffff:ffff:ffff:ffff:ffff:ffff, 6939,",
+    "2001:558::, 2001:558:ffff:ffff:ffff:ffff:ffff:ffff, 7922,",
+    "2400:cb00::, 2400:cb00:ffff:ffff:ffff:ffff:ffff:ffff, 13335,",
+    "2a04:e4c0::, 2a04:e4c0:ff:ffff:ffff:ffff:ffff:ffff, 36692,",
+]
+
+ip2as_test_table = [
+    [ "0.0.0.1", 0 ],
+    [ "1.0.0.0", 13335 ],
+    [ "1.0.0.255", 13335 ],
+    [ "1.0.1.0", 0 ],
+    [ "1.0.5.17", 38803 ],
+    [ "8.8.8.8", 15169 ],
+    [ "8.8.9.8", 0 ],
+    [ "184.178.229.12", 22773 ],
+    [ "255.255.255.255", 65535 ],
+    [ "2001:470::1", 6939 ],
+    [ "2001:558:fe13:d:76:96:22:147", 7922 ],
+    [ "2001:559::1", 0 ],
+    [ "2400:cb00:72:1024::a29e:8965", 13335 ],
+    [ "2a04:e4c0:31::2", 36692 ],
+    [ "2a04:e4c0:100::2", 0 ],
+    [ "fe80::1%eth0", 0 ],
+    [ "::ffff:8.8.8.8", 0 ],
+    [ "7.7.a.7", 0 ],
+    [ "1001:1;2;3", 0 ],
+    [ "", 0 ],
+]
+
+as_names_test_lines = [
+    "as_number,as_name,as_country,",
+    "6939,HURRICANE,US,",
+    "7922,COMCAST-7922,US,",
+    "13335,CLOUDFLARENET,US,",
+    "15169,GOOGLE,US,",
+    "36692,OPENDNS,US,",
+    "38803,GTELECOM-AUSTRALIA,AU,",
+]
+
+as_names_test_table = [
+    [ "AS13335", "CLOUDFLARENET", "US" ],
+    [ "AS38803", "GTELECOM-AUSTRALIA", "AU" ],
+    [ "AS12345", "", "ZZ" ],
+    [ "AS", "", "ZZ" ],
+    [ "ASX", "", "ZZ" ],
+]
+
+def check_lookups(table, name):
+    passing = True
+    ip_list = []
+    for test in ip2as_test_table:
+        asn = table.get_asn(test[0])
+        if asn != test[1]:
+            print(name + ".get_asn(" + test[0] + ") returns " + str(asn) + ", expected " + str(test[1]))
+            passing = False
+        ip_list.append(test[0])
+    asns = table.get_asn_many(ip_list)
+    for i in range(0, len(ip_list)):
+        if asns[i] != ip2as_test_table[i][1]:
+            print(name + ".get_asn_many()[" + str(i) + "] (" + ip_list[i] + ") returns " + str(asns[i]) + ", expected " + str(ip2as_test_table[i][1]))
+            passing = False
+    return passing
+
+def check_names(as_names, name):
+    passing = True
+    for test in as_names_test_table:
+        n = as_names.name(test[0])
+        c = as_names.cc(test[0])
+        if n != test[1] or c != test[2]:
+            print(name + "(" + test[0] + ") returns " + n + ", " + c + ", expected " + test[1] + ", " + test[2])
+            passing = False
+    return passing
+
+def write_lines(file_name, lines):
+    with open(file_name, "wt") as F:
+        for line in lines:
+            F.write(line + "\n")
+
+if __name__ == "__main__":
+    passing = True
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ranges_file = os.path.join(temp_dir, "ip2as.csv")
+        write_lines(ranges_file, ip2as_test_ranges)
+        table = ip2as.ip2as_table()
+        if not table.load(ranges_file):
+            print("Cannot load " + ranges_file)
+            passing = False
+        else:
+            passing = check_lookups(table, "csv")
+        # the snapshot test uses separate IPv4 and IPv6 files, as in data/
+        write_lines(os.path.join(temp_dir, "ip2as.csv"), ip2as_test_ranges[:6])
+        write_lines(os.path.join(temp_dir, "ip2asv6.csv"), ip2as_test_ranges[:1] + ip2as_test_ranges[6:])
+        write_lines(os.path.join(temp_dir, "as_names.csv"), as_names_test_lines)
+        if passing:
+            # first call compiles the snapshot, second call maps it.
+            ip2as.load_tables(temp_dir)
+            tables = ip2as.load_snapshot(os.path.join(temp_dir, ip2as.snapshot_default_name))
+            if tables is None:
+                print("Cannot load the snapshot")
+                passing = False
+            else:
+                ip2a4, ip2a6, as_names = tables
+                ip2a4.v6_first = ip2a6.v6_first
+                ip2a4.v6_last = ip2a6.v6_last
+                ip2a4.v6_as = ip2a6.v6_as
+                passing = check_lookups(ip2a4, "snapshot") and check_names(as_names, "snapshot")
+    if not passing:
+        print("Fail.")
+        exit(-1)
+    else:
+        print("Success.")
+        exit(0)
@@ -21,10 +21,13 @@ import traceback
 import top_as
 import time
 import bz2
+import uid_hll
 
 
 def usage():
-    print("Usage: " + sys.argv[0] + " monthly_dir result_dir")
+    print("Usage: " + sys.argv[0] + " [--approximate] monthly_dir result_dir")
+    print("With --approximate, the UIDs per resolver AS and query AS are counted")
+    print("with HyperLogLog sketches, see uid_hll.py for the error bounds.")
 
 def get_totals_by_day(big_df):
     target = [ 'day', 'uids', 'q_uid_tags', 'q_repeats', 'isp', 'public', 'both', 'others', \
@@ -42,12 +45,13 @@ def get_totals_by_day(big_df):
     total_df = pd.DataFrame(t, columns = target)
     return total_df
 
-def parse_resolver_in_file(day, file_name, ip2a4, ip2a6, as_names):
+def parse_resolver_in_file(day, file_name, ip2a4, ip2a6, as_names, approximate=False):
     exp_set = set ([ "0du" ])
     rr_set = set ([ "A", "AAAA", "HTTPS" ])
     open_set = set(['googlepdns', 'cloudflare', \
             'opendns', 'quad9', 'level3', 'neustar', 'he' ])
     r_dict = dict()
+    rsv_cache = rsv_log_parse.resolver_cache()
     for line in open(file_name, "r"):
         parsed = True
         try:
@@ -59,22 +63,21 @@ def parse_resolver_in_file(day, file_name, ip2a4, ip2a6, as_names):
             print("Cannot parse:\n" + line + "\n")
             parsed = False
         if parsed and x.query_experiment in exp_set and x.rr_type in rr_set:
-            x.set_resolver_AS(ip2a4, ip2a6, as_names)
+            x.set_resolver_AS(ip2a4, ip2a6, as_names, rsv_cache=rsv_cache)
             if x.resolver_tag in open_set:
                 logged_AS = x.resolver_tag
             else:
                 logged_AS = x.resolver_AS
             key = day + '-' + logged_AS + '-' + x.query_AS
             if not key in r_dict:
-                r_dict[key] = set()
-            if not x.query_user_id in r_dict[key]:
-                r_dict[key].add(x.query_user_id)
+                r_dict[key] = uid_hll.new_uid_set(approximate)
+            r_dict[key].add(x.query_user_id)
     t = []
     key_list = list(r_dict.keys())
     key_list.sort()
     for key in key_list:
         p = key.split("-")
-        r = [ p[0], p[1], p[2], len(r_dict[key]) ]
+        r = [ p[0], p[1], p[2], r_dict[key].count() ]
         t.append(r)
     as_df = pd.DataFrame(t, columns = [ 'day', 'resolver_AS', 'query_AS', 'hits' ])
     return as_df
@@ -143,20 +146,14 @@ def load_tables():
     auto_source_dir = resolver_dir.parent
     print("Auto source path is: " + str(auto_source_dir) + " (source: " + str(source_path) + ")")
     source_dir = os.path.join(auto_source_dir, "data") 
-    ip2a4_file = os.path.join(source_dir, "ip2as.csv") 
-    ip2a6_file = os.path.join(source_dir, "ip2asv6.csv")
-    as_names_file = os.path.join(source_dir, "as_names.csv")      
-    ip2a4 = ip2as.ip2as_table()
-    ip2a4.load(ip2a4_file)
-    ip2a6 = ip2as.ip2as_table()
-    ip2a6.load(ip2a6_file)
-    as_names = ip2as.asname()
-    as_names.load(as_names_file)
-    return ip2a4, ip2a6, as_names
+    return ip2as.load_tables(source_dir)
 
 # Main program
 if __name__ == "__main__":
     time_start = time.time()
+    approximate = "--approximate" in sys.argv
+    if approximate:
+        sys.argv.remove("--approximate")
     if len(sys.argv) != 3:
         usage()
         exit(-1)
@@ -239,7 +236,7 @@ if __name__ == "__main__":
         for day in days:
             day_src = os.path.join(ir_src, day)
             day_dns_log = os.path.join(day_src, "queries.log")
-            as_day_df = parse_resolver_in_file(day, day_dns_log, ip2a4, ip2a6, as_names)
+            as_day_df = parse_resolver_in_file(day, day_dns_log, ip2a4, ip2a6, as_names, approximate=approximate)
             as_df_list.append(as_day_df)
             print("Found " + str(as_day_df.shape[0]) + " AS keys in " +  day_dns_log)
         big_as_df = pd.concat(as_df_list)
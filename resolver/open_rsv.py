@@ -1246,101 +1246,66 @@ def table_print(rsvs_ips, f_name):
              F.write("    [ipaddress.ip_network(\"" + str(n6[0]) + "\"),\"" + n6[1] + "\"],\n")
         F.write("]\n")
 
+# Longest prefix match index for the tables of open resolver prefixes.
+# The tables are compiled once, at import time. For each IP version, we keep
+# one dict per prefix length, mapping the prefix value (the address shifted
+# right by the number of host bits) to the name of the service, and the list
+# of prefix lengths present in the table, longest first. A lookup tries each
+# length in turn, so nested or overlapping prefixes resolve to the most
+# specific one.
+class prefix_index:
+    def __init__(self, table, bits):
+        self.bits = bits
+        self.prefixes = dict()
+        for net_range in table:
+            net = net_range[0]
+            if not net.prefixlen in self.prefixes:
+                self.prefixes[net.prefixlen] = dict()
+            prefix = int(net.network_address) >> (bits - net.prefixlen)
+            if not prefix in self.prefixes[net.prefixlen]:
+                self.prefixes[net.prefixlen][prefix] = net_range[1]
+        self.lengths = sorted(self.prefixes.keys(), reverse=True)
+
+    def lookup(self, addr_int):
+        for length in self.lengths:
+            prefix = addr_int >> (self.bits - length)
+            if prefix in self.prefixes[length]:
+                return self.prefixes[length][prefix]
+        return ""
+
+as_index = dict()
+for as_entry in as_table:
+    if not as_entry[0] in as_index:
+        as_index[as_entry[0]] = as_entry[1]
+n4_index = prefix_index(n4_table, 32)
+n6_index = prefix_index(n6_table, 128)
+
 # get_open_rsv: return the name of the open resolver service that matches
 # the resolver IP address or the resolver AS, or "" if no match
 def get_open_rsv_from_AS(key):
-    x_low = 0
-    x_high = len(as_table) - 1
-    found = ""
-    r_low = as_table[0]
-    if r_low[0] == key:
-        #print("R_low[" + str(x_low) + "] matches " + key)
-        found = r_low[1]
-    elif r_low[0] < key:
-        #print("R_low[" + str(x_low) + "] < " + key)
-        r_high = as_table[x_high]
-        if r_high[0] == key:
-            #print("R_high[" + str(x_high) + "] matches " + key)
-            found = r_high[1]
-        elif r_high[0] > key:
-            #print("R_high[" + str(x_high) + "] > " + key)
-            while x_low != x_high:
-                x_mid = int((x_low + x_high) / 2)
-                if x_mid == x_low:
-                    #print("x_mid:" + str(x_high) + " = x_low:" + str(x_low))
-                    break
-                else:
-                    r_mid = as_table[x_mid]
-                    if r_mid[0] == key:
-                        #print("R_mid[" + str(x_mid) + "] matches " + key)
-                        found = r_mid[1]
-                        break
-                    elif r_mid[0] > key:
-                        #print("R_mid[" + str(x_mid) + "] > " + key)
-                        x_high = x_mid
-                    else:
-                        #print("R_mid[" + str(x_mid) + "] < " + key)
-                        x_low = x_mid
-        else:
-            #print("R_high[" + str(x_high) + "] < " + key + ", exit.")
-            pass
-
-    #print("Exit x_low: " + str(x_low) + ", x_high: " + str(x_high))
-    return found
+    if key in as_index:
+        return as_index[key]
+    return ""
 
 def get_open_rsv_from_IP(resolver_IP):
-    found = ""
     try:
         key = ipaddress.ip_address(resolver_IP)
     except:
         return ""
     if key.version == 4:
-        table = n4_table
-    else:
-        table = n6_table
-    
-    x_low = 0
-    x_high = len(table) - 1
-    r_low = table[0]
-    if key in r_low[0]:
-        found = r_low[1]
-        #print("R_low[0] " + str(r_low[0]) + " contains " + resolver_IP)
-    elif r_low[0].network_address < key:
-        r_high = table[x_high]
-        if key in r_high[0]:
-            #print("R_high[0] " + str(r_high[0]) + " contains " + resolver_IP)
-            found = r_high[1]
-        elif r_high[0].network_address > key:
-            #print("r_high[" + str(x_high) + ": " + str(r_high[0]) + " > " + resolver_IP)
-            while x_low != x_high:
-                x_mid = int((x_low + x_high) / 2)
-                if x_mid == x_low:
-                    #print("x_mid: " + str(x_mid) + " == x_low: " + str(x_low))
-                    break
-                else:
-                    r_mid = table[x_mid]
-                    #print("r_mid[" + str(x_mid) + "] = " + str(r_mid[0]))
-                    if key in r_mid[0]:
-                        #print("r_mid[" + str(x_mid) + "] " + str(r_high[0].network_address) + " contains " + resolver_IP)
-                        found = r_mid[1]
-                        break
-                    elif r_mid[0].network_address > key:
-                        #print("r_mid[" + str(x_mid) + "] " + str(r_mid[0].network_address) + " > " + resolver_IP)
-                        x_high = x_mid
-                        #r_high = table[x_high]
-                        #print("r_high[" + str(x_high) + "] = " + str(r_high[0]))
-                    else:
-                        #print("r_mid[" + str(x_mid) + "] " + str(r_mid[0].network_address) + " < " + resolver_IP)
-                        x_low = x_mid   
-                        #r_low = table[x_low] 
-                        #print("r_low[" + str(x_low) + "] = " + str(r_low[0]))
-        else:
-            #print("r_high[0] " + str(r_high[0].network_address) + " < " + resolver_IP)
-            pass
-    else:
-        #print(str(r_low[0].network_address) + " > " + resolver_IP)
-        pass
-    return found
+        return n4_index.lookup(int(key))
+    return n6_index.lookup(int(key))
+
+# batch version of get_open_rsv_from_IP, returns one name per address in
+# the list. Each distinct address is only parsed and looked up once.
+def get_open_rsv_from_IP_many(ip_list):
+    found = dict()
+    r = []
+    for resolver_IP in ip_list:
+        if not resolver_IP in found:
+            found[resolver_IP] = get_open_rsv_from_IP(resolver_IP)
+        r.append(found[resolver_IP])
+    return r
 
 def get_open_rsv(resolver_IP, resolver_AS):
     found = get_open_rsv_from_AS(resolver_AS)
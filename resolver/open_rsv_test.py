@@ -1,4 +1,5 @@
 import sys
+import ipaddress
 import open_rsv
 
 open_rsv_test_table = [
@@ -86,6 +87,27 @@ else:
                 rsv_ip = open_rsv.get_open_rsv_from_IP(test[0])
                 print("get_open_rsv_from_IP("  + test[0] + ") returns \"" + rsv_ip + "\", expected \"" + test[2] + "\"")
             break
+    if passing:
+        # the batch lookup shall match the scalar lookup
+        ip_list = [ test[0] for test in open_rsv_test_table ]
+        rsv_list = open_rsv.get_open_rsv_from_IP_many(ip_list)
+        for i in range(0, len(ip_list)):
+            rsv_ip = open_rsv.get_open_rsv_from_IP(ip_list[i])
+            if rsv_list[i] != rsv_ip:
+                print("get_open_rsv_from_IP_many()[" + str(i) + "] returns \"" + rsv_list[i] + "\", expected \"" + rsv_ip + "\"")
+                passing = False
+                break
+    if passing:
+        # nested prefixes shall resolve to the longest match
+        nested = open_rsv.prefix_index([
+            [ipaddress.ip_network("10.0.0.0/8"),"outer"],
+            [ipaddress.ip_network("10.1.0.0/16"),"inner"],
+            [ipaddress.ip_network("10.1.2.0/24"),"innermost"]], 32)
+        for test in [ ["10.2.0.1", "outer"], ["10.1.3.1", "inner"], ["10.1.2.1", "innermost"], ["11.0.0.1", ""] ]:
+            rsv_ip = nested.lookup(int(ipaddress.ip_address(test[0])))
+            if rsv_ip != test[1]:
+                print("nested lookup(" + test[0] + ") returns \"" + rsv_ip + "\", expected \"" + test[1] + "\"")
+                passing = False
     if not passing:
         print("Fail.")
         exit(-1)
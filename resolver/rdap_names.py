@@ -9,8 +9,15 @@
 
 import json
 import urllib.request
+import urllib.error
 import time
+import os
+import csv
+import threading
+import concurrent.futures
+import traceback
 import top_as
+import ip2as
 
 def filter_bgp_name(bgp_name):
     if bgp_name[-6:].startswith(" -- "):
@@ -48,57 +55,336 @@ def crack_json_fn(data):
     return success, as_name
 
 
+# name_from_rdap returns the AS name found in the RDAP data. If the data
+# has no usable name, use the Top AS name, the name in the JSON vcard, or
+# the BGP name, in that order.
+def name_from_rdap(data, asn, bgp_name):
+    as_name = ""
+    success = False
+    if 'name' in data:
+        t_name = data['name']
+        if t_name == asn or t_name == asn[2:] or t_name == ("ASN" + asn[2:]) or t_name.endswith("AFRINIC"):
+            print("Found " + asn + ", name was " + t_name + ". Need to look again.")
+        else:
+            as_name = t_name
+            success = True
+    else:
+        print("No name property for " + asn + ". Need to look again")
+    if (not success):
+        if asn in top_as.TopAS:
+            x = top_as.TopAS[asn]
+            print("Using Top AS name: ", x[0])
+            as_name = x[0]
+            success = True
+        else:
+            success,j_name =  crack_json_fn(data)
+            if success:
+                print("Cracked name from JSON: " + j_name)
+                as_name = j_name
+            else:
+                as_name = filter_bgp_name(bgp_name)
+                if len(as_name) == 0:
+                    as_name = asn
+                    print("No bgp name either, using: " + as_name)
+                else:
+                    print("Use BGP name: " + as_name)
+                success = True
+    return success, as_name
+
+def urllib_transport(url, timeout=30):
+    with urllib.request.urlopen(url, timeout=timeout) as F:
+        return json.load(F)
+
 def get_as_name(rdap_url, asn, bgp_name):
     as_name = ""
     success = False
     if asn.startswith("AS"):
         as_url = rdap_url + asn[2:]
         try:
-            with urllib.request.urlopen(as_url) as url:
-                data = json.load(url)
-                print("loaded data from " + as_url)
-                if 'name' in data:
-                    t_name = data['name']
-                    if t_name == asn or t_name == asn[2:] or t_name == ("ASN" + asn[2:]) or t_name.endswith("AFRINIC"):
-                        print("Found " + asn + ", name was " + t_name + ". Need to look again.")
-                    else:
-                        as_name = t_name
-                        success = True
-                else:
-                    print("No name property for " + asn + ". Need to look again")
-                if (not success):
-                    if asn in top_as.TopAS:
-                        x = top_as.TopAS[asn]
-                        print("Using Top AS name: ", x[0])
-                        as_name = x[0]
-                        success = True
-                    else:
-                        success,j_name =  crack_json_fn(data)
-                        if success:
-                            print("Cracked name from JSON: " + j_name)
-                            as_name = j_name
-                        else:
-                            as_name = filter_bgp_name(bgp_name)
-                            if len(as_name) == 0:
-                                as_name = asn
-                                print("No bgp name either, using: " + as_name)
-                            else:
-                                print("Use BGP name: " + as_name)
-                            success = True
+            data = urllib_transport(as_url)
+            print("loaded data from " + as_url)
+            success, as_name = name_from_rdap(data, asn, bgp_name)
         except Exception as exc:
             print("Fail: " + as_url + ": " + str(exc))
     return success, as_name
 
+# The queries for regions other than Europe and Asia Pacific are sent to
+# ARIN, which redirects them to the registry of the AS.
+rdap_region_urls = {
+    'EUR': "https://rdap.db.ripe.net/autnum/",
+    'AP': "https://rdap.apnic.net/autnum/",
+    '': "https://rdap.arin.net/registry/autnum/" }
+
+def region_url(region, rdap_urls=rdap_region_urls):
+    if region in rdap_urls:
+        return rdap_urls[region]
+    return rdap_urls['']
+
 def get_as_name_by_region(region, asn, as_name):
-    if region == 'EUR':
-        rdap_url = "https://rdap.db.ripe.net/autnum/"
-    elif region == 'AP':
-        rdap_url = "https://rdap.apnic.net/autnum/"
-    else:
-        rdap_url = "https://rdap.arin.net/registry/autnum/"
+    rdap_url = region_url(region)
 
     success, as_name = get_as_name(rdap_url, asn, as_name)
     print(asn + ": " + as_name + ", " + str(success))
     time.sleep(1)
     return success, as_name
 
+# Cache of the AS names.
+#
+# The entries are kept in a csv file, with the AS number, the name,
+# whether the name was found, and the time at which it was fetched. The
+# names expire after "ttl" seconds. If RDAP does not know the AS (error
+# 404), a negative entry is kept for "negative_ttl" seconds, so that the
+# same AS is not queried again in every run. The cache can also be warmed
+# with names from other sources, such as as_names.csv and top_as.TopAS:
+# these "static" entries do not expire, and are not saved in the file.
+
+class rdap_cache_entry:
+    def __init__(self, as_name, found, fetched, source):
+        self.as_name = as_name
+        self.found = found
+        self.fetched = fetched
+        self.source = source
+
+class rdap_cache:
+    def __init__(self, file_name="", ttl=30*86400, negative_ttl=86400, clock=time.time):
+        self.file_name = file_name
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.entries = dict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if len(file_name) > 0 and os.path.isfile(file_name):
+            self.load()
+
+    def load(self):
+        with open(self.file_name, newline='') as F:
+            for row in csv.reader(F):
+                if len(row) < 4 or row[0] == 'asn':
+                    continue
+                try:
+                    self.entries[row[0]] = rdap_cache_entry(row[1], row[2] == 'True', float(row[3]), 'rdap')
+                except ValueError:
+                    print("Bad cache line: " + ','.join(row))
+
+    # The file is written in a temporary file and then renamed, so that
+    # an interrupted run does not truncate the cache.
+    def save(self):
+        if len(self.file_name) == 0:
+            return
+        temp_file = self.file_name + ".tmp"
+        with self.lock:
+            with open(temp_file, "wt", newline='') as F:
+                w = csv.writer(F)
+                w.writerow([ 'asn', 'as_name', 'found', 'fetched' ])
+                for asn in self.entries:
+                    entry = self.entries[asn]
+                    if entry.source == 'rdap':
+                        w.writerow([ asn, entry.as_name, str(entry.found), str(entry.fetched) ])
+        os.replace(temp_file, self.file_name)
+
+    # get returns the entry for the AS, or None if there is no entry or if
+    # the entry expired.
+    def get(self, asn):
+        with self.lock:
+            entry = None
+            if asn in self.entries:
+                entry = self.entries[asn]
+                if entry.source == 'rdap':
+                    if entry.found:
+                        ttl = self.ttl
+                    else:
+                        ttl = self.negative_ttl
+                    if self.clock() - entry.fetched > ttl:
+                        entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, asn, as_name, found, source='rdap'):
+        with self.lock:
+            self.entries[asn] = rdap_cache_entry(as_name, found, self.clock(), source)
+
+    # warm adds static entries for a list of (asn, as_name), except for the
+    # AS that already have an entry. Returns the number of entries added.
+    def warm(self, names):
+        nb_added = 0
+        with self.lock:
+            for asn, as_name in names:
+                if not asn in self.entries and len(as_name) > 0:
+                    self.entries[asn] = rdap_cache_entry(as_name, True, 0, 'static')
+                    nb_added += 1
+        return nb_added
+
+    # warm_defaults adds the names of the top AS. The names in as_names.csv
+    # come from BGP and are not cached: they are only used by the fetcher
+    # when RDAP does not provide a name, see rdap_fetcher.load_bgp_names.
+    def warm_defaults(self):
+        names = []
+        for asn in top_as.TopAS:
+            names.append([ asn, top_as.TopAS[asn][0] ])
+        nb_added = self.warm(names)
+        print("Warmed the RDAP cache with " + str(nb_added) + " names.")
+        return nb_added
+
+    def stats(self):
+        return "RDAP cache: " + str(len(self.entries)) + " entries, " + str(self.hits) + " hits, " + str(self.misses) + " misses."
+
+# Rate limits.
+#
+# The registries limit the rate of queries, LACNIC after a single query.
+# Each registry has a token bucket: a query takes a token, and the tokens are
+# refilled at "rate" per second, up to "burst". The clock and sleep
+# functions can be replaced for tests.
+
+class token_bucket:
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            self.sleep(wait)
+
+# Concurrent fetcher.
+#
+# The fetcher looks up the names in the cache, and queries RDAP for the
+# others, with at most max_workers queries in parallel and one token bucket
+# per RDAP server URL, so that the regions served by the same registry
+# share the same rate. Errors 429 and 5xx, and network errors, are retried after
+# backoff*2^n seconds, or after the delay in the Retry-After header if
+# longer. The transport is a function that takes an URL and returns the
+# JSON data, or raises urllib.error.HTTPError. Tests can use a stub transport,
+# or point rdap_urls to a local server.
+
+class rdap_fetcher:
+    def __init__(self, cache, transport=urllib_transport, rdap_urls=rdap_region_urls, max_workers=4, \
+        rate=1.0, burst=1, max_retries=3, backoff=2.0, clock=time.monotonic, sleep=time.sleep):
+        self.cache = cache
+        self.transport = transport
+        self.rdap_urls = rdap_urls
+        self.max_workers = max_workers
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.buckets = dict()
+        self.bgp_names = dict()
+        self.lock = threading.Lock()
+        self.nb_queries = 0
+        self.nb_retries = 0
+        self.nb_failed = 0
+
+    def bucket(self, rdap_url):
+        with self.lock:
+            if not rdap_url in self.buckets:
+                self.buckets[rdap_url] = token_bucket(self.rate, burst=self.burst, clock=self.clock, sleep=self.sleep)
+            return self.buckets[rdap_url]
+
+    # load_bgp_names loads the names in as_names.csv. They are used as the
+    # BGP name of the AS when the caller does not provide one.
+    def load_bgp_names(self, as_names_file):
+        as_names = ip2as.asname()
+        as_names.load(as_names_file)
+        for asn in as_names.table:
+            self.bgp_names[asn] = as_names.name(asn)
+        print("Loaded " + str(len(self.bgp_names)) + " BGP names.")
+
+    # fetch queries RDAP for one AS, and updates the cache, except if the
+    # query failed after all retries.
+    def fetch(self, region, asn, bgp_name):
+        if len(bgp_name) == 0 and asn in self.bgp_names:
+            bgp_name = self.bgp_names[asn]
+        rdap_url = region_url(region, self.rdap_urls)
+        as_url = rdap_url + asn[2:]
+        for attempt in range(0, self.max_retries + 1):
+            self.bucket(rdap_url).acquire()
+            delay = self.backoff*(2**attempt)
+            with self.lock:
+                self.nb_queries += 1
+            try:
+                data = self.transport(as_url)
+                success, as_name = name_from_rdap(data, asn, bgp_name)
+                self.cache.put(asn, as_name, success)
+                return success, as_name
+            except urllib.error.HTTPError as exc:
+                if exc.code == 404:
+                    print("Not found: " + as_url)
+                    self.cache.put(asn, "", False)
+                    return False, ""
+                if exc.code != 429 and exc.code < 500:
+                    print("Fail: " + as_url + ": " + str(exc))
+                    break
+                retry_after = exc.headers.get("Retry-After") if exc.headers is not None else None
+                if retry_after is not None and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            except (urllib.error.URLError, OSError) as exc:
+                print("Retry: " + as_url + ": " + str(exc))
+            except Exception as exc:
+                traceback.print_exc()
+                print("Fail: " + as_url + ": " + str(exc))
+                break
+            if attempt < self.max_retries:
+                with self.lock:
+                    self.nb_retries += 1
+                self.sleep(delay)
+        with self.lock:
+            self.nb_failed += 1
+        return False, ""
+
+    # get_name has the same arguments and results as get_as_name_by_region.
+    def get_name(self, region, asn, as_name):
+        if not asn.startswith("AS"):
+            return False, ""
+        entry = self.cache.get(asn)
+        if entry is not None:
+            return entry.found, entry.as_name
+        return self.fetch(region, asn, as_name)
+
+    # get_names takes a list of [ region, asn, as_name ] and returns a
+    # dictionary of the results of get_name per AS.
+    def get_names(self, requests):
+        results = dict()
+        missing = []
+        for region, asn, as_name in requests:
+            if asn in results:
+                continue
+            entry = None
+            if asn.startswith("AS"):
+                entry = self.cache.get(asn)
+            if entry is not None:
+                results[asn] = [ entry.found, entry.as_name ]
+            elif not asn.startswith("AS"):
+                results[asn] = [ False, "" ]
+            else:
+                results[asn] = None
+                missing.append([ region, asn, as_name ])
+        if len(missing) > 0:
+            with concurrent.futures.ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+                futures = []
+                for region, asn, as_name in missing:
+                    futures.append([ asn, executor.submit(self.fetch, region, asn, as_name) ])
+                for asn, future in futures:
+                    results[asn] = list(future.result())
+        return results
+
+    def stats(self):
+        return "RDAP fetcher: " + str(self.nb_queries) + " queries, " + str(self.nb_retries) + " retries, " + str(self.nb_failed) + " failed."
@@ -0,0 +1,177 @@
+# RDAP names test.
+# verify that the fetcher gets the names from a local stub RDAP server,
+# retries after errors 429, caches the names and the missing AS, and that
+# the cache file and the token buckets work as expected, that the regions
+# served by the same registry share a bucket, and that the
+# names in as_names.csv are only used when RDAP has no name.
+
+import os
+import json
+import tempfile
+import threading
+import http.server
+import rdap_names
+
+stub_names = {
+    "64496": "EXAMPLE-NET-1",
+    "64497": "EXAMPLE-NET-2",
+    "64498": "EXAMPLE-NET-3",
+    "64502": "64502",
+}
+
+class stub_handler(http.server.BaseHTTPRequestHandler):
+    nb_requests = dict()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        asn = self.path.split("/")[-1]
+        with stub_handler.lock:
+            if not asn in stub_handler.nb_requests:
+                stub_handler.nb_requests[asn] = 0
+            stub_handler.nb_requests[asn] += 1
+            nb = stub_handler.nb_requests[asn]
+        if asn == "64498" and nb == 1:
+            # rate limited on the first query
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+        elif asn in stub_names:
+            body = json.dumps({ "handle": "AS" + asn, "name": stub_names[asn] }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/rdap+json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class fake_clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+
+def fetcher_test(base_url, cache_file):
+    passing = True
+    clock = fake_clock()
+    cache = rdap_names.rdap_cache(cache_file, ttl=3600, negative_ttl=60, clock=clock.time)
+    cache.warm([ [ "AS64499", "STATIC-NAME" ] ])
+    urls = { '': base_url + "/arin/", 'EUR': base_url + "/ripe/", 'AP': base_url + "/apnic/" }
+    fetcher = rdap_names.rdap_fetcher(cache, rdap_urls=urls, rate=1000.0, burst=10, backoff=0.001)
+    requests = [ [ 'EUR', "AS64496", "" ], [ 'AP', "AS64497", "" ], [ 'LAC', "AS64498", "" ], \
+        [ 'EUR', "AS64499", "" ], [ 'EUR', "AS64500", "" ], [ 'EUR', "AS64496", "" ] ]
+    results = fetcher.get_names(requests)
+    expected = { "AS64496": [ True, "EXAMPLE-NET-1" ], "AS64497": [ True, "EXAMPLE-NET-2" ], \
+        "AS64498": [ True, "EXAMPLE-NET-3" ], "AS64499": [ True, "STATIC-NAME" ], "AS64500": [ False, "" ] }
+    if results != expected:
+        print("get_names returns " + str(results) + ", expected " + str(expected))
+        passing = False
+    if stub_handler.nb_requests.get("64498", 0) != 2 or stub_handler.nb_requests.get("64496", 0) != 1:
+        print("Unexpected requests: " + str(stub_handler.nb_requests))
+        passing = False
+    # the names and the missing AS are now in the cache
+    success, as_name = fetcher.get_name('EUR', "AS64500", "")
+    if success or stub_handler.nb_requests.get("64500", 0) != 1:
+        print("The missing AS was not cached: " + str(stub_handler.nb_requests))
+        passing = False
+    cache.save()
+    # after reloading, the static name is gone, the negative entry expires
+    # before the names.
+    clock.now += 120
+    cache = rdap_names.rdap_cache(cache_file, ttl=3600, negative_ttl=60, clock=clock.time)
+    if cache.get("AS64499") is not None or cache.get("AS64500") is not None:
+        print("Static or expired entries found after reload.")
+        passing = False
+    entry = cache.get("AS64497")
+    if entry is None or entry.as_name != "EXAMPLE-NET-2":
+        print("Name not found after reload.")
+        passing = False
+    clock.now += 3600
+    if cache.get("AS64497") is not None:
+        print("Entry did not expire.")
+        passing = False
+    return passing
+
+# the names in as_names.csv are not cache hits: RDAP is still queried, and
+# the BGP name is only used if RDAP has no name for the AS.
+def bgp_names_test(base_url, as_names_file):
+    passing = True
+    with open(as_names_file, "wt") as F:
+        F.write("as_number,as_name,country\n")
+        F.write("64496,CSV-NAME-1,US\n")
+        F.write("64502,CSV-NAME-6,FR\n")
+    cache = rdap_names.rdap_cache("")
+    cache.warm_defaults()
+    urls = { '': base_url + "/arin/", 'EUR': base_url + "/ripe/" }
+    fetcher = rdap_names.rdap_fetcher(cache, rdap_urls=urls, rate=1000.0, burst=10, backoff=0.001)
+    fetcher.load_bgp_names(as_names_file)
+    nb_before = stub_handler.nb_requests.get("64496", 0)
+    results = fetcher.get_names([ [ 'EUR', "AS64496", "" ], [ 'EUR', "AS64502", "" ] ])
+    expected = { "AS64496": [ True, "EXAMPLE-NET-1" ], "AS64502": [ True, "CSV-NAME-6" ] }
+    if results != expected:
+        print("get_names with BGP names returns " + str(results) + ", expected " + str(expected))
+        passing = False
+    if stub_handler.nb_requests.get("64496", 0) != nb_before + 1 or stub_handler.nb_requests.get("64502", 0) != 1:
+        print("RDAP not queried for the AS in as_names.csv: " + str(stub_handler.nb_requests))
+        passing = False
+    return passing
+
+def bucket_test():
+    # with 2 queries per second and a burst of 2, the fifth query has to
+    # wait 1.5 seconds.
+    clock = fake_clock()
+    bucket = rdap_names.token_bucket(2.0, burst=2, clock=clock.time, sleep=clock.sleep)
+    for i in range(0, 5):
+        bucket.acquire()
+    if abs(clock.now - 1001.5) > 0.000001:
+        print("Token bucket waited until " + str(clock.now) + ", expected 1001.5")
+        return False
+    return True
+
+# NAM, LAC and AF are all sent to the ARIN URL, and share its bucket: at
+# one query per second, the third of these queries waits 2 seconds. The
+# query to RIPE does not wait.
+def shared_bucket_test():
+    clock = fake_clock()
+    urls = []
+    def stub_transport(url):
+        urls.append(url)
+        return { "name": "NET-" + url.split("/")[-1] }
+    cache = rdap_names.rdap_cache("", clock=clock.time)
+    fetcher = rdap_names.rdap_fetcher(cache, transport=stub_transport, max_workers=1, \
+        rate=1.0, burst=1, clock=clock.time, sleep=clock.sleep)
+    fetcher.get_names([ [ 'NAM', "AS64510", "" ], [ 'LAC', "AS64511", "" ], \
+        [ 'AF', "AS64512", "" ], [ 'EUR', "AS64513", "" ] ])
+    if len(urls) != 4 or len(fetcher.buckets) != 2:
+        print("Expected 4 queries and 2 buckets, got " + str(urls) + ", " + str(list(fetcher.buckets.keys())))
+        return False
+    if abs(clock.now - 1002.0) > 0.000001:
+        print("Shared bucket waited until " + str(clock.now) + ", expected 1002.0")
+        return False
+    return True
+
+if __name__ == "__main__":
+    passing = bucket_test()
+    passing &= shared_bucket_test()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), stub_handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_url = "http://127.0.0.1:" + str(server.server_address[1])
+        passing &= fetcher_test(base_url, os.path.join(temp_dir, "rdap_cache.csv"))
+        passing &= bgp_names_test(base_url, os.path.join(temp_dir, "as_names.csv"))
+    server.shutdown()
+    if not passing:
+        print("Fail.")
+        exit(-1)
+    else:
+        print("Success.")
+        exit(0)
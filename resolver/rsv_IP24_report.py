@@ -15,6 +15,7 @@ import time
 import csv
 import random
 import ipaddress
+import uid_hll
 
 class IP_nb_bucket:
     def __init__(self):
@@ -36,32 +37,35 @@ class IP_nb_bucket:
         self.nb_open += bucket.nb_open
         self.nb_both += bucket.nb_both
 
+# The UIDs are kept in exact sets by default. With approximate=True,
+# they are counted with HyperLogLog sketches, see uid_hll.py for the
+# error bounds. nb_both is then estimated from the union.
 class CC_AS_IP_data:
-    def __init__(self):
-        self.others = set()
-        self.open = set()
+    def __init__(self, approximate=False):
+        self.others = uid_hll.new_uid_set(approximate)
+        self.open = uid_hll.new_uid_set(approximate)
 
     def add_uid(self, uid, resolver_tag):
         if resolver_tag in rsv_log_parse.tag_public_set:
-            if not uid in self.open:
-                self.open.add(uid)
-        elif not uid in self.others:
+            self.open.add(uid)
+        else:
             self.others.add(uid)
 
     def summary(self):
-        total_set = self.others.union(self.open)
-        both_set = self.others.intersection(self.open)
-        return len(total_set), len(self.others), len(self.open), len(both_set)
+        nb_total = self.others.union_count(self.open)
+        nb_both = self.others.intersection_count(self.open)
+        return nb_total, self.others.count(), self.open.count(), nb_both
 
 class CC_AS_data:
-    def __init__(self):
+    def __init__(self, approximate=False):
         self.ips = dict()
         self.buckets = dict()
         self.total = 0
+        self.approximate = approximate
 
     def add_ip_uid(self, IP, uid, resolver_tag):
         if not IP in self.ips:
-            self.ips[IP] = CC_AS_IP_data()
+            self.ips[IP] = CC_AS_IP_data(approximate=self.approximate)
         self.ips[IP].add_uid(uid, resolver_tag)
 
     def summary(self):
@@ -86,19 +90,20 @@ class CC_AS_data:
         return t
        
 class CC_data:
-    def __init__(self):
+    def __init__(self, approximate=False):
         self.cc_as = dict()
         self.buckets = dict()
         self.total = 0
+        self.approximate = approximate
 
     def add_asn_IP_uid(self, asn, IP, uid, resolver_tag):
         if not asn in self.cc_as:
-            self.cc_as[asn] = CC_AS_data()
+            self.cc_as[asn] = CC_AS_data(approximate=self.approximate)
         self.cc_as[asn].add_ip_uid(IP, uid, resolver_tag)
 
     def add_cc_as(self, cc_as):
         if not cc_as in self.cc_as:
-            self.cc_as[cc_as] = CC_AS_data()
+            self.cc_as[cc_as] = CC_AS_data(approximate=self.approximate)
 
     def summary(self):
         for asn in self.cc_as:
@@ -127,14 +132,15 @@ class CC_data:
 
 
 class IP_log_all:
-    def __init__(self):
+    def __init__(self, approximate=False):
         self.ccs = dict()
         self.buckets = dict()
         self.total = 0
+        self.approximate = approximate
 
     def add_query(self, cc, asn, IP, uid, resolver_tag):
         if not cc in self.ccs:
-            self.ccs[cc] = CC_data()
+            self.ccs[cc] = CC_data(approximate=self.approximate)
         self.ccs[cc].add_asn_IP_uid(asn, IP, uid, resolver_tag)
 
     def load_IP_log(self, saved_file):
@@ -203,9 +209,11 @@ class IP_log_all:
         return t
 
 def usage():
-    print("Usage: python rsv_IP_report.py  <output_dir>  <csv_file> ... <csv_file>\n")
+    print("Usage: python rsv_IP_report.py [--approximate] <output_dir>  <csv_file> ... <csv_file>\n")
     print("This script will load the csv files,")
     print("and create an IP list for the specified ASns.")
+    print("With --approximate, the UIDs are counted with HyperLogLog sketches")
+    print("instead of exact sets, see uid_hll.py for the error bounds.")
 
 # main
 
@@ -216,10 +224,17 @@ if __name__ == "__main__":
         exit(-1)
 
     # parse the arguments
-    output_dir = sys.argv[1]
-    csv_files = sys.argv[2:]
+    args = sys.argv[1:]
+    approximate = "--approximate" in args
+    if approximate:
+        args.remove("--approximate")
+    if len(args) < 2:
+        usage()
+        exit(-1)
+    output_dir = args[0]
+    csv_files = args[1:]
 
-    log_IP = IP_log_all()
+    log_IP = IP_log_all(approximate=approximate)
     for csv_file in csv_files:
         log_IP.load_IP_log(csv_file)
         print("Loaded: " + csv_file)
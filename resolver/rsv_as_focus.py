@@ -180,63 +180,37 @@ class detailed_log:
         #return df.shape[0]
 
         nb_events = 0
-        with open(saved_file, newline='') as csvfile:
-            rsv_reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            is_first = True
-            is_second = True
-            header_row = [ 'query_time', 'resolver_tag', 'query_cc', 'query_AS', 'query_user_id', 'resolver_IP', 'resolver_AS', 'rr_type', 'query_IP' ]
-            header_index = [ -1, -1, -1, -1, -1,  -1,  -1, -1, -1 ]
-
-            for row in rsv_reader:
-                if is_first:
-                    # print(",".join(row))
-                    for i in range(0, len(header_row)):
-                        for x in range(0, len(row)):
-                            if row[x] == header_row[i]:
-                            #   print("row[" + str(x) + "](" + str(row[x]) + ") == " + header_row[i])
-                                header_index[i] = x
-                                break
-                            #else:
-                            #    print(row[x] + " != " + header_row[i])
-                        if header_index[i] < 0:
-                            print("Could not find " + header_row[i] + " in " + ','.join(row))
-                            exit(-1)
-                    is_first = False
-                else:
-                    if (is_second):
-                        #print(",".join(row))
-                        #for i in range(0, len(header_row)):
-                        #    print(str(i) + ": x[" + header_row[i] + "] = " + str(row[header_index[i]]))
-                        is_second = False
-                    query_time = float(row[header_index[0]])
-                    resolver_tag = row[header_index[1]]
-                    #if not resolver_tag in self.tag_check:
-                    #    print("Unexpected tag: " + resolver_tag + " in:\n" + ",".join(row))
-                    #    exit(-1)
-                    query_cc = row[header_index[2]]
-                    query_AS = row[header_index[3]]
-                    key = query_cc + query_AS
-                    uid = row[header_index[4]]
-                    resolver_IP = row[header_index[5]]
-                    resolver_AS = row[header_index[6]]
-                    rr_type = row[header_index[7]]
-                    query_IP = row[header_index[8]]
-                    net_string = str( ipaddress.ip_network(query_IP + "/24", strict=False))
-                    key_plus_net = key + "_" + net_string
-                    if query_AS in self.as_set:
-                        if not key in self.cc_ases:
-                            self.cc_ases[key] = detail_cc_as_net(key)
-                        if not key_plus_net in self.cc_ases:
-                            self.cc_ases[key_plus_net] = detail_cc_as_net(key_plus_net)
-                        self.add_query(key, rr_type, resolver_tag, uid, query_time, resolver_IP, resolver_AS)
-                        self.add_query(key_plus_net, rr_type, resolver_tag, uid, query_time, resolver_IP, resolver_AS)
-                        nb_events += 1
-                        # track AS0 for potential issues
-                        if resolver_AS == 'AS0':
-                            if not resolver_IP in self.as0_IP:
-                                self.as0_IP[resolver_IP] = 1
-                            else:
-                                self.as0_IP[resolver_IP] += 1
+        header_row = [ 'query_time', 'resolver_tag', 'query_cc', 'query_AS', 'query_user_id', 'resolver_IP', 'resolver_AS', 'rr_type', 'query_IP' ]
+        for row in rsv_log_parse.load_event_rows(saved_file, header_row):
+            query_time = float(row[0])
+            resolver_tag = row[1]
+            #if not resolver_tag in self.tag_check:
+            #    print("Unexpected tag: " + resolver_tag + " in:\n" + ",".join(row))
+            #    exit(-1)
+            query_cc = row[2]
+            query_AS = row[3]
+            key = query_cc + query_AS
+            uid = row[4]
+            resolver_IP = row[5]
+            resolver_AS = row[6]
+            rr_type = row[7]
+            query_IP = row[8]
+            net_string = str( ipaddress.ip_network(query_IP + "/24", strict=False))
+            key_plus_net = key + "_" + net_string
+            if query_AS in self.as_set:
+                if not key in self.cc_ases:
+                    self.cc_ases[key] = detail_cc_as_net(key)
+                if not key_plus_net in self.cc_ases:
+                    self.cc_ases[key_plus_net] = detail_cc_as_net(key_plus_net)
+                self.add_query(key, rr_type, resolver_tag, uid, query_time, resolver_IP, resolver_AS)
+                self.add_query(key_plus_net, rr_type, resolver_tag, uid, query_time, resolver_IP, resolver_AS)
+                nb_events += 1
+                # track AS0 for potential issues
+                if resolver_AS == 'AS0':
+                    if not resolver_IP in self.as0_IP:
+                        self.as0_IP[resolver_IP] = 1
+                    else:
+                        self.as0_IP[resolver_IP] += 1
         return nb_events
 
     # create an AS0 report
@@ -0,0 +1,111 @@
+#
+# Checkpoints of the per day aggregates.
+#
+# The monthly runs of the second pass and of the metrics load one first
+# pass file per day. The checkpoint store keeps, in a directory, the state
+# computed from each file (the "day" checkpoints), and the state computed
+# from the whole list of files of the last run (the "total" checkpoint).
+#
+# Each checkpoint is saved with the signature of its input files: the
+# absolute path, the size and the modification time. A day checkpoint is
+# only used if its file did not change. The total checkpoint is used if
+# its list of files is the start of the current list: if one day was added
+# to the list, only that day is loaded and merged. If a file in the middle
+# of the list changed, the total is rebuilt from the day checkpoints of the
+# other files, which is much faster than parsing them again.
+#
+# The states are saved with pickle, first in a temporary file which is
+# then renamed, so that an interrupted run does not leave a partial
+# checkpoint. The checkpoints are only meant to be read by the same
+# version of the scripts, on the same machine: the format includes a
+# version number, and a checkpoint with another version is ignored.
+
+import os
+import hashlib
+import pickle
+import traceback
+
+checkpoint_version = 1
+
+def file_signature(file_name):
+    st = os.stat(file_name)
+    return [ os.path.abspath(file_name), st.st_size, st.st_mtime_ns ]
+
+class checkpoint_store:
+    # The kind ("second_pass", "metrics") separates the states of different
+    # scripts in the same directory. The options are the arguments that
+    # change the total state, for example the list of ASes of the metrics.
+    def __init__(self, checkpoint_dir, kind, options=""):
+        self.checkpoint_dir = checkpoint_dir
+        self.kind = kind
+        self.options = options
+        self.nb_loaded = 0
+        self.nb_saved = 0
+
+    def path(self, name):
+        h = hashlib.sha256(name.encode("utf-8")).hexdigest()[:24]
+        return os.path.join(self.checkpoint_dir, self.kind + "_" + h + ".pkl")
+
+    def load(self, checkpoint_file):
+        if not os.path.isfile(checkpoint_file):
+            return None, None
+        try:
+            with open(checkpoint_file, "rb") as F:
+                version, signature, state = pickle.load(F)
+            if version != checkpoint_version:
+                return None, None
+            return signature, state
+        except Exception as exc:
+            traceback.print_exc()
+            print("Cannot load checkpoint " + checkpoint_file + ": " + str(exc))
+            return None, None
+
+    def save(self, checkpoint_file, signature, state):
+        temp_file = checkpoint_file + ".tmp" + str(os.getpid())
+        with open(temp_file, "wb") as F:
+            pickle.dump((checkpoint_version, signature, state), F, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, checkpoint_file)
+        self.nb_saved += 1
+
+    def day_file(self, file_name):
+        return self.path("day " + os.path.abspath(file_name))
+
+    # load_day returns the state saved for the file, or None if there is no
+    # checkpoint or if the file changed since it was saved.
+    def load_day(self, file_name):
+        signature, state = self.load(self.day_file(file_name))
+        if state is None or signature != file_signature(file_name):
+            return None
+        self.nb_loaded += 1
+        return state
+
+    def save_day(self, file_name, state):
+        self.save(self.day_file(file_name), file_signature(file_name), state)
+
+    def total_file(self):
+        return self.path("total " + self.options)
+
+    # load_total returns the total state and the number of files of the
+    # list that it covers, or (None, 0) if the saved total does not match
+    # the start of the list.
+    def load_total(self, file_names):
+        signature, state = self.load(self.total_file())
+        if state is None:
+            return None, 0
+        options, signatures = signature
+        if options != self.options or len(signatures) > len(file_names):
+            return None, 0
+        for i in range(0, len(signatures)):
+            if signatures[i] != file_signature(file_names[i]):
+                return None, 0
+        self.nb_loaded += 1
+        return state, len(signatures)
+
+    def save_total(self, file_names, state):
+        signatures = []
+        for file_name in file_names:
+            signatures.append(file_signature(file_name))
+        self.save(self.total_file(), [ self.options, signatures ], state)
+
+    def stats(self):
+        return "Checkpoints in " + self.checkpoint_dir + ": " + str(self.nb_loaded) + " loaded, " + str(self.nb_saved) + " saved."
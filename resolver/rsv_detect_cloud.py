@@ -28,7 +28,6 @@ import time
 import pandas as pd
 import bz2
 import top_as
-import csv
 
 class cc_as_total:
     def __init__(self, query_cc, query_AS, AS_name="", has_name=False):
@@ -179,46 +178,24 @@ class resolver_list:
     def load_csv_log(self, csv_file):
         nb_events = 0
         open_rsv_set = set (['googlepdns', 'cloudflare', 'opendns', 'quad9', 'level3', 'neustar', 'he' ])
-        with open(csv_file, newline='') as csvfile:
-            rsv_reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            is_first = True
-            is_second = True
-            header_row = ['resolver_AS', 'query_cc', 'query_AS', 'resolver_tag' ]
-            header_index = [-1, -1, -1, -1]
-
-            for row in rsv_reader:
-                if is_first:
-                    # print(",".join(row))
-                    for i in range(0, len(header_row)):
-                        for x in range(0, len(row)):
-                            if row[x] == header_row[i]:
-                            #   print("row[" + str(x) + "](" + str(row[x]) + ") == " + header_row[i])
-                                header_index[i] = x
-                                break
-                            #else:
-                            #    print(row[x] + " != " + header_row[i])
-                        if header_index[i] < 0:
-                            print("Could not find " + header_row[i] + " in " + ','.join(row))
-                            exit(-1)
-                    is_first = False
-                else:
-                    if (is_second):
-                        resolver_AS = row[header_index[0]]
-                        query_cc = row[header_index[1]]
-                        query_AS = row[header_index[2]]
-                        resolver_tag = row[header_index[3]]
-                        
-                        if not isinstance(query_cc, str) or len(query_cc) > 2:
-                            query_cc = 'ZZ'
-
-                        if resolver_AS != 'AS0' and (not resolver_AS == query_AS) and (not resolver_tag in open_rsv_set):
-                            if not resolver_AS in self.resolvers:
-                                self.resolvers[resolver_AS] = resolver(resolver_AS)
-                            self.resolvers[resolver_AS].load_row(query_cc, query_AS, 1)
-
-                            self.sum_total += 1
-                    nb_events += 1
-            return nb_events
+        header_row = ['resolver_AS', 'query_cc', 'query_AS', 'resolver_tag' ]
+        for row in rsv_log_parse.load_event_rows(csv_file, header_row):
+            resolver_AS = row[0]
+            query_cc = row[1]
+            query_AS = row[2]
+            resolver_tag = row[3]
+            
+            if not isinstance(query_cc, str) or len(query_cc) > 2:
+                query_cc = 'ZZ'
+
+            if resolver_AS != 'AS0' and (not resolver_AS == query_AS) and (not resolver_tag in open_rsv_set):
+                if not resolver_AS in self.resolvers:
+                    self.resolvers[resolver_AS] = resolver(resolver_AS)
+                self.resolvers[resolver_AS].load_row(query_cc, query_AS, 1)
+
+                self.sum_total += 1
+            nb_events += 1
+        return nb_events
 
     def export_df(self, as_names):
         r = []
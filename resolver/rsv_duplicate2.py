@@ -39,7 +39,6 @@ import pandas as pd
 import traceback
 import top_as
 import time
-import csv
 import random
 
 # New classes
@@ -233,49 +232,22 @@ class detailed_log:
 
     def load_csv_log(self, saved_file):
         nb_events = 0
-        with open(saved_file, newline='') as csvfile:
-            rsv_reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            is_first = True
-            is_second = True
-            header_row = [ 'resolver_tag', 'query_cc', 'query_AS', 'query_user_id', 'rr_type' ]
-            header_index = [ -1, -1, -1, -1, -1 ]
-
-            for row in rsv_reader:
-                if is_first:
-                    # print(",".join(row))
-                    for i in range(0, len(header_row)):
-                        for x in range(0, len(row)):
-                            if row[x] == header_row[i]:
-                            #   print("row[" + str(x) + "](" + str(row[x]) + ") == " + header_row[i])
-                                header_index[i] = x
-                                break
-                            #else:
-                            #    print(row[x] + " != " + header_row[i])
-                        if header_index[i] < 0:
-                            print("Could not find " + header_row[i] + " in " + ','.join(row))
-                            exit(-1)
-                    is_first = False
-                else:
-                    if (is_second):
-                        #print(",".join(row))
-                        #for i in range(0, len(header_row)):
-                        #    print(str(i) + ": x[" + header_row[i] + "] = " + str(row[header_index[i]]))
-                        is_second = False
-
-                    resolver_tag = row[header_index[0]]
-                    #if not resolver_tag in self.tag_check:
-                    #    print("Unexpected tag: " + resolver_tag + " in:\n" + ",".join(row))
-                    #    exit(-1)
-                    query_cc = row[header_index[1]]
-                    query_AS = row[header_index[2]]
-                    uid = row[header_index[3]]
-                    rr_type = row[header_index[4]]
-                    #if not rr_type in self.rr_check:
-                    #    print("Unexpected rr: " + rr_type + " in:\n" + ",".join(row))
-                    #    exit(-1)
-                    if rr_type in self.rr_set:
-                        self.add_query(query_cc, query_AS, rr_type, resolver_tag, uid)
-                    nb_events += 1
+        header_row = [ 'resolver_tag', 'query_cc', 'query_AS', 'query_user_id', 'rr_type' ]
+        for row in rsv_log_parse.load_event_rows(saved_file, header_row):
+            resolver_tag = row[0]
+            #if not resolver_tag in self.tag_check:
+            #    print("Unexpected tag: " + resolver_tag + " in:\n" + ",".join(row))
+            #    exit(-1)
+            query_cc = row[1]
+            query_AS = row[2]
+            uid = row[3]
+            rr_type = row[4]
+            #if not rr_type in self.rr_check:
+            #    print("Unexpected rr: " + rr_type + " in:\n" + ",".join(row))
+            #    exit(-1)
+            if rr_type in self.rr_set:
+                self.add_query(query_cc, query_AS, rr_type, resolver_tag, uid)
+            nb_events += 1
         return nb_events
 
     # create a report of duplicates, with 1 line per As per rrtype, and a summary line.
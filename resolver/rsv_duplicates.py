@@ -144,6 +144,27 @@ class detail_cc_as:
             class_tag = 'isp'
         if not class_tag in self.uids[uid]:
             self.uids[uid].add(class_tag)
+            # return True when the uid becomes a duplicate
+            return len(self.uids[uid]) == 2
+        return False
+
+# Reservoir sampling: keep a uniform random sample of "size" items out of
+# a stream of items, without keeping the whole stream in memory.
+class reservoir_sample:
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.items = []
+        self.nb_seen = 0
+
+    def add(self, item):
+        self.nb_seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            j = self.rng.randrange(self.nb_seen)
+            if j < self.size:
+                self.items[j] = item
 
 class detailed_log:
     def __init__(self, as_list):
@@ -153,6 +174,26 @@ class detailed_log:
         self.tag_check = set(rsv_log_parse.tag_list)
         #self.rr_check = set(['A', 'AAAA', 'HTTPS'])
         self.as0_IP = dict()
+        self.rng = random.Random()
+        self.seed = None
+        self.sample = None
+        self.forced_samples = dict()
+        self.sampling = None
+
+    # set_sampling prepares the reservoirs used by get_random_queries:
+    # one for the UIDs with duplicates in the forced keys, with
+    # n_per_forced_key entries, and one for the other keys, with n_rand
+    # entries. It should be called before loading the logs: each UID is
+    # added to the reservoir when it becomes a duplicate. The seed is kept,
+    # so that get_random_queries can sample again with the same seed.
+    def set_sampling(self, n_rand, forced_keys, n_per_forced_key, seed=None):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.sampling = [ n_rand, list(forced_keys), n_per_forced_key ]
+        self.sample = reservoir_sample(n_rand, self.rng)
+        self.forced_samples = dict()
+        for key in forced_keys:
+            self.forced_samples[key] = reservoir_sample(n_per_forced_key, self.rng)
 
     def add_query(self, key, rr_type, resolver_tag, uid, query_time, resolver_IP, resolver_AS):
         #if not rr_type in self.rr_check:
@@ -162,7 +203,12 @@ class detailed_log:
         #    print("Unexpected tag: " + resolver_tag + " in:\n" + ",".join(row))
         #    exit(-1)
         if key in self.cc_ases:
-           self.cc_ases[key].add_query(rr_type, resolver_tag, uid, query_time, resolver_IP, resolver_AS)
+            if self.cc_ases[key].add_query(rr_type, resolver_tag, uid, query_time, resolver_IP, resolver_AS) and \
+                self.sample is not None:
+                if key in self.forced_samples:
+                    self.forced_samples[key].add([key, uid])
+                else:
+                    self.sample.add([key, uid])
 
     def load_csv_log(self, saved_file):
         #df = pd.read_csv(saved_file)
@@ -170,57 +216,31 @@ class detailed_log:
         #return df.shape[0]
 
         nb_events = 0
-        with open(saved_file, newline='') as csvfile:
-            rsv_reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            is_first = True
-            is_second = True
-            header_row = [ 'query_time', 'resolver_tag', 'query_cc', 'query_AS', 'query_user_id', 'resolver_IP', 'resolver_AS', 'rr_type' ]
-            header_index = [ -1, -1, -1, -1, -1,  -1,  -1, -1 ]
-
-            for row in rsv_reader:
-                if is_first:
-                    # print(",".join(row))
-                    for i in range(0, len(header_row)):
-                        for x in range(0, len(row)):
-                            if row[x] == header_row[i]:
-                            #   print("row[" + str(x) + "](" + str(row[x]) + ") == " + header_row[i])
-                                header_index[i] = x
-                                break
-                            #else:
-                            #    print(row[x] + " != " + header_row[i])
-                        if header_index[i] < 0:
-                            print("Could not find " + header_row[i] + " in " + ','.join(row))
-                            exit(-1)
-                    is_first = False
+        header_row = [ 'query_time', 'resolver_tag', 'query_cc', 'query_AS', 'query_user_id', 'resolver_IP', 'resolver_AS', 'rr_type' ]
+        for row in rsv_log_parse.load_event_rows(saved_file, header_row):
+            query_time = float(row[0])
+            resolver_tag = row[1]
+            #if not resolver_tag in self.tag_check:
+            #    print("Unexpected tag: " + resolver_tag + " in:\n" + ",".join(row))
+            #    exit(-1)
+            query_cc = row[2]
+            query_AS = row[3]
+            key = query_cc + query_AS
+            uid = row[4]
+            resolver_IP = row[5]
+            resolver_AS = row[6]
+            rr_type = row[7]
+            #if not rr_type in self.rr_check:
+            #    print("Unexpected rr: " + rr_type + " in:\n" + ",".join(row))
+            #    exit(-1)
+            self.add_query(key, rr_type, resolver_tag, uid, query_time, resolver_IP, resolver_AS)
+            nb_events += 1
+            # track AS0 for potential issues
+            if resolver_AS == 'AS0':
+                if not resolver_IP in self.as0_IP:
+                    self.as0_IP[resolver_IP] = 1
                 else:
-                    if (is_second):
-                        #print(",".join(row))
-                        #for i in range(0, len(header_row)):
-                        #    print(str(i) + ": x[" + header_row[i] + "] = " + str(row[header_index[i]]))
-                        is_second = False
-                    query_time = float(row[header_index[0]])
-                    resolver_tag = row[header_index[1]]
-                    #if not resolver_tag in self.tag_check:
-                    #    print("Unexpected tag: " + resolver_tag + " in:\n" + ",".join(row))
-                    #    exit(-1)
-                    query_cc = row[header_index[2]]
-                    query_AS = row[header_index[3]]
-                    key = query_cc + query_AS
-                    uid = row[header_index[4]]
-                    resolver_IP = row[header_index[5]]
-                    resolver_AS = row[header_index[6]]
-                    rr_type = row[header_index[7]]
-                    #if not rr_type in self.rr_check:
-                    #    print("Unexpected rr: " + rr_type + " in:\n" + ",".join(row))
-                    #    exit(-1)
-                    self.add_query(key, rr_type, resolver_tag, uid, query_time, resolver_IP, resolver_AS)
-                    nb_events += 1
-                    # track AS0 for potential issues
-                    if resolver_AS == 'AS0':
-                        if not resolver_IP in self.as0_IP:
-                            self.as0_IP[resolver_IP] = 1
-                        else:
-                            self.as0_IP[resolver_IP] += 1
+                    self.as0_IP[resolver_IP] += 1
         return nb_events
 
     # create an AS0 report
@@ -312,27 +332,24 @@ class detailed_log:
         queries.sort(key=lambda x: x[3])
         return queries
 
+    # The random UIDs are taken from the reservoirs filled while loading
+    # the logs. If set_sampling was not called before loading, or was
+    # called with other parameters, the reservoirs are filled now with
+    # one pass over the loaded UIDs.
     def get_random_queries(self, n_rand, forced_keys, n_per_forced_key):
-        select_keys = set(forced_keys)
-        uid_list = []
-        selected_list = []
-        # first, accumulate a global dict of keys and sample N out of it
-        for key in self.cc_ases:
-            if not key in select_keys:          
+        if self.sampling != [ n_rand, list(forced_keys), n_per_forced_key ]:
+            self.set_sampling(n_rand, forced_keys, n_per_forced_key, seed=self.seed)
+            for key in self.cc_ases:
                 for uid in self.cc_ases[key].uids:
                     if len(self.cc_ases[key].uids[uid]) > 1:
-                        uid_list.append([key,uid])
-        selected_list = random.sample(uid_list, n_rand)
+                        if key in self.forced_samples:
+                            self.forced_samples[key].add([key, uid])
+                        else:
+                            self.sample.add([key, uid])
+        selected_list = list(self.sample.items)
         # add random uids picked from the forced keys
         for key in forced_keys:
-            forced_dup_uid = []
-            for uid in self.cc_ases[key].uids:
-                if len(self.cc_ases[key].uids[uid]) > 1:
-                    forced_dup_uid.append([key, uid])
-            if len(forced_dup_uid) > n_per_forced_key:
-                selected_list += random.sample(forced_dup_uid, n_per_forced_key)
-            else:
-                selected_list += forced_dup_uid
+            selected_list += self.forced_samples[key].items
         # build a table with all uids for the selected list
         t = []
         for key_uid in selected_list:
@@ -341,9 +358,10 @@ class detailed_log:
         return df
 
 def usage():
-    print("Usage: python rsv_duplicates.py <output_dir> <csv_file> ... <csv_file>\n")
+    print("Usage: python rsv_duplicates.py [--seed N] <output_dir> <csv_file> ... <csv_file>\n")
     print("This script will load the csv files,")
     print("and create a detailed report of CC/AS with most duplicates.")
+    print("With --seed N, the sample of queries is reproducible.")
 
 # main
 
@@ -353,8 +371,20 @@ if __name__ == "__main__":
         usage()
         exit(-1)
 
-    output_dir = sys.argv[1]
-    csv_files = sys.argv[2:]
+    args = sys.argv[1:]
+    seed = None
+    if "--seed" in args:
+        i = args.index("--seed")
+        if i + 1 >= len(args) or not args[i+1].isdigit():
+            usage()
+            exit(-1)
+        seed = int(args[i+1])
+        args = args[:i] + args[i+2:]
+    if len(args) < 2:
+        usage()
+        exit(-1)
+    output_dir = args[0]
+    csv_files = args[1:]
 
     # first, load the summary file.
 
@@ -379,6 +409,7 @@ if __name__ == "__main__":
 
     # load the high duplicate AS from csv files
     dup_logs = detailed_log(as_dups)
+    dup_logs.set_sampling(50, forced_keys, 5, seed=seed)
     for csv_file in csv_files:
         dup_logs.load_csv_log(csv_file)
         print("Loaded: " + csv_file)
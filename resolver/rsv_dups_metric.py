@@ -17,11 +17,11 @@ from pathlib import Path
 import ip2as
 import rsv_log_parse
 import pandas as pd
+import numpy as np
 import traceback
 import top_as
 import time
 import calendar
-import csv
 import rsv_arguments
 
 def usage():
@@ -30,6 +30,7 @@ def usage():
     print("   <output_dir>/duplicate_metrics.csv: table of duplicate usage per 1 hour interval.")
     print("   <output_dir>/duplicate_ASnnnn.csv: table of duplicate usage by 5 minute interval for ASnnnn.")
     print("   <output_dir>/duplicate_as_list.csv: table of duplicate usage per AS.")
+    print("Input files ending with .bz2 or .log are parsed directly as raw logs.")
 
 
 def get_time_hour(first_time):
@@ -98,6 +99,22 @@ class duplicate_slices:
                     self.slices[slice_time].dups[i] += 1
         return True
 
+    # add_arrays adds all the events at once, using the arrays returned
+    # by duplicate_queries.get_arrays()
+    def add_arrays(self, arrays):
+        slice_list, counts, sums = rsv_log_parse.slice_sums(arrays['query_time'], self.first_time, self.slice_duration, \
+            [ arrays['total'][:,0], arrays['total'][:,1], arrays['total'][:,2], \
+              arrays['dups'][:,0], arrays['dups'][:,1], arrays['dups'][:,2] ], \
+            query_ASes=arrays['query_AS'], query_AS=self.query_AS)
+        for k in range(0, len(slice_list)):
+            slice_time = slice_list[k]
+            if not slice_time in self.slices:
+                self.slices[slice_time] = duplicate_slice()
+            for i in range(0, 3):
+                self.slices[slice_time].total[i] += sums[i][k]
+                self.slices[slice_time].dups[i] += sums[3+i][k]
+        return sum(counts)
+
     def get_df(self):
         v = []
         st = list(self.slices.keys())
@@ -181,50 +198,64 @@ class duplicate_queries:
     # load the input files
     def load_csv_log(self, saved_file):
         nb_events = 0
-        with open(saved_file, newline='') as csvfile:
-            rsv_reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            is_first = True
-            is_second = True
-            header_row = [ 'query_time', 'query_AS', 'query_user_id', 'resolver_tag', 'resolver_AS', 'rr_type', 'query_cc' ]
-            header_index = [ -1, -1, -1, -1, -1, -1, -1 ]
-
-            for row in rsv_reader:
-                if is_first:
-                    # print(",".join(row))
-                    for i in range(0, len(header_row)):
-                        for x in range(0, len(row)):
-                            if row[x] == header_row[i]:
-                            #   print("row[" + str(x) + "](" + str(row[x]) + ") == " + header_row[i])
-                                header_index[i] = x
-                                break
-                            #else:
-                            #    print(row[x] + " != " + header_row[i])
-                        if header_index[i] < 0:
-                            print("Could not find " + header_row[i] + " in " + ','.join(row))
-                            exit(-1)
-                    is_first = False
-                else:
-                    if (is_second):
-                        #print(",".join(row))
-                        #for i in range(0, len(header_row)):
-                        #    print(str(i) + ": x[" + header_row[i] + "] = " + str(row[header_index[i]]))
-                        is_second = False
-                    query_time = float(row[header_index[0]])
-                    query_AS = row[header_index[1]]
-                    uid = row[header_index[2]]
-                    resolver_tag = row[header_index[3]]
-                    resolver_AS = row[header_index[4]]
-                    rr_type = row[header_index[5]]
-                    query_cc = row[header_index[6]]
-                    self.add_query(uid, query_time, query_AS, query_cc, rr_type, resolver_tag, resolver_AS)
-                    nb_events += 1
+        header_row = [ 'query_time', 'query_AS', 'query_user_id', 'resolver_tag', 'resolver_AS', 'rr_type', 'query_cc' ]
+        for row in rsv_log_parse.load_event_rows(saved_file, header_row):
+            query_time = float(row[0])
+            query_AS = row[1]
+            uid = row[2]
+            resolver_tag = row[3]
+            resolver_AS = row[4]
+            rr_type = row[5]
+            query_cc = row[6]
+            self.add_query(uid, query_time, query_AS, query_cc, rr_type, resolver_tag, resolver_AS)
+            nb_events += 1
 
         return nb_events
 
-    def add_slices(self, slice_list):
+    # load the events parsed from a raw log, see rsv_log_parse.log_events
+    def load_log_events(self, events):
+        nb_events = 0
+        for x in events:
+            self.add_query(x.query_user_id, x.query_time, x.query_AS, x.query_cc, x.rr_type, x.resolver_tag, x.resolver_AS)
+            nb_events += 1
+        return nb_events
+
+    # get_arrays returns the query times, the query ASes, and for each
+    # record type whether the UID has a record and whether it is duplicate,
+    # as numpy arrays with one line per UID.
+    def get_arrays(self):
+        nb_uids = len(self.uid_list)
+        arrays = dict()
+        arrays['query_time'] = np.zeros(nb_uids)
+        arrays['query_AS'] = np.empty(nb_uids, dtype=object)
+        arrays['total'] = np.zeros((nb_uids, 3), dtype=np.int64)
+        arrays['dups'] = np.zeros((nb_uids, 3), dtype=np.int64)
+        k = 0
+        for uid in self.uid_list:
+            event = self.uid_list[uid]
+            arrays['query_time'][k] = event.query_time
+            arrays['query_AS'][k] = event.query_AS
+            for i in range(0, 3):
+                if event.records[i] != "":
+                    arrays['total'][k,i] = 1
+                    if event.records[i] == "*":
+                        arrays['dups'][k,i] = 1
+            k += 1
+        return arrays
+
+    # The time slices are computed with numpy (see add_arrays), the other
+    # accumulators are called for each UID.
+    def add_slices(self, slice_list, arrays=None):
         nb_events = 0
         nb_processed = 0
 
+        if isinstance(slice_list, duplicate_slices):
+            if arrays is None:
+                arrays = self.get_arrays()
+            nb_processed = slice_list.add_arrays(arrays)
+            print("Processed " + str(nb_processed) + " out of " + str(len(self.uid_list)) + " events.")
+            return
+
         for uid in self.uid_list:
             event = self.uid_list[uid]
             nb_events += 1
@@ -233,6 +264,45 @@ class duplicate_queries:
 
         print("Processed " + str(nb_processed) + " out of " + str(nb_events) + " events.")
 
+# The duplicate metric groups the accumulators of this script: one hour
+# slices for all ASes, the list of CC+AS, and 5 minute slices for each
+# AS in the list. It is also used by rsv_metrics.py, which computes
+# several metrics in a single pass over the input files.
+class duplicate_metric:
+    def __init__(self, as_list):
+        self.first_time = 0
+        self.acc_list = [ duplicate_slices(3600, "") , duplicate_AS_list() ]
+        for query_AS in as_list:
+            self.acc_list.append(duplicate_slices(300, query_AS))
+
+    # the start of the slices is the hour of the first query in the
+    # first file.
+    def get_first_time(self, queries):
+        return queries.dups_first_time
+
+    def set_first_time(self, first_time):
+        self.first_time = first_time
+        for dups in self.acc_list:
+            dups.first_time = first_time
+
+    def save(self, output_dir):
+        metric_df = self.acc_list[0].get_df()
+        metric_file = os.path.join(output_dir, "duplicate_metric.csv" )
+        metric_df.to_csv(metric_file, sep=",")
+        print("Saved: " + str(metric_df.shape[0]) + " time slices in " + metric_file)
+
+        as_df = self.acc_list[1].get_df()
+        as_file = os.path.join(output_dir, "duplicate_as_list.csv" )
+        as_df.to_csv(as_file, sep=",")
+        print("Saved: " + str(as_df.shape[0]) + " AS in " + as_file)
+
+        for asn_dup in self.acc_list[2:]:
+            asn = asn_dup.query_AS
+            asn_file = os.path.join(output_dir, "duplicate_" + asn + ".csv" )
+            asn_df = asn_dup.get_df()
+            asn_df.to_csv(asn_file, sep=",")
+            print("Saved: " + str(asn_df.shape[0]) + " time slices in " + asn_file)
+
 # Main program
 if __name__ == "__main__":
     time_start = time.time()
@@ -246,45 +316,27 @@ if __name__ == "__main__":
         usage()
         exit(-1)
     as_list = rsv_arguments.parse_AS_list(sys.argv[2:])
-    csv_files, has_error = rsv_arguments.parse_file_list(sys.argv[2 + len(as_list):], [ ".csv"])
+    csv_files, has_error = rsv_arguments.parse_file_list(sys.argv[2 + len(as_list):], [ ".csv", rsv_log_parse.columnar_suffix ] + rsv_log_parse.raw_log_suffixes)
     if has_error:
         print("Invalid list of input files.")
         usage()
         exit(-1)
 
-
-    dups_list = [ duplicate_slices(3600, "") , duplicate_AS_list() ]
-    for query_AS in as_list:
-        dups_list.append(duplicate_slices(300, query_AS))
-
-    first_time = 0
+    metric = duplicate_metric(as_list)
+    tables = None
     for csv_file in csv_files:
         dq = duplicate_queries()
-        nb_events = dq.load_csv_log(csv_file)
+        if rsv_log_parse.is_raw_log(csv_file):
+            if tables is None:
+                tables = ip2as.load_tables(ip2as.default_source_dir())
+            nb_events = dq.load_log_events(rsv_log_parse.first_pass_events(csv_file, tables))
+        else:
+            nb_events = dq.load_csv_log(csv_file)
         print(csv_file + ": " + str(nb_events) + " events, " + str(len(dq.uid_list)) + " unique ids.")
-        if first_time == 0:
-            first_time = dq.first_time
-            for dups in dups_list:
-                dups.first_time = first_time
-        for dups in dups_list:
-            dq.add_slices(dups)
-
-    metric_df = dups_list[0].get_df()
-    metric_file = os.path.join(output_dir, "duplicate_metric.csv" )
-    metric_df.to_csv(metric_file, sep=",")
-    print("Saved: " + str(metric_df.shape[0]) + " time slices in " + metric_file)
-
-    as_df = dups_list[1].get_df()
-    as_file = os.path.join(output_dir, "duplicate_as_list.csv" )
-    as_df.to_csv(as_file, sep=",")
-    print("Saved: " + str(as_df.shape[0]) + " AS in " + as_file)
-
-    for asn_dup in dups_list[2:]:
-        asn = asn_dup.query_AS
-        asn_file = os.path.join(output_dir, "duplicate_" + asn + ".csv" )
-        asn_df = asn_dup.get_df()
-        asn_df.to_csv(asn_file, sep=",")
-        print("Saved: " + str(asn_df.shape[0]) + " time slices in " + asn_file)
-
-
+        if metric.first_time == 0:
+            metric.set_first_time(dq.first_time)
+        arrays = dq.get_arrays()
+        for dups in metric.acc_list:
+            dq.add_slices(dups, arrays=arrays)
 
+    metric.save(output_dir)
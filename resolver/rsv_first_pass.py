@@ -2,7 +2,7 @@
 #
 # Load an APNIC trace and store the filtered and parsed version in a csv file
 # 
-# Usage: python rsv_as_study.py <csv_file> <log_file> <ASxxxx> <source_directory>
+# Usage: python rsv_first_pass.py [--workers N] <csv_file> <log_file>* <ASxxxx>*
 
 import sys
 import os
@@ -11,56 +11,159 @@ import ip2as
 import rsv_log_parse
 #import rsv_both_graphs
 import pandas as pd
-import traceback
 import top_as
 import time
-import bz2
+import collections
+import concurrent.futures
 
 def usage():
-    print("Usage: python rsv_first_pass.py <csv_file> <log_file> <ASxxxx>\n")
-    print("This script will parse the log file, extract data for the specified ASes,")
+    print("Usage: python rsv_first_pass.py [--workers N] <csv_file> <log_file>* <ASxxxx>\n")
+    print("This script will parse the log files, extract data for the specified ASes,")
     print("and save the parsed data in the csv file.")
+    print("If the csv_file name ends with .parquet, the data is saved in Parquet format.")
     print("If no AS is specified, retains all ASes with more than 1000 UIDs.")
+    print("With --workers N, the logs are parsed by N processes.")
 
-def get_log_as_df(log_file, ip2a4, ip2a6, as_table, rr_types=[], experiment=[], query_ASes=[], log_threshold = 15625, time_start=0):
+# parse_log_line returns the row for one line of the log, or None if the
+# line cannot be parsed or does not pass the filter.
+def parse_log_line(line, ip2a4, ip2a6, as_table, filtering, rr_types, experiment, q_set, rsv_cache=None):
+    x = rsv_log_parse.parse_log_event(line, ip2a4, ip2a6, as_table, filtering, rr_types, experiment, q_set, rsv_cache=rsv_cache)
+    if x is None:
+        return None
+    return x.row()
+
+def get_log_as_df(log_file, ip2a4, ip2a6, as_table, rr_types=[], experiment=[], query_ASes=[], log_threshold = 15625, time_start=0, rsv_cache_size=500000):
         nb_events = 0
         lth = log_threshold;
         
         filtering = len(rr_types) > 0 or len(experiment) > 0 or len(query_ASes) > 0
         q_set = set(query_ASes)
+        rsv_cache = rsv_log_parse.resolver_cache(max_size=rsv_cache_size)
+        prefilter = None
+        if filtering:
+            prefilter = rsv_log_parse.raw_prefilter(rr_types=rr_types, experiment=experiment, query_ASes=query_ASes)
         t = []
-        old_time = 0
-        if log_file.endswith(".bz2"):
-            F = bz2.open(log_file, "rt")
-        else:
-            F = open(log_file, "r")
+        F = rsv_log_parse.open_log(log_file)
         for line in F:
-            parsed = True
-            try:
-                x = rsv_log_parse.rsv_log_line()
-                parsed = x.parse_line(line)
-            except Exception as exc:
-                traceback.print_exc()
-                print('\nCode generated an exception: %s' % (exc))
-                print("Cannot parse:\n" + line + "\n")
-                parsed = False
-            if parsed:
-                if (not filtering) or x.filter(rr_types=rr_types, experiment=experiment, query_ASes=q_set):
-                    x.set_resolver_AS(ip2a4, ip2a6, as_table)
-                    t.append(x.row())
-                    nb_events += 1
-
-                    if (nb_events%lth) == 0:
-                        new_time = time.time() - time_start
-                        if time_start > 0:
-                            print("loaded " + str(nb_events) + " events at " + str(new_time))
-                        else:
-                            print("loaded " + str(nb_events) + " events.")
-                        if lth < 1000000:
-                            lth *= 2
+            if prefilter is not None and not prefilter.accept(line):
+                continue
+            r = parse_log_line(line, ip2a4, ip2a6, as_table, filtering, rr_types, experiment, q_set, rsv_cache=rsv_cache)
+            if r is not None:
+                t.append(r)
+                nb_events += 1
+
+                if (nb_events%lth) == 0:
+                    new_time = time.time() - time_start
+                    if time_start > 0:
+                        print("loaded " + str(nb_events) + " events at " + str(new_time))
+                    else:
+                        print("loaded " + str(nb_events) + " events.")
+                    if lth < 1000000:
+                        lth *= 2
+        if prefilter is not None:
+            print(prefilter.stats())
+        print(rsv_cache.stats())
         df = pd.DataFrame(t, columns= rsv_log_parse.rsv_log_line.header())
         return df
 
+# Multi-process parsing.
+#
+# The bz2 blocks are not aligned on byte boundaries, so a single compressed
+# file cannot be cheaply split between processes. Instead, if there are at
+# least as many files as workers, each worker parses whole files; if not,
+# the main process decompresses the files and sends chunks of lines to the
+# workers. In both cases the shards are collected in the order of the input,
+# so the rows come out in the same order as with a single process. Each
+# worker loads the tables with ip2as.load_tables(), which maps the binary
+# snapshot, so the tables are shared between the processes.
+
+worker_state = dict()
+
+def init_worker(source_dir, rr_types, experiment, query_ASes):
+    worker_state["tables"] = ip2as.load_tables(source_dir)
+    worker_state["filtering"] = len(rr_types) > 0 or len(experiment) > 0 or len(query_ASes) > 0
+    worker_state["rr_types"] = rr_types
+    worker_state["experiment"] = experiment
+    worker_state["q_set"] = set(query_ASes)
+    worker_state["rsv_cache"] = rsv_log_parse.resolver_cache()
+    worker_state["prefilter"] = None
+    if worker_state["filtering"]:
+        worker_state["prefilter"] = rsv_log_parse.raw_prefilter(rr_types=rr_types, experiment=experiment, query_ASes=query_ASes)
+
+# parse_chunk returns the rows, and the number of lines read and dropped
+# by the prefilter for the statistics.
+def parse_chunk(lines):
+    ip2a4, ip2a6, as_table = worker_state["tables"]
+    prefilter = worker_state["prefilter"]
+    t = []
+    nb_lines = 0
+    nb_dropped = 0
+    for line in lines:
+        nb_lines += 1
+        if prefilter is not None and not prefilter.accept(line):
+            nb_dropped += 1
+            continue
+        r = parse_log_line(line, ip2a4, ip2a6, as_table, worker_state["filtering"], \
+            worker_state["rr_types"], worker_state["experiment"], worker_state["q_set"], rsv_cache=worker_state["rsv_cache"])
+        if r is not None:
+            t.append(r)
+    return t, nb_lines, nb_dropped
+
+def parse_file(log_file):
+    F = rsv_log_parse.open_log(log_file)
+    shard = parse_chunk(F)
+    F.close()
+    return shard
+
+def read_chunks(log_files, chunk_lines):
+    chunk = []
+    for log_file in log_files:
+        F = rsv_log_parse.open_log(log_file)
+        for line in F:
+            chunk.append(line)
+            if len(chunk) >= chunk_lines:
+                yield chunk
+                chunk = []
+        F.close()
+    if len(chunk) > 0:
+        yield chunk
+
+def get_logs_as_df_parallel(log_files, source_dir, nb_workers, rr_types=[], experiment=[], query_ASes=[], chunk_lines=100000, time_start=0):
+    t = []
+    nb_shards = 0
+    nb_lines = 0
+    nb_dropped = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers = nb_workers, initializer=init_worker, \
+        initargs=(source_dir, rr_types, experiment, query_ASes)) as executor:
+        if len(log_files) >= nb_workers:
+            shards = executor.map(parse_file, log_files)
+        else:
+            shards = bounded_map(executor, parse_chunk, read_chunks(log_files, chunk_lines), 2*nb_workers)
+        for shard in shards:
+            t += shard[0]
+            nb_lines += shard[1]
+            nb_dropped += shard[2]
+            nb_shards += 1
+            if time_start > 0:
+                print("loaded " + str(len(t)) + " events from " + str(nb_shards) + " shards at " + str(time.time() - time_start))
+    if len(rr_types) > 0 or len(experiment) > 0 or len(query_ASes) > 0:
+        print("Prefilter dropped " + str(nb_dropped) + " of " + str(nb_lines) + " lines.")
+    df = pd.DataFrame(t, columns= rsv_log_parse.rsv_log_line.header())
+    if len(log_files) > 1:
+        df = df.sort_values(by="query_time", kind="mergesort").reset_index(drop=True)
+    return df
+
+# Same as executor.map, but keeps at most max_pending tasks in flight, so
+# that the main process does not read the whole log in memory.
+def bounded_map(executor, fn, items, max_pending):
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
 # Main program
 if __name__ == "__main__":
     time_start = time.time()
@@ -68,38 +171,56 @@ if __name__ == "__main__":
         usage()
         exit(-1)
 
-    csv_file = sys.argv[1]
-    log_file = sys.argv[2]
+    args = sys.argv[1:]
+    nb_workers = 1
+    if "--workers" in args:
+        i = args.index("--workers")
+        if i + 1 >= len(args) or not args[i+1].isdigit() or int(args[i+1]) < 1:
+            usage()
+            exit(-1)
+        nb_workers = int(args[i+1])
+        args = args[:i] + args[i+2:]
+    if len(args) < 2:
+        usage()
+        exit(-1)
+    csv_file = args[0]
+    log_files = []
     target_ASes = []
-    if len(sys.argv) > 3:
-        target_ASes = sys.argv[3:]
-        if len(target_ASes) == 1 and target_ASes[0] == "TopAS":
-            target_ASes = top_as.top_as_list()
+    for arg in args[1:]:
+        if len(target_ASes) == 0 and not arg.startswith("AS") and arg != "TopAS":
+            log_files.append(arg)
+        else:
+            target_ASes.append(arg)
+    if len(log_files) == 0:
+        usage()
+        exit(-1)
+    if len(target_ASes) == 1 and target_ASes[0] == "TopAS":
+        target_ASes = top_as.top_as_list()
     
     source_path = Path(__file__).resolve()
     resolver_dir = source_path.parent
     auto_source_dir = resolver_dir.parent
     print("Auto source path is: " + str(auto_source_dir) + " (source: " + str(source_path) + ")")
     source_dir = os.path.join(auto_source_dir, "data") 
-    ip2a4_file = os.path.join(source_dir, "ip2as.csv") 
-    ip2a6_file = os.path.join(source_dir, "ip2asv6.csv")
-    as_names_file = os.path.join(source_dir, "as_names.csv")      
-    ip2a4 = ip2as.ip2as_table()
-    ip2a4.load(ip2a4_file)
-    ip2a6 = ip2as.ip2as_table()
-    ip2a6.load(ip2a6_file)
-    as_names = ip2as.asname()
-    as_names.load(as_names_file)
+    ip2a4, ip2a6, as_names = ip2as.load_tables(source_dir)
     time_loaded = time.time()
     print("Tables loaded at " + str(time_loaded - time_start) + " seconds.")
 
-    df = get_log_as_df(log_file, ip2a4, ip2a6, as_names, rr_types=['A', 'AAAA', 'HTTPS'], experiment=['0du'], query_ASes=target_ASes, log_threshold = 15625, time_start=time_start)
+    if nb_workers > 1:
+        df = get_logs_as_df_parallel(log_files, source_dir, nb_workers, rr_types=rsv_log_parse.first_pass_rr_types, experiment=rsv_log_parse.first_pass_experiment, query_ASes=target_ASes, time_start=time_start)
+    elif len(log_files) == 1:
+        df = get_log_as_df(log_files[0], ip2a4, ip2a6, as_names, rr_types=rsv_log_parse.first_pass_rr_types, experiment=rsv_log_parse.first_pass_experiment, query_ASes=target_ASes, log_threshold = 15625, time_start=time_start)
+    else:
+        df_list = []
+        for log_file in log_files:
+            df_list.append(get_log_as_df(log_file, ip2a4, ip2a6, as_names, rr_types=rsv_log_parse.first_pass_rr_types, experiment=rsv_log_parse.first_pass_experiment, query_ASes=target_ASes, log_threshold = 15625, time_start=time_start))
+        df = pd.concat(df_list).sort_values(by="query_time", kind="mergesort").reset_index(drop=True)
     time_file_read = time.time()
     print("File read at " + str(time.time() - time_start) + " seconds.")
     if df.shape[0] == 0:
         print("No event found. Are you sure this is a correct file?")
     else:
-        df.to_csv(csv_file)
+        rsv_log_parse.save_events(df, csv_file)
         print("Saved " + str(df.shape[0]) + " events to " + csv_file + " at " + str(time.time() - time_start) + " seconds.")
 
     exit(0)
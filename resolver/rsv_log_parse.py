@@ -69,6 +69,8 @@ import bz2
 import time
 import top_as
 import csv
+import collections
+import operator
 
 class rsv_log_line:
     def __init__(self):
@@ -276,22 +278,22 @@ class rsv_log_line:
     #
     # The additional arguments are the table mapping IPv4 addresses
     # to ASes (ip2a4), IPv6 addresses to (ip2a6) and the AS number
-    # to a CC (as_table)
-    def set_resolver_AS(self, ip2a4, ip2a6, as_table):
-        parts6 = self.resolver_IP.split(":")
-        if len(parts6) > 1:
-            asn = ip2a6.get_asn(self.resolver_IP)
+    # to a CC (as_table). If a resolver_cache is provided, the values
+    # that only depend on the resolver IP address are taken from the cache.
+    def set_resolver_AS(self, ip2a4, ip2a6, as_table, rsv_cache=None):
+        if rsv_cache is None:
+            rsv = resolver_cache.classify(self.resolver_IP, ip2a4, ip2a6, as_table)
         else:
-            asn = ip2a4.get_asn(self.resolver_IP)
-        self.resolver_AS = "AS" + str(asn)
-        self.resolver_cc = as_table.cc(self.resolver_AS)
-        self.resolver_tag = open_rsv.get_open_rsv(self.resolver_IP, self.resolver_AS)
+            rsv = rsv_cache.get(self.resolver_IP, ip2a4, ip2a6, as_table)
+        self.resolver_AS = rsv[0]
+        self.resolver_cc = rsv[1]
+        self.resolver_tag = rsv[2]
         if len(self.resolver_tag) == 0:
             if self.resolver_AS == self.query_AS:
                 self.resolver_tag = "Same_AS"
-            elif top_as.as_group(self.resolver_AS) == top_as.as_group(self.query_AS):
+            elif rsv[3] == top_as.as_group(self.query_AS):
                 self.resolver_tag = "Same_group"
-            elif self.resolver_AS in top_as.CloudAS:
+            elif rsv[4]:
                 self.resolver_tag = "Cloud"
             elif self.resolver_cc == self.query_cc:
                 self.resolver_tag = "Same_CC"
@@ -383,6 +385,374 @@ class rsv_log_line:
             self.invalid_query ]
         return r
 
+# The lean parser is a faster alternative to parse_line + row() when only
+# a few fields are needed. It does not create a rsv_log_line object, and
+# it only computes the requested fields: the dotted query IP, the "ASnnn"
+# string, the server name and the EDNS string are only built if asked.
+# The common "params" form of the query name is parsed directly; all other
+# forms (anomalous, sentinel, short names, malformed values) fall back to
+# parse_line, so that the values are always the same as those returned by
+# parse_line + row(). Lines that parse_line rejects return None.
+#
+# The field names are those of rsv_log_line.header(). The parse function
+# returns a tuple with the values of the requested fields, in the order
+# in which they were requested.
+#
+# The tools do not use it yet: the first pass and the streaming loads need
+# the rsv_log_line objects, and the resolver classification done by
+# parse_line. It can be measured with rsv_parse_bench.py.
+class rsv_lean_parser:
+    __slots__ = ('fields', 'index', 'getter', 'want_server', 'want_edns', \
+        'want_cc', 'want_AS', 'want_ip', 'nb_fast', 'nb_fallback')
+
+    def __init__(self, fields=None):
+        header = rsv_log_line.header()
+        if fields is None:
+            fields = header
+        self.fields = list(fields)
+        self.index = []
+        for field in self.fields:
+            if not field in header:
+                raise ValueError("Unknown field: " + str(field))
+            self.index.append(header.index(field))
+        # itemgetter extracts the requested values from the full tuple.
+        if self.index == list(range(0, len(header))):
+            self.getter = None
+        elif len(self.index) == 1:
+            i = self.index[0]
+            self.getter = lambda r: (r[i],)
+        else:
+            self.getter = operator.itemgetter(*self.index)
+        self.want_server = 'server' in self.fields
+        self.want_edns = 'query_edns' in self.fields
+        self.want_cc = 'query_cc' in self.fields
+        self.want_AS = 'query_AS' in self.fields
+        self.want_ip = 'query_IP' in self.fields
+        self.nb_fast = 0
+        self.nb_fallback = 0
+
+    def parse_fallback(self, s):
+        self.nb_fallback += 1
+        x = rsv_log_line()
+        if not x.parse_line(s):
+            return None
+        r = tuple(x.row())
+        if self.getter is None:
+            return r
+        return self.getter(r)
+
+    def parse(self, s):
+        s = s.strip()
+        parts = s.split(" ")
+        if len(parts) < 8 or parts[1] != "client" or parts[3] != "query:":
+            return None
+        query_name = parts[4].strip()
+        dot = query_name.find(".")
+        if dot < 0:
+            query_string = query_name
+        else:
+            query_string = query_name[:dot]
+        query_parts = query_string.split("-")
+        if len(query_parts) < 6 or \
+            query_string.startswith("000-000-000") or \
+            query_string.startswith("root-key-sentinel"):
+            return self.parse_fallback(s)
+        query_experiment = query_parts[0]
+        is_results = query_parts[1] == "results"
+        if is_results:
+            query_parts = query_parts[1:]
+            if len(query_parts) < 6:
+                return self.parse_fallback(s)
+        query_AS_str = query_parts[3]
+        ad_time_str = query_parts[4]
+        query_ip_str = query_parts[5]
+        ip_ports_str = parts[2]
+        if ip_ports_str.endswith(":"):
+            ip_ports_str = ip_ports_str[:-1]
+        ip_ports = ip_ports_str.split("#")
+        if len(ip_ports) < 2 or not query_AS_str.startswith("a") or \
+            not ad_time_str.startswith("s") or not query_ip_str.startswith("i"):
+            return self.parse_fallback(s)
+        try:
+            # these conversions decide whether the line is valid, so they
+            # are always done. Only the string formatting is lazy.
+            query_time = float(parts[0])
+            resolver_port = int(ip_ports[1])
+            as_num = int(query_AS_str[1:], 16)
+            query_ad_time = int(ad_time_str[1:])
+            ip_num = int(query_ip_str[1:], 16)
+        except:
+            return self.parse_fallback(s)
+        self.nb_fast += 1
+        query_cc = ""
+        if self.want_cc:
+            query_cc = country.country_code_from_c999(query_parts[2])
+        query_AS = ""
+        if self.want_AS:
+            query_AS = "AS" + str(as_num)
+        query_ip = ""
+        if self.want_ip:
+            query_ip = str(ip_num>>24)+ "." + \
+                str((ip_num>>16)&255)+ "." + \
+                str((ip_num>>8)&255)+ "." + \
+                str(ip_num&255)
+        server = ""
+        if self.want_server:
+            name_parts = query_name.split(".")
+            if len(name_parts[-1]) == 0:
+                name_parts = name_parts[:-1]
+            delimiter = "."
+            if len(name_parts) < 3:
+                server = delimiter.join(name_parts)
+            else:
+                server = delimiter.join(name_parts[-3:])
+        query_edns = ""
+        if self.want_edns:
+            delimiter = " "
+            query_edns = delimiter.join(parts[7:])
+        # same order as rsv_log_line.header()
+        r = ( query_time, ip_ports[0], resolver_port, "", "", "", \
+            query_experiment, query_parts[1], query_cc, query_AS, \
+            query_ad_time, query_ip, parts[5], parts[6], server, \
+            is_results, False, False, False, query_edns, "" )
+        if self.getter is None:
+            return r
+        return self.getter(r)
+
+# The resolver cache. A day of logs has hundreds of millions of queries,
+# but only a few hundred thousand distinct resolver addresses. The cache
+# keeps, for the most recently seen resolver addresses, the values that
+# only depend on that address: resolver AS, resolver CC, open resolver tag,
+# AS group and whether the AS is a cloud provider. When the cache is full,
+# the least recently used entry is removed.
+class resolver_cache:
+    def __init__(self, max_size=500000):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def classify(resolver_IP, ip2a4, ip2a6, as_table):
+        if ":" in resolver_IP:
+            asn = ip2a6.get_asn(resolver_IP)
+        else:
+            asn = ip2a4.get_asn(resolver_IP)
+        resolver_AS = "AS" + str(asn)
+        resolver_cc = as_table.cc(resolver_AS)
+        open_rsv_tag = open_rsv.get_open_rsv(resolver_IP, resolver_AS)
+        return (resolver_AS, resolver_cc, open_rsv_tag, top_as.as_group(resolver_AS), resolver_AS in top_as.CloudAS)
+
+    def get(self, resolver_IP, ip2a4, ip2a6, as_table):
+        if resolver_IP in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(resolver_IP)
+            return self.entries[resolver_IP]
+        self.misses += 1
+        rsv = resolver_cache.classify(resolver_IP, ip2a4, ip2a6, as_table)
+        self.entries[resolver_IP] = rsv
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return rsv
+
+    def stats(self):
+        return "Resolver cache: " + str(len(self.entries)) + " entries, " + \
+            str(self.hits) + " hits, " + str(self.misses) + " misses."
+
+# Streaming access to the raw logs. log_events() reads a log file, which
+# may be compressed with bz2, and yields the rsv_log_line objects that pass
+# the filter, with the resolver AS already set. The second pass tools can
+# consume these events directly, without going through the first pass csv
+# file, and without keeping the list of all events in memory.
+#
+# The first pass filters are kept here, so that the direct path retains the
+# same events as the csv path. Files that do not end with one of the
+# raw_log_suffixes are assumed to be first pass outputs.
+
+first_pass_rr_types = [ 'A', 'AAAA', 'HTTPS' ]
+first_pass_experiment = [ '0du' ]
+raw_log_suffixes = [ ".bz2", ".log" ]
+
+def is_raw_log(file_name):
+    for suffix in raw_log_suffixes:
+        if file_name.endswith(suffix):
+            return True
+    return False
+
+def open_log(log_file):
+    if log_file.endswith(".bz2"):
+        return bz2.open(log_file, "rt")
+    return open(log_file, "r")
+
+# The raw prefilter rejects lines before they are parsed, using
+# cheap tests on the raw text. It only rejects lines that the filter
+# function would also reject, so the set of accepted events is unchanged:
+# - for an experiment code such as "0du", the query name of an accepted
+#   line starts with "0du-", so the line shall contain "0du-". (Experiment
+#   codes that contain a "-" only come from anomalous names, and the test
+#   is just that the line contains the code.)
+# - the RR type is a field delimited by spaces, so the line shall contain
+#   " A ", " AAAA " or " HTTPS ".
+# - if a list of query ASes is set and all experiment codes are simple
+#   codes like "0du", the query name has the "params" form. The AS is
+#   decoded from the "a<hex>" token of the query name and checked against
+#   the list, and the "results" queries are rejected. The hex value can
+#   have leading zeros or upper case digits, so this is done by decoding
+#   just that token rather than by searching substrings.
+# The filter still runs on the lines that pass the prefilter.
+class raw_prefilter:
+    def __init__(self, rr_types=[], experiment=[], query_ASes=[]):
+        self.experiment_tokens = []
+        params_only = len(experiment) > 0
+        for ex in experiment:
+            if len(ex) == 0 or "-" in ex:
+                params_only = False
+                self.experiment_tokens.append(ex)
+            else:
+                self.experiment_tokens.append(ex + "-")
+        self.rr_tokens = []
+        for rr_type in rr_types:
+            self.rr_tokens.append(" " + rr_type + " ")
+        self.q_set = set(query_ASes)
+        self.check_AS = params_only and len(self.q_set) > 0
+        self.nb_lines = 0
+        self.nb_dropped = 0
+
+    def has_token(line, tokens):
+        for token in tokens:
+            if token in line:
+                return True
+        return False
+
+    def query_AS_match(self, line):
+        parts = line.strip().split(" ")
+        if len(parts) < 8:
+            return False
+        query_parts = parts[4].strip().split(".")[0].split("-")
+        if len(query_parts) < 6 or query_parts[1] == "results":
+            return False
+        query_AS_str = query_parts[3]
+        query_AS = "AS0"
+        if query_AS_str.startswith("a"):
+            try:
+                query_AS = "AS" + str(int(query_AS_str[1:], 16))
+            except:
+                return False
+        return query_AS in self.q_set
+
+    def accept(self, line):
+        self.nb_lines += 1
+        if (len(self.experiment_tokens) > 0 and not raw_prefilter.has_token(line, self.experiment_tokens)) or \
+            (len(self.rr_tokens) > 0 and not raw_prefilter.has_token(line, self.rr_tokens)) or \
+            (self.check_AS and not self.query_AS_match(line)):
+            self.nb_dropped += 1
+            return False
+        return True
+
+    def stats(self):
+        return "Prefilter dropped " + str(self.nb_dropped) + " of " + str(self.nb_lines) + " lines."
+
+# parse_log_event returns the parsed event for one line of the log, or None
+# if the line cannot be parsed or does not pass the filter.
+def parse_log_event(line, ip2a4, ip2a6, as_table, filtering, rr_types, experiment, q_set, rsv_cache=None):
+    parsed = True
+    try:
+        x = rsv_log_line()
+        parsed = x.parse_line(line)
+    except Exception as exc:
+        traceback.print_exc()
+        print('\nCode generated an exception: %s' % (exc))
+        print("Cannot parse:\n" + line + "\n")
+        parsed = False
+    if parsed:
+        if (not filtering) or x.filter(rr_types=rr_types, experiment=experiment, query_ASes=q_set):
+            x.set_resolver_AS(ip2a4, ip2a6, as_table, rsv_cache=rsv_cache)
+            return x
+    return None
+
+def log_events(log_file, ip2a4, ip2a6, as_table, rr_types=[], experiment=[], query_ASes=[], rsv_cache=None):
+    filtering = len(rr_types) > 0 or len(experiment) > 0 or len(query_ASes) > 0
+    q_set = set(query_ASes)
+    if rsv_cache is None:
+        rsv_cache = resolver_cache()
+    prefilter = None
+    if filtering:
+        prefilter = raw_prefilter(rr_types=rr_types, experiment=experiment, query_ASes=query_ASes)
+    F = open_log(log_file)
+    for line in F:
+        if prefilter is not None and not prefilter.accept(line):
+            continue
+        x = parse_log_event(line, ip2a4, ip2a6, as_table, filtering, rr_types, experiment, q_set, rsv_cache=rsv_cache)
+        if x is not None:
+            yield x
+    F.close()
+    if prefilter is not None:
+        print(prefilter.stats())
+    print(rsv_cache.stats())
+
+# first_pass_events applies the same filters as rsv_first_pass. The tables
+# are the IPv4 table, IPv6 table and AS names returned by ip2as.load_tables.
+def first_pass_events(log_file, tables):
+    return log_events(log_file, tables[0], tables[1], tables[2], rr_types=first_pass_rr_types, experiment=first_pass_experiment)
+
+# The first pass saves the events either in a csv file or, if the file
+# name ends with ".parquet", in a Parquet file. The Parquet file is
+# columnar, and the columns with few distinct values are dictionary
+# encoded, which makes it much smaller than the csv file. The second pass
+# tools use load_event_rows to read either format. It yields one list per
+# event, with the values of the columns in header_row, as strings except
+# for floating point columns. With Parquet, only the listed columns are
+# read. Reading Parquet files requires the "pyarrow" package.
+
+columnar_suffix = ".parquet"
+dictionary_columns = [ 'resolver_tag', 'resolver_cc', 'experiment_id', 'query_cc', \
+    'query_AS', 'rr_class', 'rr_type', 'server' ]
+
+def save_events(df, file_name):
+    if file_name.endswith(columnar_suffix):
+        encoding = dict()
+        for column in dictionary_columns:
+            if column in df.columns:
+                encoding[column] = "category"
+        df.astype(encoding).to_parquet(file_name, index=False)
+    else:
+        df.to_csv(file_name)
+
+# load_event_columns reads the columns in header_row from a Parquet file,
+# and returns one list per column, with the same values as load_event_rows.
+def load_event_columns(saved_file, header_row):
+    try:
+        df = pd.read_parquet(saved_file, columns=header_row)
+    except Exception as exc:
+        traceback.print_exc()
+        print("Could not read " + ','.join(header_row) + " from " + saved_file + ": " + str(exc))
+        exit(-1)
+    columns = []
+    for column in header_row:
+        if pd.api.types.is_float_dtype(df[column]):
+            columns.append(df[column].tolist())
+        else:
+            columns.append(df[column].astype(object).fillna("").astype(str).tolist())
+    return columns
+
+def load_event_rows(saved_file, header_row):
+    if saved_file.endswith(columnar_suffix):
+        columns = load_event_columns(saved_file, header_row)
+        for row in zip(*columns):
+            yield row
+    else:
+        with open(saved_file, newline='') as csvfile:
+            rsv_reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+            header_index = []
+            for row in rsv_reader:
+                if len(header_index) == 0:
+                    for column in header_row:
+                        if not column in row:
+                            print("Could not find " + column + " in " + ','.join(row))
+                            exit(-1)
+                        header_index.append(row.index(column))
+                else:
+                    yield [ row[i] for i in header_index ]
+
 # pivot per query and per AS, produce a dictionary with
 # one table per AS, containing the queries for that AS
 
@@ -467,67 +837,245 @@ class subnet_record:
             self.subnet,
             self.count ]
 
+# The subnet aggregator counts the ISP resolver queries per /16 (IPv4) or
+# /40 (IPv6) subnet. The address is converted to an integer with
+# ip2as.ip_key and masked, and the counters are keyed by the tuple
+# (query_cc, query_AS, resolver_AS, prefix, version). The subnet strings
+# are only produced by get_subnets(), in the order in which the subnets
+# were first seen, as in the subnet_record dictionary.
+subnet_v4_shift = 32 - 16
+subnet_v6_shift = 128 - 40
+
+def subnet_prefix(resolver_IP):
+    version, key = ip2as.ip_key(resolver_IP)
+    if version == 4:
+        return (key >> subnet_v4_shift) << subnet_v4_shift, 4
+    elif version == 6:
+        return (int.from_bytes(key, "big") >> subnet_v6_shift) << subnet_v6_shift, 6
+    return 0, 0
+
+def subnet_string(prefix, version):
+    if version == 6:
+        return str(ipaddress.IPv6Network((prefix, 128 - subnet_v6_shift)))
+    return str(ipaddress.IPv4Network((prefix, 32 - subnet_v4_shift)))
+
+class subnet_aggregator:
+    def __init__(self):
+        self.counts = dict()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, query_cc, query_AS, resolver_AS, resolver_IP):
+        prefix, version = subnet_prefix(resolver_IP)
+        if version == 0:
+            print("Bad address or subnet:" + str(resolver_IP) + "\n")
+            return
+        key = (query_cc, query_AS, resolver_AS, prefix, version)
+        if key in self.counts:
+            self.counts[key] += 1
+        else:
+            self.counts[key] = 1
+
+    # add_many adds a batch of queries, given as lists of equal length.
+    # The addresses are parsed once, the IPv4 and IPv6 prefixes are masked
+    # as arrays, and the keys are counted with a Counter before being
+    # merged in the counts.
+    def add_many(self, query_ccs, query_ASes, resolver_ASes, resolver_IPs):
+        n = len(resolver_IPs)
+        versions = np.zeros(n, dtype=np.int8)
+        v4_keys = np.zeros(n, dtype=np.uint32)
+        v6_keys = [ 0 ]*n
+        for i in range(0, n):
+            version, key = ip2as.ip_key(resolver_IPs[i])
+            versions[i] = version
+            if version == 4:
+                v4_keys[i] = key
+            elif version == 6:
+                v6_keys[i] = int.from_bytes(key, "big") >> subnet_v6_shift
+        v4_prefixes = (v4_keys >> subnet_v4_shift) << subnet_v4_shift
+        prefixes = []
+        for i in range(0, n):
+            if versions[i] == 4:
+                prefixes.append(int(v4_prefixes[i]))
+            elif versions[i] == 6:
+                prefixes.append(v6_keys[i] << subnet_v6_shift)
+            else:
+                prefixes.append(0)
+                print("Bad address or subnet:" + str(resolver_IPs[i]) + "\n")
+        batch = collections.Counter(zip(query_ccs, query_ASes, resolver_ASes, prefixes, versions.tolist()))
+        for key in batch:
+            if key[4] == 0:
+                continue
+            if key in self.counts:
+                self.counts[key] += batch[key]
+            else:
+                self.counts[key] = batch[key]
+
+    def merge(self, other):
+        for key in other.counts:
+            if key in self.counts:
+                self.counts[key] += other.counts[key]
+            else:
+                self.counts[key] = other.counts[key]
+
+    def get_subnets(self):
+        snts = []
+        for key in self.counts:
+            snts.append([ key[0], key[1], key[2], subnet_string(key[3], key[4]), self.counts[key] ])
+        snts.sort(key=lambda x: x[4], reverse=True)
+        return snts
+
+# The per CC+AS record keeps, for each UID, the earliest time at which
+# a query for that UID was received from each category of resolver (tag).
+# At month scale there are tens of millions of UIDs, so instead of an
+# object per UID, the UIDs are mapped to integer indices, and the times
+# are kept in a numpy array with one line per UID and one column per tag.
+# The columns are those of tag_list, plus columns added when an unexpected
+# tag shows up. A tag that has not been seen for a UID has the time "inf".
+# The array "tag_order" keeps the order in which the tags were first seen
+# for each UID, which is used for the "rank" in get_delta_t_both.
 class pivoted_cc_AS_record:
     def __init__(self, query_cc,query_AS):
         self.query_cc = query_cc
         self.query_AS = query_AS
-        self.rqt = dict()
-        self.user_ids = set()
+        self.uid_index = dict()
+        self.tags = list(tag_list)
+        self.tag_index = dict()
+        for tag in self.tags:
+            self.tag_index[tag] = len(self.tag_index)
+        self.times = np.full((16, len(self.tags)), np.inf)
+        self.tag_order = np.zeros((16, len(self.tags)), dtype=np.int8)
+        self.nb_tags = bytearray()
+        self.delta_max = 0.5
         self.nb_isp = 0
         self.nb_public = 0
         self.nb_both = 0
         self.nb_others = 0
         self.nb_tag_uid = 0
         self.nb_all = 0
-        self.subnets = dict()
+        self.subnets = subnet_aggregator()
+
+    def nb_uids(self):
+        return len(self.uid_index)
+
+    # add a UID line, doubling the size of the arrays if needed.
+    def add_uid(self, uid):
+        i = len(self.uid_index)
+        if i >= self.times.shape[0]:
+            size = 2*self.times.shape[0]
+            times = np.full((size, self.times.shape[1]), np.inf)
+            times[:i] = self.times
+            self.times = times
+            tag_order = np.zeros((size, self.tag_order.shape[1]), dtype=np.int8)
+            tag_order[:i] = self.tag_order
+            self.tag_order = tag_order
+        self.uid_index[uid] = i
+        self.nb_tags.append(0)
+        return i
+
+    # add a column for a tag that is not in tag_list.
+    def add_tag(self, tag):
+        j = len(self.tags)
+        self.tags.append(tag)
+        self.tag_index[tag] = j
+        self.times = np.hstack([self.times, np.full((self.times.shape[0], 1), np.inf)])
+        self.tag_order = np.hstack([self.tag_order, np.zeros((self.tag_order.shape[0], 1), dtype=np.int8)])
+        return j
 
     # process event 
-    # For each UID, we compute a pivoted record, which contains a dict() of "tags".
-    # If a tag is present in the dict, we only retain the earliest time for that ta
+    # For each UID, we keep the earliest time for each tag.
     def process_event(self, qt, tag, query_cc, query_AS, uid, resolver_IP, resolver_AS):
+        self.process_time(qt, tag, uid)
+        if tag in tag_isp_set:
+            self.subnets.add(query_cc, query_AS, resolver_AS, resolver_IP)
+
+    # process_time updates the per UID times, without the subnets, which
+    # the columnar load adds in batches.
+    def process_time(self, qt, tag, uid):
         self.nb_all += 1
-        if uid in self.rqt:
-            if not tag in self.rqt[uid].rsv_times:
-                self.nb_tag_uid += 1
-            self.rqt[uid].add_event2(qt, tag)
+        if uid in self.uid_index:
+            i = self.uid_index[uid]
         else:
+            i = self.add_uid(uid)
+        if tag in self.tag_index:
+            j = self.tag_index[tag]
+        else:
+            j = self.add_tag(tag)
+        t = self.times.item(i, j)
+        if t == np.inf:
             self.nb_tag_uid += 1
-            self.rqt[uid] = pivoted_record(qt, tag, query_cc, query_AS, uid)
-            if not uid in self.user_ids:
-                self.user_ids.add(uid)
+            self.tag_order[i, j] = self.nb_tags[i]
+            self.nb_tags[i] += 1
+            self.times[i, j] = qt
+        elif qt < t:
+            self.times[i, j] = qt
+
+    # merge adds the state of another record, as if the events of the other
+    # record had been processed after those of this one. This is used to
+    # combine the records computed for each day. For a UID present in both
+    # records, for example a UID whose queries straddle midnight, the time
+    # of each tag is the earliest of the two, and the tags that are new in
+    # the other record are ranked after those already seen, in the order
+    # in which the other record saw them.
+    def merge(self, other):
+        self.nb_all += other.nb_all
+        cols = []
+        for tag in other.tags:
+            if tag in self.tag_index:
+                cols.append(self.tag_index[tag])
+            else:
+                cols.append(self.add_tag(tag))
+        cols = np.array(cols, dtype=np.int64)
+        nb_other = other.nb_uids()
+        rows = np.zeros(nb_other, dtype=np.int64)
+        for uid in other.uid_index:
+            if uid in self.uid_index:
+                rows[other.uid_index[uid]] = self.uid_index[uid]
+            else:
+                rows[other.uid_index[uid]] = self.add_uid(uid)
+        if nb_other > 0:
+            cells = (rows[:,None], cols[None,:])
+            self_times = self.times[cells]
+            other_times = other.times[:nb_other]
+            is_new = np.isfinite(other_times) & ~np.isfinite(self_times)
+            new_order = np.where(is_new, other.tag_order[:nb_other], len(cols))
+            new_rank = np.argsort(np.argsort(new_order, axis=1, kind="stable"), axis=1, kind="stable")
+            nb_tags = np.array(self.nb_tags, dtype=np.int64)
+            self.tag_order[cells] = np.where(is_new, nb_tags[rows][:,None] + new_rank, self.tag_order[cells])
+            self.times[cells] = np.minimum(self_times, other_times)
+            nb_tags[rows] += is_new.sum(axis=1)
+            self.nb_tags = bytearray(nb_tags.astype(np.uint8).tobytes())
+        self.nb_tag_uid = int(np.isfinite(self.times[:self.nb_uids()]).sum())
+        self.subnets.merge(other.subnets)
+
+    # get_deltas returns the time of the first query for each UID, the
+    # delay between that and the first query for each tag, and a mask
+    # of the tags for which that delay is at most delta_max.
+    def get_deltas(self):
+        times = self.times[:self.nb_uids()]
+        first_time = times.min(axis=1)
+        delta = times - first_time[:,None]
+        within = np.isfinite(times) & (delta <= self.delta_max)
+        return first_time, delta, within
 
-        if tag in tag_isp_set:
-            try:
-                addr = ipaddress.ip_address(resolver_IP)
-                if addr.version == 6:
-                    subnet = ipaddress.IPv6Network(resolver_IP + "/40", strict=False)
-                else:
-                    subnet = ipaddress.IPv4Network(resolver_IP + "/16", strict=False)
-                key = subnet_record.key(query_cc, query_AS, resolver_AS, subnet)
-                if key in self.subnets:
-                    self.subnets[key].count += 1
-                else:
-                    self.subnets[key] = subnet_record(query_cc, query_AS, resolver_AS, subnet, 1)
-            except Exception as exc:
-                traceback.print_exc()
-                print('\nCode generated an exception: %s' % (exc))
-                print("Bad address or subnet:" + resolver_IP + "\n")
-    
     # Delta updates the per query record to compute the delta between the
     # arrival in a given category and the first query for that UID.
     # This computation can only be performed once all records have been logged.
+    # We only consider the events that happen less that "delta_max"
+    # (default= 0.5 second) from the first event. This cuts down the
+    # noise of, for example, queries repeated to maintain a cache
     def compute_delta_t(self, delta_max = 0.5):
-        for key in self.rqt:
-            self.rqt[key].compute_delta_t(delta_max=delta_max)
-            if self.rqt[key].has_public:
-                if self.rqt[key].has_isp:
-                    self.nb_both += 1
-                else:
-                    self.nb_public += 1
-            elif self.rqt[key].has_isp:
-                self.nb_isp += 1
-            else:
-                self.nb_others += 1
+        self.delta_max = delta_max
+        first_time, delta, within = self.get_deltas()
+        isp_cols = [ self.tag_index[tag] for tag in self.tags if tag in tag_isp_set ]
+        public_cols = [ self.tag_index[tag] for tag in self.tags if tag in tag_public_set ]
+        has_isp = within[:,isp_cols].any(axis=1)
+        has_public = within[:,public_cols].any(axis=1)
+        self.nb_both += int(np.count_nonzero(has_public & has_isp))
+        self.nb_public += int(np.count_nonzero(has_public & ~has_isp))
+        self.nb_isp += int(np.count_nonzero(has_isp & ~has_public))
+        self.nb_others += int(np.count_nonzero(~(has_isp | has_public)))
 
     # Produce a one line summary record for the ASN   
     # Return a list of values:
@@ -550,7 +1098,7 @@ class pivoted_cc_AS_record:
         r = [
             self.query_cc,
             self.query_AS,
-            len(self.user_ids),
+            self.nb_uids(),
             self.nb_tag_uid,
             self.nb_all,
             self.nb_isp,
@@ -558,42 +1106,70 @@ class pivoted_cc_AS_record:
             self.nb_both,
             self.nb_others
         ]
-        rank0 = len(r)
+        tag_counts = np.isfinite(self.times[:self.nb_uids()]).sum(axis=0)
         for tag in tag_list:
-            r.append(0)
-
-        for key in self.rqt:
-            rqt_r = self.rqt[key]
-            rank = rank0
-            for tag in tag_list:
-                if tag in rqt_r.rsv_times:
-                    r[rank] += 1
-                rank += 1
-                
+            r.append(int(tag_counts[self.tag_index[tag]]))
         return r
 
     # get_delta_t_both:
-    # we produce a list of "dots" records suitable for statistics and graphs
+    # we produce a list of "dots" records suitable for statistics and graphs.
+    # For each UID, the tags are listed in the order in which they were
+    # first seen, and the rank is the position in that list.
     def get_delta_t_both(self):
-        dots = []
-        for key in self.rqt:
-            rqt_r = self.rqt[key]
-            if len(rqt_r.delta_times) == 0:
-                rqt_r.compute_delta_times()
-            n_both = 0
-            for tag in rqt_r.delta_times:
-                n_both += 1
-                dot_line = [ tag, n_both,  rqt_r.first_time, rqt_r.delta_times[tag]]
-                dots.append(dot_line)
-        dot_df = pd.DataFrame(dots,columns=dot_headers)
+        first_time, delta, within = self.get_deltas()
+        rows, cols = np.nonzero(within)
+        if len(rows) == 0:
+            return pd.DataFrame([], columns=dot_headers)
+        order = np.lexsort((self.tag_order[rows, cols], rows))
+        rows = rows[order]
+        cols = cols[order]
+        row_start = np.concatenate(([0], np.cumsum(np.bincount(rows))[:-1]))
+        rank = np.arange(len(rows)) - row_start[rows] + 1
+        tag_names = np.array(self.tags, dtype=object)
+        dot_df = pd.DataFrame({
+            'rsv_type': list(tag_names[cols]),
+            'rank': rank.astype(np.int64),
+            'first_time': first_time[rows],
+            'delay': delta[rows, cols] }, columns=dot_headers)
         return dot_df
 
     def get_subnets(self):
-        snts = []
-        for key in self.subnets:
-            snts.append(self.subnets[key].subnet_row())
-        snts.sort(key=lambda x: x[4], reverse=True)
-        return snts
+        return self.subnets.get_subnets()
+
+# summaries_df returns the frame of the summaries, sorted by number of
+# UIDs. The sort is stable: the CC+AS with the same number of UIDs stay
+# in the order of s_list.
+def summaries_df(s_list):
+    # compose the headers
+    headers = [ \
+        'q_cc', \
+        'q_AS', \
+        'uids',
+        'q_uid_tags',
+        'q_repeats',
+        'isp',
+        'public',
+        'both',
+        'others',
+       ]
+    for tag in tag_list:
+        headers.append(tag)
+    s_list.sort(key=lambda x: x[2], reverse=True)
+    df = pd.DataFrame(s_list, columns=headers)
+    return df
+
+# event_tuples yields, for each event of a first pass file or raw log, the
+# arguments of pivoted_per_query.process_event. The tables are only used
+# for raw logs.
+pivoted_header_row = [ 'query_time', 'resolver_tag', 'query_cc', 'query_AS', 'query_user_id', 'resolver_IP', 'resolver_AS' ]
+
+def event_tuples(file_name, tables=None):
+    if is_raw_log(file_name):
+        for x in first_pass_events(file_name, tables):
+            yield (x.query_time, x.resolver_tag, x.query_cc, x.query_AS, x.query_user_id, x.resolver_IP, x.resolver_AS)
+    else:
+        for row in load_event_rows(file_name, pivoted_header_row):
+            yield (float(row[0]), row[1], row[2], row[3], row[4], row[5], row[6])
 
 class pivoted_per_query:
     def __init__(self):
@@ -607,40 +1183,38 @@ class pivoted_per_query:
 
         self.cc_AS_list[key].process_event(qt, tag, query_cc, query_AS, uid, resolver_IP, resolver_AS)
 
+    # merge adds the records of another pivoted_per_query, as if its
+    # events had been loaded after those already loaded.
+    def merge(self, other):
+        for key in other.cc_AS_list:
+            if not key in self.cc_AS_list:
+                self.cc_AS_list[key] = pivoted_cc_AS_record(other.cc_AS_list[key].query_cc, other.cc_AS_list[key].query_AS)
+            self.cc_AS_list[key].merge(other.cc_AS_list[key])
+        self.tried += other.tried
+
+    def nb_events(self):
+        nb_events = 0
+        for key in self.cc_AS_list:
+            nb_events += self.cc_AS_list[key].nb_all
+        return nb_events
+
     def quicker_load(self, file_name, ip2a4, ip2a6, as_table, rr_types=[], experiment=[], query_ASes=[], log_threshold = 15625, time_start=0):
+        events = log_events(file_name, ip2a4, ip2a6, as_table, rr_types=rr_types, experiment=experiment, query_ASes=query_ASes)
+        return self.load_events(events, log_threshold=log_threshold, time_start=time_start)
+
+    def load_events(self, events, log_threshold = 15625, time_start=0):
         nb_events = 0
         lth = log_threshold;
-        
-        filtering = len(rr_types) > 0 or len(experiment) > 0 or len(query_ASes) > 0
-        q_set = set(query_ASes)
-
-        if file_name.endswith(".bz2"):
-            F = bz2.open(file_name, "rt")
-        else:
-            F = open(file_name, "r")
-        for line in F:
-            parsed = True
-            try:
-                x = rsv_log_line()
-                parsed = x.parse_line(line)
-            except Exception as exc:
-                traceback.print_exc()
-                print('\nCode generated an exception: %s' % (exc))
-                print("Cannot parse:\n" + line + "\n")
-                parsed = False
-            if parsed:
-                if (not filtering) or x.filter(rr_types=rr_types, experiment=experiment, query_ASes=q_set):
-                    x.set_resolver_AS(ip2a4, ip2a6, as_table)
-                    self.process_event(x.query_time, x.resolver_tag, x.query_cc, x.query_AS, x.query_user_id, x.resolver_IP, x.resolver_AS)
-                    nb_events += 1
-                    if (nb_events%lth) == 0:
-                        if time_start > 0:
-                            time_n = time.time()
-                            print("loaded " + str(nb_events) + " events at " + str(time_n - time_start))
-                        else:
-                            print("loaded " + str(nb_events) + " events.")
-                        lth *= 2
-                    
+        for x in events:
+            self.process_event(x.query_time, x.resolver_tag, x.query_cc, x.query_AS, x.query_user_id, x.resolver_IP, x.resolver_AS)
+            nb_events += 1
+            if (nb_events%lth) == 0:
+                if time_start > 0:
+                    time_n = time.time()
+                    print("loaded " + str(nb_events) + " events at " + str(time_n - time_start))
+                else:
+                    print("loaded " + str(nb_events) + " events.")
+                lth *= 2
         return nb_events
 
     def load_df_row(self, x):
@@ -651,40 +1225,38 @@ class pivoted_per_query:
         #df.apply(lambda x: self.load_df_row(x), axis=1)
         #return df.shape[0]
         nb_events = 0
-        with open(saved_file, newline='') as csvfile:
-            rsv_reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            is_first = True
-            is_second = True
-            header_row = [ 'query_time', 'resolver_tag', 'query_cc', 'query_AS', 'query_user_id', 'resolver_IP', 'resolver_AS' ]
-            header_index = [ -1, -1, -1, -1, -1,  -1,  -1 ]
-
-            for row in rsv_reader:
-                if is_first:
-                    # print(",".join(row))
-                    for i in range(0, len(header_row)):
-                        for x in range(0, len(row)):
-                            if row[x] == header_row[i]:
-                            #   print("row[" + str(x) + "](" + str(row[x]) + ") == " + header_row[i])
-                                header_index[i] = x
-                                break
-                            #else:
-                            #    print(row[x] + " != " + header_row[i])
-                        if header_index[i] < 0:
-                            print("Could not find " + header_row[i] + " in " + ','.join(row))
-                            exit(-1)
-                    is_first = False
-                else:
-                    if (is_second):
-                        #print(",".join(row))
-                        #for i in range(0, len(header_row)):
-                        #    print(str(i) + ": x[" + header_row[i] + "] = " + str(row[header_index[i]]))
-                        is_second = False
-                    self.process_event(float(row[header_index[0]]), row[header_index[1]], row[header_index[2]], 
-                                       row[header_index[3]], row[header_index[4]], row[header_index[5]],
-                                       row[header_index[6]])
-                    nb_events += 1
+        header_row = [ 'query_time', 'resolver_tag', 'query_cc', 'query_AS', 'query_user_id', 'resolver_IP', 'resolver_AS' ]
+        if saved_file.endswith(columnar_suffix):
+            return self.load_columns(load_event_columns(saved_file, header_row))
+        for row in load_event_rows(saved_file, header_row):
+            self.process_event(float(row[0]), row[1], row[2], 
+                               row[3], row[4], row[5],
+                               row[6])
+            nb_events += 1
         return nb_events
 
+    # load_columns processes the columns read from a Parquet file. The
+    # times are processed one event at a time, but the rows with an ISP tag
+    # are grouped per CC+AS, and their subnets are added in one batch.
+    def load_columns(self, columns):
+        query_times, tags, query_ccs, query_ASes, uids, resolver_IPs, resolver_ASes = columns
+        isp_rows = dict()
+        for i in range(0, len(query_times)):
+            key = str(query_ccs[i]) + str(query_ASes[i])
+            if not key in self.cc_AS_list:
+                self.cc_AS_list[key] = pivoted_cc_AS_record(query_ccs[i], query_ASes[i])
+            self.cc_AS_list[key].process_time(query_times[i], tags[i], uids[i])
+            if tags[i] in tag_isp_set:
+                if not key in isp_rows:
+                    isp_rows[key] = []
+                isp_rows[key].append(i)
+        for key in isp_rows:
+            rows = isp_rows[key]
+            self.cc_AS_list[key].subnets.add_many([ query_ccs[i] for i in rows ], \
+                [ query_ASes[i] for i in rows ], [ resolver_ASes[i] for i in rows ], \
+                [ resolver_IPs[i] for i in rows ])
+        return len(query_times)
+
     def key_list(self):
         return list(self.cc_AS_list.keys())
 
@@ -693,27 +1265,11 @@ class pivoted_per_query:
             self.cc_AS_list[key].compute_delta_t()
 
     def get_summaries(self, key_list, first_only):
-        # compose the headers
-        headers = [ \
-            'q_cc', \
-            'q_AS', \
-            'uids',
-            'q_uid_tags',
-            'q_repeats',
-            'isp',
-            'public',
-            'both',
-            'others',
-           ]
-        for tag in tag_list:
-            headers.append(tag)
         s_list = []
         for key in key_list:
             if key in self.cc_AS_list:
                 s_list.append(self.cc_AS_list[key].get_summary(first_only))
-        s_list.sort(key=lambda x: x[2], reverse=True)
-        df = pd.DataFrame(s_list, columns=headers)
-        return df
+        return summaries_df(s_list)
 
     def get_delta_t_both(self, key):
         return self.cc_AS_list[key].get_delta_t_both()
@@ -725,6 +1281,34 @@ class pivoted_per_query:
         sn_df = pd.DataFrame(sn, columns=subnet_record.headers())
         return sn_df
 
+# downsample_dots returns at most about max_points dots for the scatter
+# plots, so that the time to draw the plot does not grow with the number of
+# events. The sample is stratified by resolver type: each type keeps a share
+# of the budget proportional to its number of dots, but at least
+# min_per_type dots, so that rare types remain visible. The dots with the
+# smallest and largest delay and first time of each type are always kept,
+# so the axes of the plot do not change. If max_points is 0, or if there
+# are fewer dots than that, the frame is returned as is.
+def downsample_dots(dot_df, max_points, min_per_type=100, seed=0):
+    nb_dots = dot_df.shape[0]
+    if max_points <= 0 or nb_dots <= max_points:
+        return dot_df
+    rng = np.random.default_rng(seed)
+    rsv_types = dot_df['rsv_type'].to_numpy()
+    delays = dot_df['delay'].to_numpy()
+    first_times = dot_df['first_time'].to_numpy()
+    kept = []
+    for rsv in pd.unique(rsv_types):
+        rows = np.flatnonzero(rsv_types == rsv)
+        nb_kept = max(min_per_type, int(max_points*len(rows)/nb_dots))
+        if nb_kept >= len(rows):
+            kept.append(rows)
+        else:
+            kept.append(rng.choice(rows, nb_kept, replace=False))
+            kept.append(rows[[ np.argmin(delays[rows]), np.argmax(delays[rows]), \
+                np.argmin(first_times[rows]), np.argmax(first_times[rows]) ]])
+    return dot_df.iloc[np.unique(np.concatenate(kept))]
+
 def do_graph(key, dot_df, image_file="", x_delay=False, log_y=False):
     if log_y:
         # replace 0 by low value so logy plots will work
@@ -812,6 +1396,35 @@ def get_slice_time(query_time, first_time, slice_duration, debug=False):
     slice_time = first_time + slice_nb*slice_duration
     return slice_time
 
+# Tumbling window aggregation. Instead of calling get_slice_time for each
+# event and updating a dict of slices, slice_sums takes numpy arrays:
+# the query times, and one column per counter (flags or counts) with one
+# value per event. It computes the slice of each event with the same formula
+# as get_slice_time, and sums the counters per slice with bincount. If
+# query_AS is set, only the events for which query_ASes[i] == query_AS are
+# counted. It returns the list of slice times in increasing order, the
+# number of events in each slice, and for each column the list of sums.
+def slice_sums(query_times, first_time, slice_duration, columns, query_ASes=None, query_AS=""):
+    query_times = np.asarray(query_times, dtype=np.float64)
+    columns = [ np.asarray(column) for column in columns ]
+    if len(query_AS) > 0:
+        selected = (np.asarray(query_ASes, dtype=object) == query_AS)
+        query_times = query_times[selected]
+        columns = [ column[selected] for column in columns ]
+    slice_nb = np.trunc((query_times - first_time)/slice_duration).astype(np.int64)
+    if isinstance(first_time, float):
+        slice_time = first_time + (slice_nb*slice_duration).astype(np.float64)
+    else:
+        slice_time = first_time + slice_nb*slice_duration
+    slice_list, slice_index = np.unique(slice_time, return_inverse=True)
+    nb_slices = len(slice_list)
+    counts = np.bincount(slice_index, minlength=nb_slices).tolist()
+    sums = []
+    for column in columns:
+        s = np.bincount(slice_index, weights=column.astype(np.float64), minlength=nb_slices)
+        sums.append(s.astype(np.int64).tolist())
+    return slice_list.tolist(), counts, sums
+
 
 
 
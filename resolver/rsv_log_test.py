@@ -2,8 +2,10 @@
 # verify that the parse library does what we expect
 
 import sys
+import ipaddress
 import ip2as
 import rsv_log_parse
+import rsv_duplicates
 import pandas as pd
 import traceback
 
@@ -98,12 +100,263 @@ def frame_test():
     df = pd.DataFrame(m,columns=rsv_log_parse.rsv_log_line.header())
     print(df)
 
+def cache_test():
+    # the resolver cache shall not change the results, even when entries
+    # are evicted. Use a tiny cache, and empty AS tables.
+    passing = True
+    ip2a4 = ip2as.ip2as_table()
+    ip2a6 = ip2as.ip2as_table()
+    as_names = ip2as.asname()
+    rsv_cache = rsv_log_parse.resolver_cache(max_size=2)
+    for line in test_lines + test_lines:
+        x = rsv_log_parse.rsv_log_line()
+        y = rsv_log_parse.rsv_log_line()
+        if x.parse_line(line) and y.parse_line(line):
+            x.set_resolver_AS(ip2a4, ip2a6, as_names)
+            y.set_resolver_AS(ip2a4, ip2a6, as_names, rsv_cache=rsv_cache)
+            if x.row() != y.row():
+                print("Cache changes the result for:\n" + line)
+                passing = False
+                break
+    if passing and (len(rsv_cache.entries) > 2 or rsv_cache.hits == 0 or \
+        rsv_cache.hits + rsv_cache.misses != 2*len(test_lines)):
+        print("Unexpected cache state. " + rsv_cache.stats())
+        passing = False
+    return passing
+
+def lean_test():
+    # the lean parser shall return exactly the same values as parse_line
+    # and row(), for all the fields or for a subset of them.
+    passing = True
+    header = rsv_log_parse.rsv_log_line.header()
+    subset = [ 'query_AS', 'query_time', 'resolver_IP', 'query_user_id', 'rr_type' ]
+    full_parser = rsv_log_parse.rsv_lean_parser()
+    subset_parser = rsv_log_parse.rsv_lean_parser(subset)
+    for line in test_lines:
+        x = rsv_log_parse.rsv_log_line()
+        if x.parse_line(line):
+            r = x.row()
+            expected = tuple(r)
+            expected_subset = tuple([r[header.index(f)] for f in subset])
+        else:
+            expected = None
+            expected_subset = None
+        if full_parser.parse(line) != expected or \
+            subset_parser.parse(line) != expected_subset:
+            print("Lean parser differs for:\n" + line)
+            passing = False
+            break
+    if passing and full_parser.nb_fast == 0:
+        print("Lean parser never used the fast path.")
+        passing = False
+    return passing
+
+def prefilter_test():
+    # the raw prefilter shall not drop any line that passes the filter.
+    passing = True
+    ip2a4 = ip2as.ip2as_table()
+    ip2a6 = ip2as.ip2as_table()
+    as_names = ip2as.asname()
+    for query_ASes in [ [], [ "AS22773", "AS7922" ] ]:
+        prefilter = rsv_log_parse.raw_prefilter(rr_types=rsv_log_parse.first_pass_rr_types, \
+            experiment=rsv_log_parse.first_pass_experiment, query_ASes=query_ASes)
+        for line in test_lines:
+            accepted = prefilter.accept(line)
+            x = rsv_log_parse.parse_log_event(line, ip2a4, ip2a6, as_names, True, rsv_log_parse.first_pass_rr_types, \
+                rsv_log_parse.first_pass_experiment, set(query_ASes))
+            if x is not None and not accepted:
+                print("Prefilter drops:\n" + line)
+                passing = False
+        print(prefilter.stats())
+    return passing
+
+def slice_sums_test():
+    # slice_sums shall put the events in the same slices as get_slice_time,
+    # including events before the first time.
+    passing = True
+    query_times = [ 1730419200.5, 1730419199.25, 1730419500.0, 1730423000.75, 1730420000.0 ]
+    flags = [ 1, 0, 1, 1, 0 ]
+    query_ASes = [ "AS1", "AS2", "AS1", "AS1", "AS2" ]
+    for first_time in [ 1730419200, 1730419200.5 ]:
+        for slice_duration in [ 300, 3600 ]:
+            for query_AS in [ "", "AS1" ]:
+                expected = dict()
+                for i in range(0, len(query_times)):
+                    if len(query_AS) == 0 or query_ASes[i] == query_AS:
+                        slice_time = rsv_log_parse.get_slice_time(query_times[i], first_time, slice_duration)
+                        if not slice_time in expected:
+                            expected[slice_time] = [ 0, 0 ]
+                        expected[slice_time][0] += 1
+                        expected[slice_time][1] += flags[i]
+                slice_list, counts, sums = rsv_log_parse.slice_sums(query_times, first_time, slice_duration, \
+                    [ flags ], query_ASes=query_ASes, query_AS=query_AS)
+                got = dict()
+                for k in range(0, len(slice_list)):
+                    got[slice_list[k]] = [ counts[k], sums[0][k] ]
+                if got != expected or slice_list != sorted(expected.keys()):
+                    print("slice_sums(" + str(first_time) + ", " + str(slice_duration) + ", " + query_AS + ") returns " + str(got) + ", expected " + str(expected))
+                    passing = False
+    return passing
+
+def subnet_test():
+    # the subnet aggregator shall produce the same subnets as the
+    # ipaddress networks, whether the queries are added one at a time
+    # or in a batch.
+    passing = True
+    resolver_IPs = [ "172.217.37.19", "172.217.200.1", "8.8.8.8", \
+        "2001:56a:7636:6e00::2000:0", "2001:56a:76ff::1", "2001:56b::1", "172.217.37.19" ]
+    expected = dict()
+    for resolver_IP in resolver_IPs:
+        if ":" in resolver_IP:
+            subnet = str(ipaddress.IPv6Network(resolver_IP + "/40", strict=False))
+        else:
+            subnet = str(ipaddress.IPv4Network(resolver_IP + "/16", strict=False))
+        if not subnet in expected:
+            expected[subnet] = 0
+        expected[subnet] += 1
+    one_by_one = rsv_log_parse.subnet_aggregator()
+    for resolver_IP in resolver_IPs:
+        one_by_one.add("AU", "AS1221", "AS1221", resolver_IP)
+    batch = rsv_log_parse.subnet_aggregator()
+    n = len(resolver_IPs)
+    batch.add_many([ "AU" ]*n, [ "AS1221" ]*n, [ "AS1221" ]*n, resolver_IPs)
+    for aggregator in [ one_by_one, batch ]:
+        got = dict()
+        for row in aggregator.get_subnets():
+            got[row[3]] = row[4]
+        if got != expected:
+            print("subnets are " + str(got) + ", expected " + str(expected))
+            passing = False
+    return passing
+
+def downsample_test():
+    # the sample shall fit the budget, keep every resolver type, and keep
+    # the smallest and largest delays.
+    passing = True
+    rsv_types = [ "Same_AS" ]*20000 + [ "googlepdns" ]*5000 + [ "quad9" ]*10
+    nb_dots = len(rsv_types)
+    dot_df = pd.DataFrame({ 'rsv_type': rsv_types, 'rank': [ 1 ]*nb_dots, \
+        'first_time': [ 1730419200.0 + i for i in range(0, nb_dots) ], \
+        'delay': [ (i%1000)/1000.0 for i in range(0, nb_dots) ] }, columns=rsv_log_parse.dot_headers)
+    sample_df = rsv_log_parse.downsample_dots(dot_df, 1000)
+    if sample_df.shape[0] > 1300:
+        print("downsample_dots returns " + str(sample_df.shape[0]) + " dots, expected about 1000")
+        passing = False
+    for rsv in [ "Same_AS", "googlepdns", "quad9" ]:
+        sdf = dot_df[dot_df['rsv_type'] == rsv]
+        sample_sdf = sample_df[sample_df['rsv_type'] == rsv]
+        if sample_sdf['delay'].min() != sdf['delay'].min() or sample_sdf['delay'].max() != sdf['delay'].max():
+            print("downsample_dots does not keep the delay range of " + rsv)
+            passing = False
+    if rsv_log_parse.downsample_dots(dot_df, 0).shape[0] != nb_dots:
+        print("downsample_dots(0) does not keep all dots")
+        passing = False
+    return passing
+
+def merge_test():
+    # merging the records of two days shall give the same state as loading
+    # the events of both days, including for the UID that straddles midnight.
+    passing = True
+    day_events = [
+        [ [ 1730419190.0, "Same_AS", "u1", "10.0.0.1" ], [ 1730419195.0, "googlepdns", "u2", "8.8.8.8" ], \
+          [ 1730419199.5, "googlepdns", "u3", "8.8.8.8" ], [ 1730419199.75, "Same_AS", "u3", "10.0.1.1" ] ],
+        [ [ 1730419200.25, "cloudflare", "u3", "1.1.1.1" ], [ 1730419200.0, "Same_AS", "u3", "10.1.0.1" ], \
+          [ 1730419201.0, "Odd_tag", "u4", "9.9.9.9" ], [ 1730419202.0, "Same_AS", "u1", "10.0.0.2" ] ] ]
+    all_ppq = rsv_log_parse.pivoted_per_query()
+    merged_ppq = rsv_log_parse.pivoted_per_query()
+    for events in day_events:
+        day_ppq = rsv_log_parse.pivoted_per_query()
+        for x in events:
+            all_ppq.process_event(x[0], x[1], "AU", "AS1221", x[2], x[3], "AS1221")
+            day_ppq.process_event(x[0], x[1], "AU", "AS1221", x[2], x[3], "AS1221")
+        merged_ppq.merge(day_ppq)
+    all_ppq.compute_delta_t()
+    merged_ppq.compute_delta_t()
+    key_list = all_ppq.key_list()
+    if merged_ppq.key_list() != key_list:
+        print("merged keys are " + str(merged_ppq.key_list()) + ", expected " + str(key_list))
+        return False
+    if not merged_ppq.get_summaries(key_list, False).equals(all_ppq.get_summaries(key_list, False)):
+        print("merged summaries differ")
+        passing = False
+    for key in key_list:
+        if not merged_ppq.get_delta_t_both(key).equals(all_ppq.get_delta_t_both(key)):
+            print("merged delays differ for " + key)
+            passing = False
+    if not merged_ppq.get_subnets().equals(all_ppq.get_subnets()):
+        print("merged subnets differ")
+        passing = False
+    return passing
+
+def sampling_dups(seed, n_rand, n_uids, late_seed=None):
+    # each UID in AU/AS1221 gets queries from two resolver classes, and
+    # is therefore a duplicate.
+    logs = rsv_duplicates.detailed_log([ "AUAS1221", "AUAS7545" ])
+    if seed is not None:
+        logs.set_sampling(n_rand, [ "AUAS7545" ], 2, seed=seed)
+    for i in range(0, n_uids):
+        uid = "u" + str(i)
+        logs.add_query("AUAS1221", "A", "Same_AS", uid, 1730419200.0 + i, "10.0.0.1", "AS1221")
+        logs.add_query("AUAS1221", "A", "googlepdns", uid, 1730419200.5 + i, "8.8.8.8", "AS15169")
+    if late_seed is not None:
+        # sampling with other parameters after loading
+        logs.set_sampling(n_rand + 1, [ "AUAS7545" ], 2, seed=late_seed)
+    return list(logs.get_random_queries(n_rand, [ "AUAS7545" ], 2)['uid'])
+
+def sampling_test():
+    # the same seed gives the same sample, the sample size is capped, and
+    # all duplicates are returned if there are fewer than requested.
+    passing = True
+    first = sampling_dups(1234, 5, 200)
+    second = sampling_dups(1234, 5, 200)
+    if first != second:
+        print("Samples differ with the same seed: " + str(first) + ", " + str(second))
+        passing = False
+    if len(set(first)) != 5:
+        print("Sample of " + str(len(set(first))) + " UIDs, expected 5")
+        passing = False
+    few = sampling_dups(1234, 5, 3)
+    if sorted(set(few)) != [ "u0", "u1", "u2" ]:
+        print("Expected all 3 duplicates, got " + str(few))
+        passing = False
+    # when get_random_queries samples again, it reuses the seed
+    late_first = sampling_dups(None, 5, 200, late_seed=99)
+    late_second = sampling_dups(None, 5, 200, late_seed=99)
+    if late_first != late_second or len(set(late_first)) != 5:
+        print("Resampled samples differ with the same seed: " + str(late_first) + ", " + str(late_second))
+        passing = False
+    return passing
+
 # Main program
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         if not parse_test():
             print("test fails.")
             exit(-1)
+        if not cache_test():
+            print("cache test fails.")
+            exit(-1)
+        if not lean_test():
+            print("lean parser test fails.")
+            exit(-1)
+        if not prefilter_test():
+            print("prefilter test fails.")
+            exit(-1)
+        if not slice_sums_test():
+            print("slice sums test fails.")
+            exit(-1)
+        if not subnet_test():
+            print("subnet test fails.")
+            exit(-1)
+        if not downsample_test():
+            print("downsample test fails.")
+            exit(-1)
+        if not merge_test():
+            print("merge test fails.")
+            exit(-1)
+        if not sampling_test():
+            print("sampling test fails.")
+            exit(-1)
         frame_test()
     else:
         print("Usage: python rsv_log_test.py")
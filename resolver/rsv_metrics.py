@@ -0,0 +1,282 @@
+#
+# Single pass computation of the resolver metrics
+#
+# The scripts rsv_dups_metric.py, rsv_https_metric.py and rsv_cloud_metric.py
+# each read the same first pass files, and each build a list of UIDs. This
+# script reads each file once, builds a single per UID state with the
+# values needed by all three metrics, and then walks the list of UIDs once,
+# feeding every accumulator of every metric. It produces the same output
+# files as the three scripts.
+#
+
+import sys
+import os
+import time
+import numpy as np
+import ip2as
+import rsv_log_parse
+import rsv_arguments
+import rsv_dups_metric
+import rsv_https_metric
+import rsv_cloud_metric
+import rsv_checkpoint
+
+def usage():
+    print("Usage: python rsv_metrics.py [--checkpoint <dir>] <output_dir> [<list of AS] <csv_file> ... <csv_file>\n")
+    print("This script will load the csv files, and produce in <output_dir> the output files")
+    print("of rsv_dups_metric.py, rsv_https_metric.py and rsv_cloud_metric.py.")
+    print("Input files ending with .bz2 or .log are parsed directly as raw logs.")
+    print("With --checkpoint <dir>, the UIDs loaded from each file and the metrics are")
+    print("saved in <dir>, and reused in the next runs if the files did not change.")
+
+# The per UID state combines the duplicate_query, https_query and cloud_query
+# records, so that the accumulators of the three scripts can use it.
+class metric_query:
+    __slots__ = ('uid', 'query_time', 'query_AS', 'query_cc', 'records', \
+        'has_https', 'has_a', 'has_aaaa', 'has_https_isp', 'has_https_pdns', \
+        'cloud_AS', 'has_cloud', 'has_other')
+
+    def __init__(self, uid, query_time, query_AS, query_cc):
+        self.uid = uid
+        self.query_time = query_time
+        self.query_AS = query_AS
+        self.query_cc = query_cc
+        self.records = [ "", "", "" ]
+        self.has_https = False
+        self.has_a = False
+        self.has_aaaa = False
+        self.has_https_isp = False
+        self.has_https_pdns = False
+        self.cloud_AS = ""
+        self.has_cloud = False
+        self.has_other = False
+
+class metric_queries:
+    def __init__(self):
+        self.uid_list = dict()
+        self.dups_first_time = 0
+        self.https_first_time = 0
+
+    # add_query does the same updates as the add_query functions of
+    # duplicate_queries, https_queries and cloud_queries.
+    def add_query(self, uid, query_time, query_AS, query_cc, rr_type, resolver_tag, resolver_AS):
+        if self.dups_first_time == 0 or query_time < self.dups_first_time:
+            first_hour = int(query_time/3600)
+            self.dups_first_time = first_hour*3600
+        if self.https_first_time == 0 or self.https_first_time > query_time:
+            self.https_first_time = query_time
+
+        if not uid in self.uid_list:
+            self.uid_list[uid] = metric_query(uid, query_time, query_AS, query_cc)
+        event = self.uid_list[uid]
+        # duplicates, by resolver AS
+        if rr_type == 'HTTPS':
+            rr_rank = 0
+        elif rr_type == 'A':
+            rr_rank = 1
+        elif rr_type == 'AAAA':
+            rr_rank = 2
+        else:
+            rr_rank = -1
+        if rr_rank >= 0 and event.records[rr_rank] != resolver_AS:
+            if event.records[rr_rank] == "":
+                event.records[rr_rank] = resolver_AS
+            else:
+                event.records[rr_rank] = "*"
+        # https
+        if rr_type == 'HTTPS':
+            event.has_https = True
+            if resolver_tag in rsv_log_parse.tag_isp_set:
+                event.has_https_isp = True
+            elif resolver_tag in rsv_log_parse.tag_public_set:
+                event.has_https_pdns = True
+        elif rr_type == 'A':
+            event.has_a = True
+        elif rr_type == 'AAAA':
+            event.has_aaaa = True
+        # cloud
+        if resolver_tag == "Cloud":
+            event.has_cloud = True
+            event.cloud_AS = resolver_AS
+        else:
+            event.has_other = True
+
+    # get_arrays returns the arrays used by the add_arrays functions of
+    # the time slices of the three metrics, with one line per UID.
+    def get_arrays(self):
+        nb_uids = len(self.uid_list)
+        arrays = dict()
+        arrays['query_time'] = np.zeros(nb_uids)
+        arrays['query_AS'] = np.empty(nb_uids, dtype=object)
+        arrays['total'] = np.zeros((nb_uids, 3), dtype=np.int64)
+        arrays['dups'] = np.zeros((nb_uids, 3), dtype=np.int64)
+        for name in [ 'has_https', 'has_https_isp', 'has_https_pdns', 'has_cloud', 'has_other' ]:
+            arrays[name] = np.zeros(nb_uids, dtype=bool)
+        k = 0
+        for uid in self.uid_list:
+            event = self.uid_list[uid]
+            arrays['query_time'][k] = event.query_time
+            arrays['query_AS'][k] = event.query_AS
+            for i in range(0, 3):
+                if event.records[i] != "":
+                    arrays['total'][k,i] = 1
+                    if event.records[i] == "*":
+                        arrays['dups'][k,i] = 1
+            arrays['has_https'][k] = event.has_https
+            arrays['has_https_isp'][k] = event.has_https_isp
+            arrays['has_https_pdns'][k] = event.has_https_pdns
+            arrays['has_cloud'][k] = event.has_cloud
+            arrays['has_other'][k] = event.has_other
+            k += 1
+        return arrays
+
+    # load the input files
+    def load_csv_log(self, saved_file):
+        nb_events = 0
+        header_row = [ 'query_time', 'query_AS', 'query_cc', 'query_user_id', 'rr_type', 'resolver_tag', 'resolver_AS' ]
+        for row in rsv_log_parse.load_event_rows(saved_file, header_row):
+            self.add_query(row[3], float(row[0]), row[1], row[2], row[4], row[5], row[6])
+            nb_events += 1
+        return nb_events
+
+    # load the events parsed from a raw log, see rsv_log_parse.log_events
+    def load_log_events(self, events):
+        nb_events = 0
+        for x in events:
+            self.add_query(x.query_user_id, x.query_time, x.query_AS, x.query_cc, x.rr_type, x.resolver_tag, x.resolver_AS)
+            nb_events += 1
+        return nb_events
+
+# The engine holds a list of metrics. Each metric has a list of accumulators
+# (acc_list), each with an add_event function, and the functions
+# get_first_time, set_first_time and save. Other metrics can be added
+# to the list if they follow the same pattern.
+#
+# With a checkpoint store (see rsv_checkpoint.py), the metric_queries of
+# each file are saved as day checkpoints, and the metrics after the last
+# file as the total checkpoint. As in the scripts of each metric, the UIDs
+# of each file are counted separately: a UID with queries in two files,
+# for example just before and after midnight, counts once in each file.
+# Adding the slices of the files in the same order thus gives the same
+# metrics, whether the files are loaded or read from the checkpoints.
+class metric_engine:
+    def __init__(self, metrics):
+        self.set_metrics(metrics)
+        self.tables = None
+        self.store = None
+
+    def set_metrics(self, metrics):
+        self.metrics = metrics
+        self.acc_list = []
+        for metric in metrics:
+            self.acc_list += metric.acc_list
+
+    def set_checkpoint(self, checkpoint_dir, options=""):
+        self.store = rsv_checkpoint.checkpoint_store(checkpoint_dir, "metrics", options=options)
+
+    def load_file(self, file_name):
+        if self.store is not None:
+            mq = self.store.load_day(file_name)
+            if mq is not None:
+                print(file_name + ": read the checkpoint, " + str(len(mq.uid_list)) + " unique ids.")
+                return mq
+        mq = metric_queries()
+        if rsv_log_parse.is_raw_log(file_name):
+            if self.tables is None:
+                self.tables = ip2as.load_tables(ip2as.default_source_dir())
+            nb_events = mq.load_log_events(rsv_log_parse.first_pass_events(file_name, self.tables))
+        else:
+            nb_events = mq.load_csv_log(file_name)
+        print(file_name + ": " + str(nb_events) + " events, " + str(len(mq.uid_list)) + " unique ids.")
+        if self.store is not None:
+            self.store.save_day(file_name, mq)
+        return mq
+
+    # process_files loads the files and adds their slices. With a
+    # checkpoint store, the files covered by the total checkpoint are
+    # skipped.
+    def process_files(self, file_names):
+        nb_done = 0
+        if self.store is not None:
+            metrics, nb_done = self.store.load_total(file_names)
+            if metrics is not None:
+                self.set_metrics(metrics)
+                print("Loaded the checkpoint of " + str(nb_done) + " files.")
+        for file_name in file_names[nb_done:]:
+            mq = self.load_file(file_name)
+            self.add_slices(mq)
+        if self.store is not None:
+            if nb_done < len(file_names):
+                self.store.save_total(file_names, self.metrics)
+            print(self.store.stats())
+
+    # add_slices walks the list of UIDs once, for all accumulators that
+    # take one event at a time. The time slices, which have an add_arrays
+    # function, share the arrays computed once by get_arrays.
+    def add_slices(self, mq):
+        for metric in self.metrics:
+            if metric.first_time == 0:
+                metric.set_first_time(metric.get_first_time(mq))
+        event_list = []
+        array_list = []
+        for acc in self.acc_list:
+            if hasattr(acc, "add_arrays"):
+                array_list.append(acc)
+            else:
+                event_list.append(acc)
+        if len(array_list) > 0:
+            arrays = mq.get_arrays()
+            for acc in array_list:
+                acc.add_arrays(arrays)
+        for uid in mq.uid_list:
+            event = mq.uid_list[uid]
+            for acc in event_list:
+                acc.add_event(event)
+        print("Processed " + str(len(mq.uid_list)) + " events for " + str(len(self.acc_list)) + " accumulators.")
+
+    def save(self, output_dir):
+        for metric in self.metrics:
+            metric.save(output_dir)
+
+# Main program
+if __name__ == "__main__":
+    time_start = time.time()
+    if len(sys.argv) < 3:
+        usage()
+        exit(-1)
+
+    args = sys.argv[1:]
+    checkpoint_dir = ""
+    if "--checkpoint" in args:
+        i = args.index("--checkpoint")
+        if i + 1 >= len(args) or not os.path.isdir(args[i+1]):
+            print("Invalid checkpoint dir.")
+            usage()
+            exit(-1)
+        checkpoint_dir = args[i+1]
+        args = args[:i] + args[i+2:]
+    if len(args) < 2:
+        usage()
+        exit(-1)
+
+    output_dir = args[0]
+    if not os.path.isdir(output_dir):
+        print("Invalid output dir: " + output_dir)
+        usage()
+        exit(-1)
+
+    as_list = rsv_arguments.parse_AS_list(args[1:])
+    csv_files, has_error = rsv_arguments.parse_file_list(args[1 + len(as_list):], [ ".csv", rsv_log_parse.columnar_suffix ] + rsv_log_parse.raw_log_suffixes)
+    if has_error:
+        print("Invalid list of input files.")
+        usage()
+        exit(-1)
+
+    engine = metric_engine([ rsv_dups_metric.duplicate_metric(as_list), \
+        rsv_https_metric.https_metric(as_list), \
+        rsv_cloud_metric.cloud_metric(as_list) ])
+    if len(checkpoint_dir) > 0:
+        engine.set_checkpoint(checkpoint_dir, options=",".join(as_list))
+    engine.process_files(csv_files)
+    engine.save(output_dir)
+    print("Done in " + str(time.time() - time_start) + " seconds.")
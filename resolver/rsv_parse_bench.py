@@ -0,0 +1,130 @@
+# Parser microbenchmark.
+#
+# Compare the speed of the full parser (parse_line + row) and of the
+# lean parser (rsv_lean_parser), and verify that both return the same values.
+#
+# Usage: python rsv_parse_bench.py [<log_file> [<nb_lines>]]
+#
+# If no log file is specified, the benchmark uses the test lines from
+# rsv_log_test.py, repeated to make 200000 lines. These lines exercise the
+# unusual forms of query names, and about 40% of them take the fallback to
+# parse_line, much more than in real logs, so the speedup on all the lines
+# depends on the input. The lines are thus also measured in two groups:
+# those parsed directly by the lean parser, and those that fall back to
+# parse_line or are rejected.
+
+import sys
+import time
+import rsv_log_parse
+import rsv_log_test
+
+# Fields used by most of the second pass tools.
+bench_fields = [ 'query_time', 'resolver_IP', 'experiment_id', 'query_user_id', \
+    'query_cc', 'query_AS', 'rr_type' ]
+
+def usage():
+    print("Usage: python rsv_parse_bench.py [<log_file> [<nb_lines>]]")
+
+def load_lines(log_file, nb_lines):
+    lines = []
+    if len(log_file) == 0:
+        while len(lines) < nb_lines:
+            lines += rsv_log_test.test_lines
+        lines = lines[:nb_lines]
+    else:
+        F = rsv_log_parse.open_log(log_file)
+        for line in F:
+            lines.append(line)
+            if len(lines) >= nb_lines:
+                break
+        F.close()
+    return lines
+
+# split_lines returns the lines that the lean parser parses directly, and
+# the other lines.
+def split_lines(lines):
+    parser = rsv_log_parse.rsv_lean_parser()
+    fast_lines = []
+    other_lines = []
+    for line in lines:
+        nb_fast = parser.nb_fast
+        parser.parse(line)
+        if parser.nb_fast > nb_fast:
+            fast_lines.append(line)
+        else:
+            other_lines.append(line)
+    return fast_lines, other_lines
+
+def bench_full(lines, fields):
+    header = rsv_log_parse.rsv_log_line.header()
+    index = [header.index(f) for f in fields]
+    results = []
+    for line in lines:
+        x = rsv_log_parse.rsv_log_line()
+        if x.parse_line(line):
+            r = x.row()
+            results.append(tuple([r[i] for i in index]))
+        else:
+            results.append(None)
+    return results
+
+def bench_lean(lines, fields):
+    parser = rsv_log_parse.rsv_lean_parser(fields)
+    results = []
+    for line in lines:
+        results.append(parser.parse(line))
+    return results, parser
+
+# Each parser is timed nb_runs times, alternating, and the best time is
+# kept, which limits the noise.
+nb_runs = 3
+
+def run_bench(name, lines, fields):
+    if len(lines) == 0:
+        print(name + ": no lines.")
+        return True
+    full_time = None
+    lean_time = None
+    for run in range(0, nb_runs):
+        start = time.time()
+        full = bench_full(lines, fields)
+        elapsed = time.time() - start
+        if full_time is None or elapsed < full_time:
+            full_time = elapsed
+        start = time.time()
+        lean, parser = bench_lean(lines, fields)
+        elapsed = time.time() - start
+        if lean_time is None or elapsed < lean_time:
+            lean_time = elapsed
+    full_rate = len(lines)/max(full_time, 1e-9)
+    lean_rate = len(lines)/max(lean_time, 1e-9)
+    print(name + ": full " + str(int(full_rate)) + " lines/s, lean " + str(int(lean_rate)) + \
+        " lines/s, speedup " + "{:.2f}".format(lean_rate/full_rate) + \
+        " (" + str(parser.nb_fast) + " fast, " + str(parser.nb_fallback) + " fallback)")
+    if full != lean:
+        print("Lean parser results differ from parse_line + row()")
+        return False
+    return True
+
+# Main
+if __name__ == "__main__":
+    log_file = ""
+    nb_lines = 200000
+    if len(sys.argv) > 3:
+        usage()
+        exit(-1)
+    if len(sys.argv) > 1:
+        log_file = sys.argv[1]
+    if len(sys.argv) > 2:
+        nb_lines = int(sys.argv[2])
+    lines = load_lines(log_file, nb_lines)
+    print("Loaded " + str(len(lines)) + " lines.")
+    fast_lines, other_lines = split_lines(lines)
+    print(str(len(fast_lines)) + " lines parsed directly, " + str(len(other_lines)) + " fall back or are rejected.")
+    passing = True
+    for group, group_lines in [ [ "all lines", lines ], [ "fast path", fast_lines ], [ "fallback", other_lines ] ]:
+        passing &= run_bench(group + ", selected fields", group_lines, bench_fields)
+        passing &= run_bench(group + ", all fields", group_lines, rsv_log_parse.rsv_log_line.header())
+    if not passing:
+        exit(-1)
+    exit(0)
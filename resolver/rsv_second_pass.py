@@ -2,7 +2,7 @@
 #
 # Load a et of parsed APNIC traces and create graphs
 # 
-# Usage: python rsv_second_pass.py <output_dir> <csv_file> ... <csv_file>
+# Usage: python rsv_second_pass.py [--workers N] [--max-points N] [--checkpoint <dir>] [--shards N] <output_dir> <csv_file> ... <csv_file>
 
 import sys
 import os
@@ -15,13 +15,226 @@ import traceback
 import top_as
 import time
 import csv
+import concurrent.futures
+import matplotlib.pyplot as plt
+import rsv_first_pass
+import rsv_checkpoint
+import zlib
+import pickle
+import tempfile
 
 def usage():
-    print("Usage: python rsv_second_pass.py <image_dir> <output_dir> <csv_file> ... <csv_file>\n")
+    print("Usage: python rsv_second_pass.py [--workers N] [--max-points N] [--checkpoint <dir>] [--shards N] <image_dir> <output_dir> <csv_file> ... <csv_file>\n")
     print("This script will load the csv files,")
+    print("(or parse directly the raw log files ending with .bz2 or .log)")
     print("and write plot and histogram images in the specied image directory.")
     print("If willretains all ASes with more than 1000 UIDs.")
-    
+    print("With --workers N, the graphs are drawn by N processes.")
+    print("With --max-points N, the delay plots show a sample of at most about N dots.")
+    print("With --checkpoint <dir>, the state loaded from each file is saved in <dir>,")
+    print("and reused in the next runs if the file did not change.")
+    print("With --shards N, the events are split by CC+AS between N processes.")
+
+# Loading of the files, with or without checkpoints.
+#
+# Without checkpoints, all files are loaded in the same pivoted_per_query.
+# With checkpoints, each file is loaded in its own pivoted_per_query, which
+# is saved as a day checkpoint and merged in the total. The merge gives the
+# same state as loading the files one after the other.
+
+def load_file(ppq, csv_file, tables, time_start):
+    if rsv_log_parse.is_raw_log(csv_file):
+        # parse the raw log directly, without the first pass csv file
+        if tables[0] is None:
+            tables[0] = ip2as.load_tables(ip2as.default_source_dir())
+        nb_events_in_file = ppq.load_events(rsv_log_parse.first_pass_events(csv_file, tables[0]), time_start=time_start)
+    else:
+        nb_events_in_file = ppq.load_csv_log(csv_file)
+    print("Read " + str(nb_events_in_file) + " from " + csv_file + " at " + str(time.time() - time_start) + " seconds.")
+
+def load_files(csv_files, checkpoint_dir, time_start):
+    tables = [ None ]
+    if len(checkpoint_dir) == 0:
+        ppq = rsv_log_parse.pivoted_per_query()
+        for csv_file in csv_files:
+            load_file(ppq, csv_file, tables, time_start)
+        return ppq
+    store = rsv_checkpoint.checkpoint_store(checkpoint_dir, "second_pass")
+    ppq, nb_done = store.load_total(csv_files)
+    if ppq is None:
+        ppq = rsv_log_parse.pivoted_per_query()
+    else:
+        print("Loaded the checkpoint of " + str(nb_done) + " files at " + str(time.time() - time_start) + " seconds.")
+    for csv_file in csv_files[nb_done:]:
+        day_ppq = store.load_day(csv_file)
+        if day_ppq is None:
+            day_ppq = rsv_log_parse.pivoted_per_query()
+            load_file(day_ppq, csv_file, tables, time_start)
+            store.save_day(csv_file, day_ppq)
+        else:
+            print("Read the checkpoint of " + csv_file + " at " + str(time.time() - time_start) + " seconds.")
+        ppq.merge(day_ppq)
+    if nb_done < len(csv_files):
+        store.save_total(csv_files, ppq)
+    print(store.stats())
+    return ppq
+
+# Key sharded processing.
+#
+# The state of the second pass is partitioned by CC+AS. With --shards N,
+# the coordinator reads each file once, and writes the events of each CC+AS
+# in the partition file of the shard given by the hash of the CC+AS (crc32,
+# which unlike hash() does not change between processes). The events are
+# written in batches with pickle, which keeps the values as loaded, in the
+# order of the input. Each of the N processes loads only its partition,
+# computes the delays, summaries, subnets and graph dots of its CC+AS, and
+# returns them. The coordinator knows the index of the first event of each
+# CC+AS in the input, and sorts the CC+AS by that index, which is the order
+# of pivoted_per_query.key_list in a single process, so the output files
+# are the same. It also counts all the events, which sets the threshold
+# for the graphs.
+
+partition_batch_size = 10000
+
+def key_shard(key, nb_shards):
+    return zlib.crc32(key.encode("utf-8")) % nb_shards
+
+def write_partitions(csv_files, nb_shards, partition_dir, time_start):
+    partition_files = []
+    outputs = []
+    batches = []
+    for shard in range(0, nb_shards):
+        partition_files.append(os.path.join(partition_dir, "shard-" + str(shard) + ".pickle"))
+        outputs.append(open(partition_files[shard], "wb"))
+        batches.append([])
+    tables = None
+    shard_of = dict()
+    first_seen = dict()
+    nb_events = 0
+    for csv_file in csv_files:
+        if rsv_log_parse.is_raw_log(csv_file) and tables is None:
+            tables = ip2as.load_tables(ip2as.default_source_dir())
+        for x in rsv_log_parse.event_tuples(csv_file, tables):
+            key = str(x[2]) + str(x[3])
+            if not key in shard_of:
+                shard_of[key] = key_shard(key, nb_shards)
+                first_seen[key] = nb_events
+            shard = shard_of[key]
+            batches[shard].append(x)
+            if len(batches[shard]) >= partition_batch_size:
+                pickle.dump(batches[shard], outputs[shard], protocol=pickle.HIGHEST_PROTOCOL)
+                batches[shard] = []
+            nb_events += 1
+        print("Partitioned " + csv_file + " at " + str(time.time() - time_start) + " seconds.")
+    for shard in range(0, nb_shards):
+        if len(batches[shard]) > 0:
+            pickle.dump(batches[shard], outputs[shard], protocol=pickle.HIGHEST_PROTOCOL)
+        outputs[shard].close()
+    return partition_files, first_seen, nb_events
+
+def partition_events(partition_file):
+    with open(partition_file, "rb") as F:
+        while True:
+            try:
+                batch = pickle.load(F)
+            except EOFError:
+                break
+            for x in batch:
+                yield x
+
+def process_shard(shard_job):
+    partition_file, shard, nb_events, output_dir, max_points = shard_job
+    ppq = rsv_log_parse.pivoted_per_query()
+    for x in partition_events(partition_file):
+        ppq.process_event(*x)
+    ppq.compute_delta_t()
+    target_threshold = get_target_threshold(nb_events)
+    results = []
+    for key in ppq.key_list():
+        results.append([ key, ppq.cc_AS_list[key].get_summary(False), \
+            ppq.cc_AS_list[key].get_subnets(), \
+            get_graph_job(ppq, key, target_threshold, output_dir, max_points) ])
+    print("Shard " + str(shard) + ": " + str(len(results)) + " CC+AS, " + str(ppq.nb_events()) + " of " + str(nb_events) + " events.")
+    return results
+
+def process_shards(csv_files, nb_shards, output_dir, max_points, time_start):
+    results = []
+    with tempfile.TemporaryDirectory(dir=output_dir) as partition_dir:
+        partition_files, first_seen, nb_events = write_partitions(csv_files, nb_shards, partition_dir, time_start)
+        shard_jobs = []
+        for shard in range(0, nb_shards):
+            shard_jobs.append((partition_files[shard], shard, nb_events, output_dir, max_points))
+        with concurrent.futures.ProcessPoolExecutor(max_workers = nb_shards) as executor:
+            for shard_result in executor.map(process_shard, shard_jobs):
+                for result in shard_result:
+                    results.append([ first_seen[result[0]] ] + result)
+    results.sort(key=lambda x: x[0])
+    return nb_events, results
+
+# Graph rendering.
+#
+# Each qualifying CC+AS produces a plot and a histogram. The graphs do not
+# depend on each other, so they can be drawn by a pool of processes, each
+# using the non interactive "Agg" backend. The main process computes the
+# dots and downsamples those used by the plot before sending them, which
+# limits the size of the jobs. The histogram uses all the non zero delays.
+
+def init_render_worker():
+    plt.switch_backend("Agg")
+
+def render_graphs(job):
+    key, plot_df, hist_df, output_dir = job
+    plot_delay_file = os.path.join(output_dir, key[:2] + "_" + key[2:] + "_plot_delays" )
+    rsv_log_parse.do_graph(key, plot_df, plot_delay_file, x_delay=True, log_y=True)
+    host_delay_files = os.path.join(output_dir,  key[:2] + "_" + key[2:] + "_hist_delays" )
+    rsv_log_parse.do_hist(key, hist_df, image_file=host_delay_files)
+    return key
+
+# Based on the number of event, we set a threshold on the number of "both" events
+# required to start the delay analysis and the graphs. The tests in practice recognizes
+# if we are running with a test file, and lowers the threshold so that we can
+# exercise the code, event if there are few points per graph.
+def get_target_threshold(nb_events):
+    target_threshold = 1000
+    if nb_events < 100000:
+        target_threshold = 30
+    return target_threshold
+
+# get_graph_job returns the graph job of a CC+AS that has enough UIDs
+# served by both ISP and public resolvers, or by ISP and other resolvers,
+# or None for the other CC+AS.
+def get_graph_job(ppq, key, target_threshold, output_dir, max_points):
+    if ppq.cc_AS_list[key].nb_both  > target_threshold or \
+       (ppq.cc_AS_list[key].nb_others > target_threshold and ppq.cc_AS_list[key].nb_isp > target_threshold):
+        # collect table, one row per event
+        dot_df = ppq.get_delta_t_both(key)
+        dot_df_nz = dot_df[dot_df['delay'] > 0]
+        if dot_df_nz.shape[0] > 0:
+            return (key, rsv_log_parse.downsample_dots(dot_df, max_points), dot_df_nz, output_dir)
+    return None
+
+def get_graph_jobs(ppq, key_list, target_threshold, output_dir, max_points):
+    for key in key_list:
+        job = get_graph_job(ppq, key, target_threshold, output_dir, max_points)
+        if job is not None:
+            yield job
+
+def publish_graphs(jobs, nb_workers=1):
+    nb_published = 0
+    if nb_workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = nb_workers, initializer=init_render_worker) as executor:
+            for key in rsv_first_pass.bounded_map(executor, render_graphs, jobs, 2*nb_workers):
+                nb_published += 1
+                if (nb_published%100) == 0:
+                    print("Published " + str(nb_published) + " AS graphs")
+    else:
+        for job in jobs:
+            render_graphs(job)
+            nb_published += 1
+            if (nb_published%100) == 0:
+                print("Published " + str(nb_published) + " AS graphs")
+    return nb_published
+
 
 # Main program
 if __name__ == "__main__":
@@ -30,50 +243,88 @@ if __name__ == "__main__":
         usage()
         exit(-1)
 
-    output_dir = sys.argv[1]
-    csv_files = sys.argv[2:]
+    args = sys.argv[1:]
+    nb_workers = 1
+    max_points = 0
+    checkpoint_dir = ""
+    nb_shards = 1
+    for option in [ "--workers", "--max-points", "--checkpoint", "--shards" ]:
+        if option in args:
+            i = args.index(option)
+            if i + 1 >= len(args):
+                usage()
+                exit(-1)
+            if option == "--checkpoint":
+                checkpoint_dir = args[i+1]
+                if not os.path.isdir(checkpoint_dir):
+                    print("Invalid checkpoint dir: " + checkpoint_dir)
+                    usage()
+                    exit(-1)
+            elif not args[i+1].isdigit():
+                usage()
+                exit(-1)
+            elif option == "--workers":
+                nb_workers = max(1, int(args[i+1]))
+            elif option == "--shards":
+                nb_shards = max(1, int(args[i+1]))
+            else:
+                max_points = int(args[i+1])
+            args = args[:i] + args[i+2:]
+    if len(args) < 2:
+        usage()
+        exit(-1)
+    output_dir = args[0]
+    csv_files = args[1:]
+    if nb_shards > 1 and len(checkpoint_dir) > 0:
+        print("The options --shards and --checkpoint cannot be used together.")
+        usage()
+        exit(-1)
 
     # Load files that have been parsed in the first pass
     #
-    ppq = rsv_log_parse.pivoted_per_query()
-    nb_events = 0
-    for csv_file in csv_files:
-        nb_events_in_file = ppq.load_csv_log(csv_file)
-        print("Read " + str(nb_events_in_file) + " from " + csv_file + " at " + str(time.time() - time_start) + " seconds.")
-        nb_events += nb_events_in_file
+    if nb_shards > 1:
+        nb_events, results = process_shards(csv_files, nb_shards, output_dir, max_points, time_start)
+        print("Loaded " + str(len(results)) + " CC+AS with " + str(nb_events) + " events in " + str(nb_shards) + " shards at " + str(time.time() - time_start) + " seconds.")
+        key_list = []
+        s_list = []
+        sn = []
+        graph_jobs = []
+        for result in results:
+            key_list.append(result[1])
+            s_list.append(result[2])
+            sn += result[3]
+            if result[4] is not None:
+                graph_jobs.append(result[4])
+        summary_df = rsv_log_parse.summaries_df(s_list)
+        subnet_df = pd.DataFrame(sn, columns=rsv_log_parse.subnet_record.headers())
+    else:
+        ppq = load_files(csv_files, checkpoint_dir, time_start)
+        nb_events = ppq.nb_events()
 
-    print("Loaded " + str(len(ppq.cc_AS_list)) + " CC+AS with " + str(nb_events) + " events at " + str(time.time() - time_start) + " seconds.")
+        print("Loaded " + str(len(ppq.cc_AS_list)) + " CC+AS with " + str(nb_events) + " events at " + str(time.time() - time_start) + " seconds.")
 
-    # Based on the number of event, we set a threshold on the number of "both" events
-    # required to start the delay analysis and the graphs. The tests in practice recognizes
-    # if we are running with a test file, and lowers the threshold so that we can
-    # exercise the code, event if there are few points per graph.
-    target_threshold = 1000
-    if nb_events < 100000:
-        target_threshold = 30
+        # Once all events have been loaded, we compute for each UID the delay between the
+        # arrival of the first event for that UID and the arrival of the first event in
+        # each of the categories of resolvers.
+        ppq.compute_delta_t()
+        time_delays_computed = time.time()
+        print("Delays computed at " + str(time_delays_computed - time_start) + " seconds.")
 
-    # Once all events have been loaded, we compute for each UID the delay between the
-    # arrival of the first event for that UID and the arrival of the first event in
-    # each of the categories of resolvers.
-    ppq.compute_delta_t()
-    time_delays_computed = time.time()
-    print("Delays computed at " + str(time_delays_computed - time_start) + " seconds.")
-
-    # We prepare the graphs for all qualifying ASes
-    key_list = ppq.key_list()
-        
-    # get the summaries per cc + AS
-    summary_df = ppq.get_summaries(key_list, False);
+        # We prepare the graphs for all qualifying ASes
+        key_list = ppq.key_list()
+        summary_df = ppq.get_summaries(key_list, False)
+        subnet_df = ppq.get_subnets()
+        graph_jobs = get_graph_jobs(ppq, key_list, get_target_threshold(nb_events), output_dir, max_points)
+
+    # publish the summaries per cc + AS
     summary_file = os.path.join(output_dir, "summary.csv" )
     summary_df.to_csv(summary_file, sep=",")
 
-
     print("Published summaries for " + str(len(key_list)) + " CC+AS" + " in " + summary_file)
     time_summaries_computed = time.time()
     print("Summaries computed at " + str(time_summaries_computed - time_start) + " seconds.")
 
-    # get the subnets used for each AS
-    subnet_df = ppq.get_subnets()
+    # publish the subnets used for each AS
     subnet_file = os.path.join(output_dir, "subnets.csv" )
     subnet_df.to_csv(subnet_file, sep=",")
     print("Published statistics for " + str(subnet_df.shape[0]) + " subnets" + " in " + subnet_file)
@@ -82,25 +333,9 @@ if __name__ == "__main__":
 
     # Analyse the spread of delays for the AS that have a sufficient share of UID with events
     # from both ISP resolvers and public resolvers. 
-    nb_published = 0
-    for key in key_list:
-        if ppq.cc_AS_list[key].nb_both  > target_threshold or \
-           (ppq.cc_AS_list[key].nb_others > target_threshold and ppq.cc_AS_list[key].nb_isp > target_threshold):
-            # collect table, one row per event
-            dot_df = ppq.get_delta_t_both(key)
-            dot_df_nz = dot_df[dot_df['delay'] > 0]
-            if dot_df_nz.shape[0] > 0:
-                plot_delay_file = os.path.join(output_dir, key[:2] + "_" + key[2:] + "_plot_delays" )
-                rsv_log_parse.do_graph(key, dot_df, plot_delay_file, x_delay=True, log_y=True)
-                host_delay_files = os.path.join(output_dir,  key[:2] + "_" + key[2:] + "_hist_delays" )
-                rsv_log_parse.do_hist(key, dot_df_nz, image_file=host_delay_files)
-                nb_published += 1
-            if (nb_published%100) == 0:
-                print("Published " + str(nb_published) + " AS graphs")
+    nb_published = publish_graphs(graph_jobs, nb_workers=nb_workers)
     print("Done publishing " + str(nb_published) + " AS graphs")
     time_finished = time.time()
     print("Finished at " + str(time_finished - time_start) + " seconds.")
 
     exit(0)
-
-
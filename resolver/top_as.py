@@ -540,8 +540,36 @@ class known_AS_names:
         for asn in TopAS:
             as_entry = TopAS[asn]
             self.as_names[asn] = as_entry[0]
+        self.fetcher = None
         print("Started with: " + str(len(self.as_names)) + " names.")
 
+    # With a fetcher (see rdap_names.rdap_fetcher), the names are looked up
+    # in the RDAP cache, and fetched concurrently by prefetch.
+    def set_fetcher(self, fetcher):
+        self.fetcher = fetcher
+
+    def get_region(self, cc):
+        if cc in country.cc_to_region:
+            region = country.cc_to_region[cc]
+        else:
+            region = 'EUR'
+        return region
+
+    # prefetch takes a list of [ asn, cc, as_name ] and fetches the names
+    # that are not known yet, in one batch.
+    def prefetch(self, requests):
+        if self.fetcher is None:
+            return
+        missing = []
+        for asn, cc, as_name in requests:
+            if not asn in self.as_names:
+                missing.append([ self.get_region(cc), asn, as_name ])
+        results = self.fetcher.get_names(missing)
+        for asn in results:
+            if results[asn][0]:
+                self.as_names[asn] = results[asn][1]
+        print("Prefetched " + str(len(results)) + " names. " + self.fetcher.stats())
+
     def process_row(self, x, headers=['asn', 'as_name', 'has_name'] ):
         if (headers[0] in x) and (headers[1] in x) and (headers[2] in x) and (x[headers[2]] == True):
             if not x[headers[0]] in self.as_names:
@@ -551,7 +579,13 @@ class known_AS_names:
         print("Loading: " + file_name)
         df = pd.read_csv(file_name)
         print("Loaded: " + file_name)
-        df.apply(lambda x: self.process_row(x), axis=1)
+        # same as process_row for each row, with a mask of the named AS
+        headers = ['asn', 'as_name', 'has_name']
+        if headers[0] in df.columns and headers[1] in df.columns and headers[2] in df.columns:
+            named = (df[headers[2]] == True).fillna(False).astype(bool)
+            for asn, as_name in zip(df.loc[named, headers[0]].tolist(), df.loc[named, headers[1]].tolist()):
+                if not asn in self.as_names:
+                    self.as_names[asn] = as_name
         print("Loaded: " + str(len(self.as_names)) + " names.")
 
     def get_name(self, asn, cc, as_name):
@@ -560,11 +594,11 @@ class known_AS_names:
             success = True
             as_name = self.as_names[asn]
         else:
-            if cc in country.cc_to_region:
-                region = country.cc_to_region[cc]
+            region = self.get_region(cc)
+            if self.fetcher is not None:
+                success, as_name = self.fetcher.get_name(region, asn, as_name)
             else:
-                region = 'EUR'
-            success, as_name = rdap_names.get_as_name_by_region(region, asn, as_name)
+                success, as_name = rdap_names.get_as_name_by_region(region, asn, as_name)
             if success:
                 self.as_names[asn] = as_name
         return success, as_name
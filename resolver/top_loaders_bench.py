@@ -0,0 +1,136 @@
+# Top file loaders benchmark.
+#
+# Compare the speed of the loaders of get_top_resolvers.py and top_as.py
+# with the previous implementation, which called process_row for each row
+# with DataFrame.apply, and verify that both build the same state.
+#
+# Usage: python top_loaders_bench.py [<nb_rows>]
+#
+# The benchmark writes synthetic files of <nb_rows> rows (1000000 by
+# default) in a temporary directory.
+
+import sys
+import os
+import time
+import random
+import tempfile
+import pandas as pd
+import get_top_resolvers
+import top_as
+
+def usage():
+    print("Usage: python top_loaders_bench.py [<nb_rows>]")
+
+# The count file has the columns of resolver_list.export_df, the top file
+# those of resolver_list.export_top, and the AS file those of the top AS
+# lists loaded by known_AS_names.load_top_as.
+def write_files(temp_dir, nb_rows):
+    rng = random.Random(1234)
+    ccs = [ "US", "BR", "IN", "FR", "JP", "", "ZZ" ]
+    rows = []
+    for i in range(0, nb_rows):
+        rows.append([ "AS" + str(rng.randrange(2000)), rng.choice(ccs), "AS" + str(rng.randrange(20000)), rng.randrange(1, 1000) ])
+    count_file = os.path.join(temp_dir, "counts.csv")
+    pd.DataFrame(rows, columns=get_top_resolvers.resolver_cc_as.headers()).to_csv(count_file)
+    rows = []
+    resolver_AS = ""
+    for i in range(0, nb_rows):
+        if i%50 == 0:
+            resolver_AS = "AS" + str(i)
+            rows.append([ resolver_AS, "US", "total", rng.randrange(1000, 100000), "NAME-" + resolver_AS, rng.random() < 0.8 ])
+        else:
+            query_AS = "AS" + str(rng.randrange(20000))
+            rows.append([ resolver_AS, rng.choice(ccs[:5]), query_AS, rng.randrange(1, 1000), "NAME-" + query_AS, rng.random() < 0.8 ])
+    top_file = os.path.join(temp_dir, "top.csv")
+    pd.DataFrame(rows, columns=get_top_resolvers.resolver_cc_as.top_headers()).to_csv(top_file)
+    rows = []
+    for i in range(0, nb_rows):
+        asn = "AS" + str(rng.randrange(4*nb_rows))
+        rows.append([ rng.choice(ccs[:5]), asn, "NAME-" + asn, rng.random() < 0.5 ])
+    as_file = os.path.join(temp_dir, "top_as.csv")
+    pd.DataFrame(rows, columns=[ 'CC', 'asn', 'as_name', 'has_name' ]).to_csv(as_file)
+    return count_file, top_file, as_file
+
+def resolver_list_state(r_list):
+    state = [ r_list.sum_total ]
+    for resolver_AS in r_list.resolvers:
+        r = r_list.resolvers[resolver_AS]
+        state.append([ resolver_AS, [ [ key, r.r_cc_AS[key].query_cc, r.r_cc_AS[key].query_AS, r.r_cc_AS[key].count ] for key in r.r_cc_AS ] ])
+    return state
+
+def top_list_state(top_list):
+    state = []
+    for resolver_AS in top_list.top_list:
+        state.append(top_list.top_list[resolver_AS].top_rows())
+    return state
+
+def run_bench(name, old_load, new_load, get_state):
+    start = time.time()
+    old_loaded = old_load()
+    old_time = time.time() - start
+    start = time.time()
+    new_loaded = new_load()
+    new_time = time.time() - start
+    old_state = get_state(old_loaded)
+    new_state = get_state(new_loaded)
+    print(name + ": apply " + "{:.2f}".format(old_time) + " s, vectorized " + "{:.2f}".format(new_time) + \
+        " s, speedup " + "{:.1f}".format(old_time/max(new_time, 1e-9)))
+    if old_state != new_state:
+        print(name + ": the states differ.")
+        return False
+    return True
+
+def old_resolver_list(count_file):
+    r_list = get_top_resolvers.resolver_list()
+    df = pd.read_csv(count_file)
+    df.apply(lambda x: r_list.process_row(x), axis=1)
+    return r_list
+
+def new_resolver_list(count_file):
+    r_list = get_top_resolvers.resolver_list()
+    r_list.load_file(count_file)
+    return r_list
+
+def old_top_list(top_file):
+    top_list = get_top_resolvers.top_resolvers_list()
+    df = pd.read_csv(top_file)
+    df.apply(lambda x: top_list.process_row(x), axis=1)
+    return top_list
+
+def new_top_list(top_file):
+    top_list = get_top_resolvers.top_resolvers_list()
+    top_list.load_file(top_file)
+    return top_list
+
+def old_known_names(as_file):
+    names = top_as.known_AS_names()
+    df = pd.read_csv(as_file)
+    df.apply(lambda x: names.process_row(x), axis=1)
+    return names
+
+def new_known_names(as_file):
+    names = top_as.known_AS_names()
+    names.load_top_as(as_file)
+    return names
+
+# Main
+if __name__ == "__main__":
+    nb_rows = 1000000
+    if len(sys.argv) > 2:
+        usage()
+        exit(-1)
+    if len(sys.argv) > 1:
+        nb_rows = int(sys.argv[1])
+    passing = True
+    with tempfile.TemporaryDirectory() as temp_dir:
+        count_file, top_file, as_file = write_files(temp_dir, nb_rows)
+        print("Wrote files of " + str(nb_rows) + " rows.")
+        passing &= run_bench("resolver_list", lambda: old_resolver_list(count_file), \
+            lambda: new_resolver_list(count_file), resolver_list_state)
+        passing &= run_bench("top_resolvers_list", lambda: old_top_list(top_file), \
+            lambda: new_top_list(top_file), top_list_state)
+        passing &= run_bench("known_AS_names", lambda: old_known_names(as_file), \
+            lambda: new_known_names(as_file), lambda x: list(x.as_names.items()))
+    if not passing:
+        exit(-1)
+    exit(0)
@@ -0,0 +1,42 @@
+# UID counting test.
+# verify that the exact sets count exactly, and that the HyperLogLog
+# sketches stay within the documented error bounds.
+
+import uid_hll
+
+def check_estimate(name, value, expected, tolerance):
+    if abs(value - expected) > tolerance*expected:
+        print(name + " returns " + str(value) + ", expected " + str(expected) + " +- " + str(int(100*tolerance)) + "%")
+        return False
+    return True
+
+def uid_test(approximate, nb_uids, tolerance):
+    a = uid_hll.new_uid_set(approximate)
+    b = uid_hll.new_uid_set(approximate)
+    # a has uids 0 to n-1, b has uids n/2 to 3n/2 - 1, each added twice.
+    for i in range(0, nb_uids):
+        a.add("u" + hex(i))
+        a.add("u" + hex(i))
+        b.add("u" + hex(nb_uids//2 + i))
+    passing = check_estimate("count(" + str(nb_uids) + ")", a.count(), nb_uids, tolerance)
+    passing &= check_estimate("union_count(" + str(nb_uids) + ")", a.union_count(b), nb_uids + nb_uids//2, tolerance)
+    passing &= check_estimate("intersection_count(" + str(nb_uids) + ")", a.intersection_count(b), nb_uids - nb_uids//2, 3*tolerance)
+    a.merge(b)
+    passing &= check_estimate("merge(" + str(nb_uids) + ")", a.count(), nb_uids + nb_uids//2, tolerance)
+    return passing
+
+if __name__ == "__main__":
+    passing = True
+    for nb_uids in [ 1, 50, 1000 ]:
+        passing &= uid_test(False, nb_uids, 0.0)
+    # small sets are counted exactly
+    passing &= uid_test(True, 40, 0.0)
+    # 4 standard errors at precision 12 (1.6%)
+    for nb_uids in [ 1000, 20000, 200000 ]:
+        passing &= uid_test(True, nb_uids, 0.065)
+    if not passing:
+        print("Fail.")
+        exit(-1)
+    else:
+        print("Success.")
+        exit(0)
@@ -22,6 +22,7 @@ import concurrent.futures
 import os
 from os import listdir
 from os.path import isfile, isdir, join
+import imrs_merge
 
 def collect_cluster_dates(clusters, cluster_id, instance_folder, month, datemax):
     dates = dict()
@@ -75,9 +76,11 @@ def check_or_create_dir(dir_path):
             return False
     return True
 
-def process_cluster(cluster_id, result_folder, tmp_folder, ithitool, dates, do_debug):
+# cluster_tasks returns the merge tasks of the cluster, one per date for
+# which the cluster file is not yet computed.
+def cluster_tasks(cluster_id, result_folder, tmp_folder, dates, do_debug):
+    tasks = []
     cluster_folder = join(result_folder, cluster_id)
-    dates = clusters[cluster_id]
     if check_or_create_dir(cluster_folder):
         for one_date in dates:
             file_list = dates[one_date]
@@ -90,60 +93,53 @@ def process_cluster(cluster_id, result_folder, tmp_folder, ithitool, dates, do_d
             elif len(file_list) == 0:
                 if do_debug:
                     print(report_name + ": no cbor file.")
-            elif len(file_list) == 1:
-                cp_cmd = "cp " + file_list[0] + " " + ipstats_file
-                cp_ret = os.system(cp_cmd)
-                if cp_ret == 0:
-                    if do_debug:
-                        print(report_name + " copied.")
-                else:
-                    print(report_name + " copy failed, error:" + str(cp_ret))
-                    return False
             else:
                 tmp_file_name = cluster_id + "-" + one_date + ".txt"
                 tmp_file = join(tmp_folder, tmp_file_name)
-                with open(tmp_file_name,"wt") as F:
-                     for file_name in file_list:
-                         F.write(file_name + "\n")
-                merge_cmd = ithitool + ' -I ' + ipstats_file + " " + tmp_file_name
-                cmd_ret = os.system(merge_cmd)
-                if cmd_ret == 0:
-                    if do_debug:
-                        print(report_name + ": computed.")
-                else:
-                    print(report_name + ": computation failed, error:" + str(cmd_ret))
-                    return False
-    return True
-
-# main
-if len(sys.argv) < 5 or len(sys.argv) > 6 or \
-    (len(sys.argv) == 6 and sys.argv[5] != "debug"):
-    print("Usage: imrs_cluster <ipstats_folder> <yyyymm> <last_day> <ithitool> ")
-    print("There are just " + str(len(sys.argv)) + " arguments.")
-    exit (1)
-ipstats_folder = sys.argv[1]
-month = sys.argv[2]
-datemax = sys.argv[3]
-ithitool = sys.argv[4]
-do_debug = len(sys.argv) == 6
-
-print("Writing clusters for: " + ipstats_folder)
-try:
-    clusters = prepare_cluster_list(ipstats_folder, month, datemax)
-    result_folder = join(ipstats_folder, "clusters")
-    tmp_folder = join(ipstats_folder, "tmp")
-    if check_or_create_dir(result_folder) and \
-       check_or_create_dir(tmp_folder):
-        for cluster_id in clusters:
-            dates = clusters[cluster_id]
-            if len(dates) > 0:
-                if not process_cluster(cluster_id, result_folder, tmp_folder, ithitool, dates, do_debug):
-                    exit(1)
-except Exception as exc:
-   traceback.print_exc()
-   print('\nCode generated an exception: %s' % (exc))
-
-
+                tasks.append(imrs_merge.merge_task(report_name, ipstats_file, file_list, tmp_file, copy_single=True))
+    return tasks
 
+def usage():
+    print("Usage: imrs_cluster [--workers N] <ipstats_folder> <yyyymm> <last_day> <ithitool | native> [debug]")
+    print("With \"native\", the files are merged by imrs_merge.py instead of ithitools.")
+    print("The merges run in N processes, by default one per core.")
 
+# main
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    nb_workers = os.cpu_count()
+    if "--workers" in args:
+        i = args.index("--workers")
+        if i + 1 >= len(args) or not args[i+1].isdigit() or int(args[i+1]) < 1:
+            usage()
+            exit(1)
+        nb_workers = int(args[i+1])
+        args = args[:i] + args[i+2:]
+    if len(args) < 4 or len(args) > 5 or \
+        (len(args) == 5 and args[4] != "debug"):
+        usage()
+        print("There are just " + str(len(sys.argv)) + " arguments.")
+        exit (1)
+    ipstats_folder = args[0]
+    month = args[1]
+    datemax = args[2]
+    ithitool = args[3]
+    do_debug = len(args) == 5
 
+    print("Writing clusters for: " + ipstats_folder)
+    try:
+        clusters = prepare_cluster_list(ipstats_folder, month, datemax)
+        result_folder = join(ipstats_folder, "clusters")
+        tmp_folder = join(ipstats_folder, "tmp")
+        if check_or_create_dir(result_folder) and \
+           check_or_create_dir(tmp_folder):
+            tasks = []
+            for cluster_id in clusters:
+                dates = clusters[cluster_id]
+                if len(dates) > 0:
+                    tasks += cluster_tasks(cluster_id, result_folder, tmp_folder, dates, do_debug)
+            if imrs_merge.run_merge_tasks(tasks, ithitool, tmp_folder, nb_workers, do_debug) > 0:
+                exit(1)
+    except Exception as exc:
+       traceback.print_exc()
+       print('\nCode generated an exception: %s' % (exc))
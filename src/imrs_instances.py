@@ -19,6 +19,7 @@ import concurrent.futures
 import os
 from os import listdir
 from os.path import isfile, isdir, join
+import imrs_merge
 
 def prepare_instances_list(ipstats_folder, month):
     instances = dict()
@@ -50,11 +51,7 @@ def process_instance(instance_id, month, result_folder, tmp_folder, ithitool, in
     result_path = join(result_folder, result_file)
     tmp_file = instance_id + "_" + month + "-file-list.txt"
     tmp_path = join(tmp_folder, tmp_file)
-    with open(tmp_path,"wt") as F:
-            for file_name in instances[instance_id]:
-                F.write(file_name + "\n")
-    merge_cmd = ithitool + ' -I ' + result_path + " " + tmp_path
-    cmd_ret = os.system(merge_cmd)
+    cmd_ret = imrs_merge.merge_with_tool(ithitool, result_path, instances[instance_id], tmp_path, tmp_dir=tmp_folder)
     if cmd_ret == 0:
         if do_debug:
             print(result_file + ": computed.")
@@ -66,7 +63,8 @@ def process_instance(instance_id, month, result_folder, tmp_folder, ithitool, in
 # main
 if len(sys.argv) < 4 or len(sys.argv) > 5 or \
     (len(sys.argv) == 5 and sys.argv[4] != "debug"):
-    print("Usage: imrs_instances <ipstats_folder> <yyyymm> <ithitool> [debug]")
+    print("Usage: imrs_instances <ipstats_folder> <yyyymm> <ithitool | native> [debug]")
+    print("With \"native\", the files are merged by imrs_merge.py instead of ithitools.")
     print("There are just " + str(len(sys.argv)) + " arguments.")
     exit (1)
 ipstats_folder = sys.argv[1]
@@ -0,0 +1,339 @@
+#!/usr/bin/python
+# coding=utf-8
+#
+# This script merges ipstats files, as "ithitools -I <output> <file_list>"
+# does, without starting a process or loading all the records in memory.
+# The scripts imrs_cluster.py, imrs_instances.py, imrs_monthly.py and
+# imrs_total.py use it when the name of the tool is "native".
+#
+# The records with the same IP address are added with the same rules as
+# imrs_record.add in imrs/imrs.py: the counts are summed, the HyperLogLog
+# registers are merged with a maximum, and the estimates are computed
+# again from the registers. The optional APNIC and servers columns are
+# kept from the first record of the address, as imrs_record.add does for
+# a record of the same IP. Records that do not have these columns are
+# written in the same format as ithitools: same columns, estimates written
+# with "%f", addresses sorted with IPv4 first, then by address bytes.
+# There is one difference: ithitools adds the locales of a record to
+# themselves instead of adding those of the other record, the merge
+# adds the locales of both records.
+#
+# The files written by ithitools are sorted, and they are merged by
+# reading one record at a time from each file, using a heap. If a file
+# is not sorted, the merge is done again in two steps: the records are
+# first split in temporary partition files by a hash of the address, each
+# partition is then loaded, merged and sorted, and the sorted partitions
+# are merged with the heap. The memory used is about one partition.
+#
+# The output is written in a temporary file in the same folder, which is
+# renamed when complete, so that the other scripts and the reruns never
+# see a partial "-ipstats.csv" file. run_merge_tasks runs a list of
+# independent merges in a pool of processes, the largest first, so that
+# the longest merges do not start last.
+#
+# Usage: imrs_merge.py <output_file> <ipstats_file | list_file.txt> ...
+
+import sys
+import traceback
+import os
+import heapq
+import ipaddress
+import math
+import tempfile
+import shutil
+import zlib
+import concurrent.futures
+
+# Columns of the list of values that follow the IP address.
+nb_values = 135
+tld_estimate = 69
+sld_estimate = 94
+register_columns = list(range(tld_estimate + 1, tld_estimate + 17)) + \
+    list(range(sld_estimate + 1, sld_estimate + 17))
+default_partition_bytes = 256*1024*1024
+
+class ipstats_order_error(Exception):
+    pass
+
+def hll_estimate(registers):
+    divider = 0.0
+    for r in registers:
+        divider += 1.0 / (1 << r)
+    E = 172.288 / divider
+    if E < 40.0:
+        V = registers.count(0)
+        if V > 0:
+            E = 16 * math.log(16.0 / V)
+    return E
+
+def parse_number(p):
+    try:
+        return int(p)
+    except ValueError:
+        # Some large files were generated with "0.0" instead of "0".
+        return int(float(p))
+
+# A record is a list [ key, ip, values, tail ]. The key sorts the addresses
+# as ithitools does, and tail holds the APNIC and servers columns, if any.
+def parse_record(line):
+    parts = line.rstrip("\r\n, ").split(",")
+    if len(parts) < nb_values + 1:
+        return None
+    ip = parts[0].strip()
+    if len(ip) == 0:
+        ip = "0.0.0.0"
+    packed = ipaddress.ip_address(ip).packed
+    parts[tld_estimate + 1] = "0"
+    parts[sld_estimate + 1] = "0"
+    try:
+        values = list(map(int, parts[1:nb_values + 1]))
+        tail = list(map(int, parts[nb_values + 1:nb_values + 3]))
+    except ValueError:
+        values = list(map(parse_number, parts[1:nb_values + 1]))
+        tail = list(map(parse_number, parts[nb_values + 1:nb_values + 3]))
+    return [ (len(packed), packed), ip, values, tail ]
+
+def add_record(record, other):
+    values = record[2]
+    other_values = other[2]
+    merged = [ x + y for x, y in zip(values, other_values) ]
+    for i in register_columns:
+        merged[i] = max(values[i], other_values[i])
+    record[2] = merged
+
+def record_to_string(record):
+    values = record[2]
+    parts = list(map(str, values))
+    parts[tld_estimate] = "{:f}".format(hll_estimate(values[tld_estimate + 1:tld_estimate + 17]))
+    parts[sld_estimate] = "{:f}".format(hll_estimate(values[sld_estimate + 1:sld_estimate + 17]))
+    s = record[1] + "," + ",".join(parts)
+    for v in record[3]:
+        s += "," + str(v)
+    return s + "\n"
+
+# Read the records of one file, in order. If check_order is set, raise
+# ipstats_order_error when an address is lower than the previous one.
+def read_records(file_name, check_order=True):
+    previous_key = None
+    with open(file_name, "r") as F:
+        for line in F:
+            try:
+                record = parse_record(line)
+            except Exception as e:
+                print("Cannot parse: " + line.strip()[0:64] + " in " + file_name + "\nException: " + str(e))
+                continue
+            if record is None:
+                if len(line.strip()) > 0:
+                    print("Cannot parse: " + line.strip()[0:64] + " in " + file_name)
+                continue
+            if check_order:
+                if previous_key is not None and record[0] < previous_key:
+                    raise ipstats_order_error(file_name + ": " + record[1] + " is out of order.")
+                previous_key = record[0]
+            yield record
+
+# Merge sorted files in F, and return the number of records written.
+def merge_sorted(file_list, F):
+    nb_records = 0
+    heap = []
+    readers = []
+    for file_name in file_list:
+        readers.append(read_records(file_name))
+    for i in range(0, len(readers)):
+        record = next(readers[i], None)
+        if record is not None:
+            heap.append((record[0], i, record))
+    heapq.heapify(heap)
+    current = None
+    while len(heap) > 0:
+        key, i, record = heap[0]
+        if current is not None and current[0] == key:
+            add_record(current, record)
+        else:
+            if current is not None:
+                F.write(record_to_string(current))
+                nb_records += 1
+            current = record
+        record = next(readers[i], None)
+        if record is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (record[0], i, record))
+    if current is not None:
+        F.write(record_to_string(current))
+        nb_records += 1
+    return nb_records
+
+def partition_id(record, nb_partitions):
+    return zlib.crc32(record[0][1]) % nb_partitions
+
+# Split the records of all files by hash of the address, then write each
+# partition sorted and merged, and return the list of partition files.
+def write_partitions(file_list, tmp_dir, nb_partitions):
+    partition_files = []
+    partition_outputs = []
+    for i in range(0, nb_partitions):
+        partition_files.append(os.path.join(tmp_dir, "partition-" + str(i) + ".csv"))
+        partition_outputs.append(open(partition_files[i], "wt"))
+    for file_name in file_list:
+        for record in read_records(file_name, check_order=False):
+            partition_outputs[partition_id(record, nb_partitions)].write(record_to_string(record))
+    for F in partition_outputs:
+        F.close()
+    sorted_files = []
+    for i in range(0, nb_partitions):
+        records = dict()
+        for record in read_records(partition_files[i], check_order=False):
+            if record[0] in records:
+                add_record(records[record[0]], record)
+            else:
+                records[record[0]] = record
+        os.remove(partition_files[i])
+        sorted_file = os.path.join(tmp_dir, "sorted-" + str(i) + ".csv")
+        with open(sorted_file, "wt") as F:
+            for key in sorted(records.keys()):
+                F.write(record_to_string(records[key]))
+        sorted_files.append(sorted_file)
+    return sorted_files
+
+def merge_unsorted(file_list, F, tmp_dir=None, partition_bytes=default_partition_bytes):
+    total_bytes = 0
+    for file_name in file_list:
+        total_bytes += os.path.getsize(file_name)
+    nb_partitions = max(1, int(total_bytes / partition_bytes) + 1)
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as partition_dir:
+        sorted_files = write_partitions(file_list, partition_dir, nb_partitions)
+        return merge_sorted(sorted_files, F)
+
+def temp_output_name(output_file):
+    return output_file + ".tmp" + str(os.getpid())
+
+def remove_if_present(file_name):
+    if os.path.isfile(file_name):
+        os.remove(file_name)
+
+# Merge the files in output_file, and return the number of records.
+def merge_ipstats_files(output_file, file_list, tmp_dir=None, partition_bytes=default_partition_bytes):
+    temp_file = temp_output_name(output_file)
+    try:
+        try:
+            with open(temp_file, "wt") as F:
+                nb_records = merge_sorted(file_list, F)
+        except ipstats_order_error as e:
+            print(str(e) + " Merging through partitions.")
+            with open(temp_file, "wt") as F:
+                nb_records = merge_unsorted(file_list, F, tmp_dir=tmp_dir, partition_bytes=partition_bytes)
+        os.replace(temp_file, output_file)
+    finally:
+        remove_if_present(temp_file)
+    return nb_records
+
+def copy_ipstats_file(input_file, output_file):
+    temp_file = temp_output_name(output_file)
+    try:
+        shutil.copyfile(input_file, temp_file)
+        os.replace(temp_file, output_file)
+    finally:
+        remove_if_present(temp_file)
+
+# Same as the arguments of ithitools: files ending with .txt contain lists
+# of file names.
+def expand_file_list(args):
+    file_list = []
+    for arg in args:
+        if arg.endswith(".txt"):
+            for line in open(arg, "r"):
+                file_name = line.strip()
+                if len(file_name) > 0:
+                    file_list += expand_file_list([ file_name ])
+        else:
+            file_list.append(arg)
+    return file_list
+
+# merge_with_tool merges file_list in output_file. If ithitool is "native",
+# the files are merged by merge_ipstats_files. Otherwise, the list of files
+# is written in list_file and ithitool is called with the option -I.
+# Returns 0 if the merge succeeded, an error code otherwise.
+def merge_with_tool(ithitool, output_file, file_list, list_file, tmp_dir=None):
+    if ithitool == "native":
+        try:
+            merge_ipstats_files(output_file, file_list, tmp_dir=tmp_dir)
+            return 0
+        except Exception as e:
+            traceback.print_exc()
+            print("Cannot merge in " + output_file + "\nException: " + str(e))
+            return -1
+    with open(list_file, "wt") as F:
+        for file_name in file_list:
+            F.write(file_name + "\n")
+    temp_file = temp_output_name(output_file)
+    cmd_ret = os.system(ithitool + ' -I ' + temp_file + " " + list_file)
+    if cmd_ret == 0:
+        os.replace(temp_file, output_file)
+    else:
+        remove_if_present(temp_file)
+    return cmd_ret
+
+# A merge task produces output_file from the list of files. If copy_single
+# is set and there is just one file, it is copied instead of merged.
+class merge_task:
+    def __init__(self, report_name, output_file, file_list, list_file, copy_single=False):
+        self.report_name = report_name
+        self.output_file = output_file
+        self.file_list = file_list
+        self.list_file = list_file
+        self.copy_single = copy_single
+        self.size = 0
+        for file_name in file_list:
+            self.size += os.path.getsize(file_name)
+
+def run_merge_task(task, ithitool, tmp_dir):
+    if task.copy_single and len(task.file_list) == 1:
+        try:
+            copy_ipstats_file(task.file_list[0], task.output_file)
+            return 0
+        except Exception as e:
+            traceback.print_exc()
+            print("Cannot copy " + task.file_list[0] + "\nException: " + str(e))
+            return -1
+    return merge_with_tool(ithitool, task.output_file, task.file_list, task.list_file, tmp_dir=tmp_dir)
+
+# run_merge_tasks runs the tasks, largest first, in nb_workers processes,
+# or in this process if nb_workers is 1. Returns the number of failed tasks.
+def run_merge_tasks(tasks, ithitool, tmp_dir, nb_workers, do_debug):
+    nb_failed = 0
+    tasks = sorted(tasks, key=lambda task: task.size, reverse=True)
+    results = []
+    if nb_workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            results.append((task, run_merge_task(task, ithitool, tmp_dir)))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nb_workers) as executor:
+            futures = dict()
+            for task in tasks:
+                futures[executor.submit(run_merge_task, task, ithitool, tmp_dir)] = task
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    cmd_ret = future.result()
+                except Exception as e:
+                    traceback.print_exc()
+                    print(futures[future].report_name + ": worker failed\nException: " + str(e))
+                    cmd_ret = -1
+                results.append((futures[future], cmd_ret))
+    for task, cmd_ret in results:
+        if cmd_ret == 0:
+            if do_debug:
+                print(task.report_name + ": computed.")
+        else:
+            print(task.report_name + ": computation failed, error:" + str(cmd_ret))
+            nb_failed += 1
+    return nb_failed
+
+# main
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: imrs_merge.py <output_file> <ipstats_file | list_file.txt> ...")
+        exit(1)
+    file_list = expand_file_list(sys.argv[2:])
+    nb_records = merge_ipstats_files(sys.argv[1], file_list)
+    print("File processing succeeded, " + str(nb_records) + " records.")
@@ -0,0 +1,73 @@
+# IMRS merge test.
+# verify that imrs_merge adds the records of the same address, merges
+# the HyperLogLog registers, writes the addresses in the ithitools order,
+# and gives the same result when an input file is not sorted.
+
+import os
+import tempfile
+import imrs_merge
+
+def test_line(ip, n, register, tail=""):
+    values = [ n ]*imrs_merge.nb_values
+    for i in imrs_merge.register_columns:
+        values[i] = register
+    values[imrs_merge.tld_estimate] = "0.000000"
+    values[imrs_merge.sld_estimate] = "0.000000"
+    return ip + "," + ",".join(map(str, values)) + tail + "\n"
+
+def write_file(file_name, lines):
+    with open(file_name, "wt") as F:
+        for line in lines:
+            F.write(line)
+
+def check_output(output_file, expected):
+    passing = True
+    lines = open(output_file, "r").readlines()
+    ips = []
+    for line in lines:
+        ips.append(line.split(",")[0])
+    if ips != [ x[0] for x in expected ]:
+        print("Unexpected order: " + str(ips))
+        return False
+    for i in range(0, len(expected)):
+        ip, n, register, tail = expected[i]
+        record = imrs_merge.parse_record(lines[i])
+        expected_record = imrs_merge.parse_record(test_line(ip, n, register, tail))
+        estimate = "{:f}".format(imrs_merge.hll_estimate([ register ]*16))
+        if record[2] != expected_record[2] or record[3] != expected_record[3] or \
+            lines[i].split(",")[imrs_merge.tld_estimate + 1] != estimate:
+            print("Unexpected record: " + lines[i].strip())
+            passing = False
+    return passing
+
+if __name__ == "__main__":
+    passing = True
+    file_a = [ test_line("10.0.0.1", 1, 2), test_line("10.0.0.2", 1, 3), test_line("2001:db8::1", 1, 1) ]
+    file_b = [ test_line("9.0.0.1", 2, 1), test_line("10.0.0.2", 2, 5, ",7,3"), test_line("2001:db8::1", 2, 0.0) ]
+    expected = [ [ "9.0.0.1", 2, 1, "" ], [ "10.0.0.1", 1, 2, "" ], [ "10.0.0.2", 3, 5, "" ], [ "2001:db8::1", 3, 1, "" ] ]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        a = os.path.join(temp_dir, "a.csv")
+        b = os.path.join(temp_dir, "b.csv")
+        c = os.path.join(temp_dir, "c.csv")
+        write_file(a, file_a)
+        write_file(b, file_b)
+        write_file(c, list(reversed(file_b)))
+        sorted_output = os.path.join(temp_dir, "sorted.csv")
+        nb_records = imrs_merge.merge_ipstats_files(sorted_output, [ a, b ])
+        passing &= nb_records == 4 and check_output(sorted_output, expected)
+        # the tail columns are kept from the first record of the address
+        tail_output = os.path.join(temp_dir, "tail.csv")
+        imrs_merge.merge_ipstats_files(tail_output, [ b, a ])
+        expected[2][3] = ",7,3"
+        passing &= check_output(tail_output, expected)
+        unsorted_output = os.path.join(temp_dir, "unsorted.csv")
+        imrs_merge.merge_ipstats_files(unsorted_output, [ a, c ], tmp_dir=temp_dir, partition_bytes=100)
+        if open(unsorted_output, "r").read() != open(sorted_output, "r").read():
+            print("The merge of the unsorted file differs.")
+            passing = False
+    if not passing:
+        print("Fail.")
+        exit(-1)
+    else:
+        print("Success.")
+        exit(0)
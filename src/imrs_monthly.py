@@ -18,6 +18,7 @@ import concurrent.futures
 import os
 from os import listdir
 from os.path import isfile, isdir, join
+import imrs_merge
 
 def check_or_create_dir(dir_path):
     if not isdir(dir_path):
@@ -29,66 +30,77 @@ def check_or_create_dir(dir_path):
             return False
     return True
 
-# main
-if len(sys.argv) < 4 or len(sys.argv) > 5 or \
-    (len(sys.argv) == 5 and sys.argv[4] != "debug"):
-    print("Usage: imrs_monthly <ipstats_folder> <yyyymm> <ithitool> [\"debug\"]")
-    print("There are just " + str(len(sys.argv)) + " arguments.")
-    exit (1)
-ipstats_folder = sys.argv[1]
-month = sys.argv[2]
-ithitool = sys.argv[3]
-do_debug = len(sys.argv) == 5
-
-print("Writing monthly per custom clusters aggregates for: " + ipstats_folder)
-try:
-    # Look at every cluster under the "clusters" folder
-    clusters_folder = join(ipstats_folder, "clusters")
-    monthly_folder = join(ipstats_folder, "monthly")
-    tmp_folder = join(ipstats_folder, "tmp")
+# monthly_tasks returns one merge task per cluster folder, merging the
+# daily files of the month.
+def monthly_tasks(clusters_folder, monthly_folder, tmp_folder, month):
+    tasks = []
     cluster_list = listdir(clusters_folder)
-    if check_or_create_dir(monthly_folder) and \
-       check_or_create_dir(tmp_folder):
-        for cluster_id in cluster_list:
-            # check that this is a cluster, and not some other file
-            this_cluster_dir = join(clusters_folder, cluster_id)
-            cluster_parts = cluster_id.split("-")
-            if len(cluster_parts) != 2 or \
-                len(cluster_parts[0]) != 2 or \
-                len(cluster_parts[1]) != 3:
-                print("*** Unexpected cluster name: " + this_cluster_dir)
-            elif not isdir(this_cluster_dir):
-                print("*** Not a cluster folder: " + this_cluster_dir)
-            else:
-                tmp_file_name = join(tmp_folder, cluster_id + '.' + month + ".txt")
-                nb_files = 0
-                with open(tmp_file_name, "wt") as F:
-                    result_list = listdir(this_cluster_dir)
-                    for result_file in result_list:
-                        result_path = join(this_cluster_dir, result_file)
-                        if not isfile(result_path) or \
-                            not result_file.startswith(month) or \
-                            not result_file.endswith("ipstats.csv"):
-                            print("*** Unexpected file: " + result_file)
-                        else:
-                            nb_files += 1
-                            F.write(result_path+"\n")
-                print(cluster_id + ", " + str(nb_files))
-                if nb_files > 0:
-                    ipstats_file = cluster_id + "." + month + "-" + "ipstats.csv"
-                    ipstats_path = join(monthly_folder, ipstats_file)
-                    merge_cmd = ithitool + ' -I ' + ipstats_path + " " + tmp_file_name
-                    cmd_ret = os.system(merge_cmd)
-                    if cmd_ret == 0:
-                        if do_debug:
-                            print(report_name + ": computed.")
-                    else:
-                        print(report_name + ": computation failed, error:" + str(cmd_ret))
-except Exception as exc:
-   traceback.print_exc()
-   print('\nCode generated an exception: %s' % (exc))
-
-
+    for cluster_id in cluster_list:
+        # check that this is a cluster, and not some other file
+        this_cluster_dir = join(clusters_folder, cluster_id)
+        cluster_parts = cluster_id.split("-")
+        if len(cluster_parts) != 2 or \
+            len(cluster_parts[0]) != 2 or \
+            len(cluster_parts[1]) != 3:
+            print("*** Unexpected cluster name: " + this_cluster_dir)
+        elif not isdir(this_cluster_dir):
+            print("*** Not a cluster folder: " + this_cluster_dir)
+        else:
+            tmp_file_name = join(tmp_folder, cluster_id + '.' + month + ".txt")
+            file_list = []
+            result_list = listdir(this_cluster_dir)
+            for result_file in result_list:
+                result_path = join(this_cluster_dir, result_file)
+                if not isfile(result_path) or \
+                    not result_file.startswith(month) or \
+                    not result_file.endswith("ipstats.csv"):
+                    print("*** Unexpected file: " + result_file)
+                else:
+                    file_list.append(result_path)
+            nb_files = len(file_list)
+            print(cluster_id + ", " + str(nb_files))
+            if nb_files > 0:
+                ipstats_file = cluster_id + "." + month + "-" + "ipstats.csv"
+                ipstats_path = join(monthly_folder, ipstats_file)
+                tasks.append(imrs_merge.merge_task(ipstats_file, ipstats_path, file_list, tmp_file_name))
+    return tasks
 
+def usage():
+    print("Usage: imrs_monthly [--workers N] <ipstats_folder> <yyyymm> <ithitool | native> [\"debug\"]")
+    print("With \"native\", the files are merged by imrs_merge.py instead of ithitools.")
+    print("The merges run in N processes, by default one per core.")
 
+# main
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    nb_workers = os.cpu_count()
+    if "--workers" in args:
+        i = args.index("--workers")
+        if i + 1 >= len(args) or not args[i+1].isdigit() or int(args[i+1]) < 1:
+            usage()
+            exit(1)
+        nb_workers = int(args[i+1])
+        args = args[:i] + args[i+2:]
+    if len(args) < 3 or len(args) > 4 or \
+        (len(args) == 4 and args[3] != "debug"):
+        usage()
+        print("There are just " + str(len(sys.argv)) + " arguments.")
+        exit (1)
+    ipstats_folder = args[0]
+    month = args[1]
+    ithitool = args[2]
+    do_debug = len(args) == 4
 
+    print("Writing monthly per custom clusters aggregates for: " + ipstats_folder)
+    try:
+        # Look at every cluster under the "clusters" folder
+        clusters_folder = join(ipstats_folder, "clusters")
+        monthly_folder = join(ipstats_folder, "monthly")
+        tmp_folder = join(ipstats_folder, "tmp")
+        if check_or_create_dir(monthly_folder) and \
+           check_or_create_dir(tmp_folder):
+            tasks = monthly_tasks(clusters_folder, monthly_folder, tmp_folder, month)
+            imrs_merge.run_merge_tasks(tasks, ithitool, tmp_folder, nb_workers, do_debug)
+    except Exception as exc:
+       traceback.print_exc()
+       print('\nCode generated an exception: %s' % (exc))
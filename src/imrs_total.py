@@ -18,6 +18,7 @@ import concurrent.futures
 import os
 from os import listdir
 from os.path import isfile, isdir, join
+import imrs_merge
 
 def check_or_create_dir(dir_path):
     if not isdir(dir_path):
@@ -32,7 +33,8 @@ def check_or_create_dir(dir_path):
 # main
 if len(sys.argv) < 4 or len(sys.argv) > 5 or \
     (len(sys.argv) == 5 and sys.argv[4] != "debug"):
-    print("Usage: imrs_monthly <ipstats_folder> <yyyymm> <ithitool> [\"debug\"]")
+    print("Usage: imrs_total <ipstats_folder> <yyyymm> <ithitool | native> [\"debug\"]")
+    print("With \"native\", the files are merged by imrs_merge.py instead of ithitools.")
     print("There are just " + str(len(sys.argv)) + " arguments.")
     exit (1)
 ipstats_folder = sys.argv[1]
@@ -49,33 +51,32 @@ try:
     if check_or_create_dir(monthly_folder) and \
        check_or_create_dir(tmp_folder):
         tmp_file_name = join(tmp_folder, month + ".txt")
-        with open(tmp_file_name, "wt") as F:
-            # check that this is a cluster, and not some other file
-            # Watch for: cluster_id + "." + month + "-" + "ipstats.csv"
-            monthly_file_end = month + "-" + "ipstats.csv"
-            for monthly_file in monthly_list:
-                monthly_path = join(monthly_folder, monthly_file)
-                if len(monthly_file) > 7 and \
-                    monthly_file[2] == "-" and \
-                    monthly_file[6] == "." and \
-                    monthly_file.endswith(monthly_file_end):
-                    F.write(monthly_path +"\n")
-                    if do_debug:
-                        print("Adding: " + monthly_file)
-                elif do_debug:
-                    print("Not a monthly file: " + monthly_path)
+        file_list = []
+        # check that this is a cluster, and not some other file
+        # Watch for: cluster_id + "." + month + "-" + "ipstats.csv"
+        monthly_file_end = month + "-" + "ipstats.csv"
+        for monthly_file in monthly_list:
+            monthly_path = join(monthly_folder, monthly_file)
+            if len(monthly_file) > 7 and \
+                monthly_file[2] == "-" and \
+                monthly_file[6] == "." and \
+                monthly_file.endswith(monthly_file_end):
+                file_list.append(monthly_path)
+                if do_debug:
+                    print("Adding: " + monthly_file)
+            elif do_debug:
+                print("Not a monthly file: " + monthly_path)
         total_file = "total-" + month +  "-" + "ipstats.csv"
         total_path = join(ipstats_folder, total_file)
-        merge_cmd = ithitool + ' -I ' + total_path + " " + tmp_file_name
         if do_debug:
-            print("Running: " + merge_cmd)
+            print("Merging " + str(len(file_list)) + " files with " + ithitool + " in " + total_path)
             sys.stdout.flush()
-        cmd_ret = os.system(merge_cmd)
+        cmd_ret = imrs_merge.merge_with_tool(ithitool, total_path, file_list, tmp_file_name, tmp_dir=tmp_folder)
         if cmd_ret == 0:
             if do_debug:
                 print(total_file + ": computed.")
         else:
-            print(report_name + ": computation failed, error:" + str(cmd_ret))
+            print(total_file + ": computation failed, error:" + str(cmd_ret))
 except Exception as exc:
    traceback.print_exc()
    print('\nCode generated an exception: %s' % (exc))
@@ -39,27 +39,34 @@
 # if not yet present, creates the collection folder, the result
 #   folder and the temporary folder.
 # Collect list of instances (from storage folder)
-# In parallel, process instances -- one python thread by instance:
+# For each instance:
 #   if ~/ipstats/results/<instance> not present, create.
 #   if ~/ipstats/tmp/<instance> not present, create.
 #   list all slices files in /data/ITHI/cbor/IMRS/<instance>/cbor.
-#   from list of slices, extract list of dates.
-#   trim list of dates:
-#        - remove the last date, because it might be incomplete.
-#        - remove all dates not in target month.
-#   for each date in trimmed list:
-#        - if ~/ipstats/<instance>/<date>--ipstats.csv is not present: 
-#               extract sublist of slices.
-#               for each slice of date:
-#                   if ~/ipstats/tmp/<instance>/<slice>.ipstats.csv exists, continue
-#                   else:
-#                       spawn ithitools task, create csv from slice.
-#           add all slice.csv from progress into <date>.csv for instance, using
-#           ithitools task.
-#       - remove all dated files from ~/ipstats/<instance>/progress/
+#   from list of slices, extract list of dates in the target month.
+#   for each date, prepare a work item with the list of slices of the date,
+#   unless the manifest shows that it was already computed.
+# Process the work items in parallel, one process per core. Each item
+# spawns an ithitools task, which computes ~/ipstats/<instance>/<date>-ipstats.csv
+# from the slices. The result is first written in a temporary file, then
+# renamed, so that an interrupted run never leaves a partial result.
 #
-# The script can stop if the specified duration time is elapsed. The time is checked
-# in the for loops "for each date" and "for each slice of date".
+# The items are submitted by decreasing total size of the cbor files, so
+# that the largest dates of the largest instances do not start last, and
+# only a few items are submitted ahead of the free workers, so that idle
+# workers pick the next item whatever its instance.
+#
+# The manifest, ~/ipstats/manifest-<yyyymm>.json, records for each
+# "<instance>/<date>" whether the computation succeeded or failed, with the
+# number and total size of the slices. The next run skips the items that
+# succeeded, unless the slices changed since, for example because the date
+# was still in progress, and retries the items that failed. Results
+# computed by previous versions of the script, which are not yet in the
+# manifest, are considered complete.
+#
+# The script stops submitting new items when the specified duration is
+# elapsed, and waits for the items in progress. The next run continues with
+# the remaining items.
 
 import sys
 import traceback
@@ -67,6 +74,7 @@ import random
 import time
 import concurrent.futures
 import os
+import json
 from os import listdir
 from os.path import isfile, isdir, join
 
@@ -101,6 +109,89 @@ def prepare_instance_list(storage_folder):
                     instance_list.append(folder)
     return sorted(instance_list)
 
+max_run_time = 18*60*60
+
+# A work item computes the ipstats file of one instance for one date.
+class date_item:
+    def __init__(self, instance, date, cbor_files, result_file, list_file, cmd):
+        self.instance = instance
+        self.date = date
+        self.cbor_files = cbor_files
+        self.result_file = result_file
+        self.list_file = list_file
+        self.cmd = cmd
+        self.size = 0
+        for cbor_file in cbor_files:
+            self.size += os.path.getsize(cbor_file)
+
+    def key(self):
+        return self.instance + "/" + self.date
+
+    def signature(self):
+        return [ len(self.cbor_files), self.size ]
+
+# process_date_item runs in the worker processes, and returns the exit
+# code of ithitools and the duration of the computation.
+def process_date_item(item):
+    start_time = time.time()
+    print("Need to compute: " + item.result_file)
+    with open(item.list_file, "wt") as F:
+        for cbor_file in item.cbor_files:
+            F.write(cbor_file + "\n")
+    temp_result = item.result_file + ".tmp" + str(os.getpid())
+    merge_cmd = item.cmd + ' -I ' + temp_result + " " + item.list_file
+    cmd_ret = os.system(merge_cmd)
+    if cmd_ret == 0 and isfile(temp_result):
+        os.replace(temp_result, item.result_file)
+    else:
+        if cmd_ret == 0:
+            cmd_ret = -1
+        if isfile(temp_result):
+            os.remove(temp_result)
+    return cmd_ret, time.time() - start_time
+
+class run_manifest:
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.items = dict()
+        if isfile(manifest_file):
+            try:
+                with open(manifest_file, "rt") as F:
+                    self.items = json.load(F)
+            except Exception as exc:
+                traceback.print_exc()
+                print("Cannot load the manifest " + manifest_file + ": " + str(exc))
+
+    def is_done(self, item):
+        if not item.key() in self.items:
+            return False
+        entry = self.items[item.key()]
+        return entry["status"] == "done" and entry["signature"] == item.signature() and \
+            isfile(item.result_file)
+
+    def has(self, item):
+        return item.key() in self.items
+
+    def record(self, item, cmd_ret, duration):
+        status = "done"
+        if cmd_ret != 0:
+            status = "failed"
+        self.items[item.key()] = { "status": status, "signature": item.signature(), \
+            "error": cmd_ret, "duration": round(duration, 3), "time": int(time.time()) }
+
+    def save(self):
+        temp_file = self.manifest_file + ".tmp" + str(os.getpid())
+        with open(temp_file, "wt") as F:
+            json.dump(self.items, F, indent=1, sort_keys=True)
+        os.replace(temp_file, self.manifest_file)
+
+    def nb_status(self, status):
+        nb = 0
+        for key in self.items:
+            if self.items[key]["status"] == status:
+                nb += 1
+        return nb
+
 class instance_bucket:
     def __init__(self, instance, storage_folder, result_path, tmp_path, month, cmd, do_debug):
         self.instance = instance
@@ -114,8 +205,6 @@ class instance_bucket:
         self.storage_instance = join(storage_folder, instance)
         self.cbor_instance = join(self.storage_instance, "cbor")
         self.slices = []
-        self.is_complete = False
-        self.end_time = time.time() + 18*60*60
         self.do_debug = do_debug
 
     def begin_instance(self):
@@ -140,63 +229,80 @@ class instance_bucket:
             self.date_list = self.date_list[0:1]
         return True
 
-    def process_date(self, d):
+    def get_date_item(self, d):
         date_result = join(self.result_instance, d + "-ipstats.csv")
         date_tmp = join(self.tmp_instance, d + ".txt")
-        print("Computing " + date_result)
-        if not isfile(date_result):
-            print("Need to compute: " + date_result)
-            this_slice = [ s for s in self.slices if s.startswith(d) and s.endswith(".cbor.xz") ]
-            try:
-                with open(date_tmp, "wt") as F:
-                    for s in this_slice:
-                        s_file = join(self.cbor_instance, s)
-                        if os.path.getsize(s_file) > 0:
-                            F.write(s_file + "\n")
-                merge_cmp = self.cmd + ' -I ' + date_result + " " + date_tmp
-                cmd_ret = os.system(merge_cmp)
-                if cmd_ret == 0:
-                    print("Computation of " + date_result + " succeeds.")
-                else:
-                    print("Computation of " + date_result + " failed, error:" + str(cmd-ret))
-                    return False
-            
-            except Exception as exc:
-                traceback.print_exc()
-                print('\nInstance %s generated an exception: %s' % (self.instance, exc))
-                return False
-        else:
-            print ("Already computed: " + date_result)
-        return True
+        this_slice = [ s for s in self.slices if s.startswith(d) and s.endswith(".cbor.xz") ]
+        cbor_files = []
+        for s in this_slice:
+            s_file = join(self.cbor_instance, s)
+            if os.path.getsize(s_file) > 0:
+                cbor_files.append(s_file)
+        return date_item(self.instance, d, cbor_files, date_result, date_tmp, self.cmd)
 
-    def load(self):
+    # get_date_items returns the items of the instance that are not yet
+    # computed according to the manifest.
+    def get_date_items(self, manifest):
+        items = []
         try:
-            print("Loading " + self.instance)
             if not self.begin_instance():
                 print("Begin " + self.instance + "failed.")
-                return False
-            print("Dates for " + self.instance)
+                return items
             if not self.get_list_of_dates():
                 print("Dates for " + self.instance + "failed.")
-                return False
-            print ("Found " + str(len(self.slices)) + " slices, " + str(len(self.date_list)) + " dates.")
+                return items
             for d in self.date_list:
-                if time.time() > self.end_time:
-                    print("Job has been running too long, stop now")
-                    return False
-                print("Looking date " + d)
-                if not self.process_date(d):
-                    return False
-            print("Complete.")
-            self.is_complete = True
-            return True
+                item = self.get_date_item(d)
+                if manifest.is_done(item):
+                    if self.do_debug:
+                        print("Already computed: " + item.result_file)
+                elif isfile(item.result_file) and not manifest.has(item):
+                    # computed before the manifest was used
+                    print("Already computed: " + item.result_file)
+                    manifest.record(item, 0, 0)
+                else:
+                    items.append(item)
+            print(self.instance + ": " + str(len(self.slices)) + " slices, " + str(len(self.date_list)) + " dates, " + \
+                str(len(items)) + " to compute.")
         except Exception as exc:
-                traceback.print_exc()
-                print('\nScript generated an exception: %s' %(exc))
-                return False
+            traceback.print_exc()
+            print('\nInstance %s generated an exception: %s' % (self.instance, exc))
+        return items
+
+# run_date_items processes the items, largest first. At most two items
+# per worker are submitted ahead, so that no new item starts after
+# end_time. The manifest is saved after each item.
+def run_date_items(items, nb_process, end_time, manifest):
+    items = sorted(items, key=lambda item: item.size, reverse=True)
+    next_item = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers = nb_process) as executor:
+        pending = dict()
+        while True:
+            while next_item < len(items) and len(pending) < 2*nb_process and time.time() < end_time:
+                pending[executor.submit(process_date_item, items[next_item])] = items[next_item]
+                next_item += 1
+            if len(pending) == 0:
+                break
+            done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                duration = 0
+                try:
+                    cmd_ret, duration = future.result()
+                except Exception as exc:
+                    traceback.print_exc()
+                    print('\nItem %s generated an exception: %s' % (item.key(), exc))
+                    cmd_ret = -1
+                if cmd_ret == 0:
+                    print("Computation of " + item.result_file + " succeeds.")
+                else:
+                    print("Computation of " + item.result_file + " failed, error:" + str(cmd_ret))
+                manifest.record(item, cmd_ret, duration)
+                manifest.save()
+    if next_item < len(items):
+        print("Job has been running too long, " + str(len(items) - next_item) + " items left for the next run.")
+    return next_item
 
-def instance_bucket_load(bucket):
-    return bucket.load()
 # Main
 def main():
     start_time = time.time()
@@ -224,32 +330,24 @@ def main():
         exit (1)
 
     print ("Found " + str(len(instance_list)) + " instances")
+    manifest = run_manifest(join(collection_folder, "manifest-" + month + ".json"))
     
     nb_process = os.cpu_count()
-    bucket_list = []
+    items = []
     s = ""
     for instance in instance_list:
         bucket = instance_bucket(instance, storage_folder, result_path, tmp_path, month, ithitool, do_debug)
-        bucket_list.append(bucket)
+        items += bucket.get_date_items(manifest)
         s += instance + ", "
         if do_debug:
             break;
-    print("Starting to process " + str(len(instance_list)) + " instances:\n" + s)
+    manifest.save()
+    print("Starting to process " + str(len(items)) + " dates of " + str(len(instance_list)) + " instances:\n" + s)
     
-    # process multiple instances in parallel
-    with concurrent.futures.ProcessPoolExecutor(max_workers = nb_process) as executor:
-        future_to_bucket = {executor.submit(instance_bucket_load, bucket):bucket for bucket in bucket_list }
-        for future in concurrent.futures.as_completed(future_to_bucket):
-            bucket = future_to_bucket[future]
-            try:
-                # data = future.result()
-                bucket.is_complete = True
-                sys.stdout.write(".")
-                sys.stdout.flush()
-            except Exception as exc:
-                traceback.print_exc()
-                print('\nBucket %s generated an exception: %s' % (bucket.instance, exc))
-        print("\nAll buckets processed.")
+    # process the dates of all instances in parallel
+    run_date_items(items, nb_process, start_time + max_run_time, manifest)
+    print("\nAll items processed: " + str(manifest.nb_status("done")) + " done, " + \
+        str(manifest.nb_status("failed")) + " failed, in " + str(int(time.time() - start_time)) + " seconds.")
 
 # actual main program, can be called by threads, etc.
 if __name__ == '__main__':